@@ -0,0 +1,112 @@
+# -*- coding: UTF-8 -*-
+"""Batches of country records for the model adapter.
+
+A batch is a json array of packed input records, or ndjson (one record per
+line). Valid records are run together in one vectorized call of the model
+function; results and errors (a list of messages, as the errors of single
+record requests) are returned per record, in input order.
+"""
+
+import json
+import logging
+
+import pandas as pd
+
+from packed_schema import SchemaError, parse_records
+
+logger = logging.getLogger(__name__)
+
+
+def is_batch(text):
+    """True if text is a json array or several ndjson lines rather than a single (possibly pretty-printed) json record"""
+    try:
+        return isinstance(json.loads(text), list)
+    except ValueError:
+        #not a json value: ndjson if it has several lines
+        return len([l for l in text.splitlines() if l.strip()]) > 1
+
+
+def parse_line(line):
+    """(record, error) for one ndjson line. record is None when the line is not a json object"""
+    try:
+        rec = json.loads(line)
+    except ValueError as e:
+        return None, "invalid json: {}".format(e)
+    return (rec, None) if isinstance(rec, dict) else (None, "record is not a json object")
+
+
+def parse_batch(text):
+    """list of (record, error) from a json array or ndjson text. record is None when the line is not valid json"""
+
+    text = text.strip()
+    if text.startswith("["):
+        try:
+            return [(rec, None) if isinstance(rec, dict) else (None, "record is not a json object") for rec in json.loads(text)]
+        except ValueError as e:
+            return [(None, "invalid json: {}".format(e))]
+
+    return [parse_line(line) for line in text.splitlines() if line.strip()]
+
+
+def _call(model_function, df, store):
+    if store is not None:
+        return store.call(model_function, df)
+    return model_function(df)
+
+
+def _row_to_dict(row):
+    #goes through pandas json to get the same encoding (eg nan as null) as single record requests
+    return json.loads(row.to_json())
+
+
+def row_result(out, name):
+    """result of the record name in the outputs out of the model function"""
+    return _row_to_dict(out.loc[name])
+
+
+def run_batch(records, model_function, store=None, result_function=row_result):
+    """runs model_function on records (list of (record, error) as returned by parse_batch).
+    Records with the same columns are run in one call (names must be unique within a call, so repeated names go to separate calls).
+    If a call fails, its records are run one by one to attribute the error.
+    result_function(outputs, name) extracts the result of a record from the outputs of a call.
+    Returns one dict per record, in input order, with the name and either result or error"""
+
+    results = [None] * len(records)
+    frames = dict()
+
+    for i, (rec, error) in enumerate(records):
+        name = rec.get("name") if rec is not None else None
+        if error is not None:
+            results[i] = dict(name=name, error=error if isinstance(error, list) else [error])
+            continue
+        try:
+            df = parse_records([rec])
+        except SchemaError as e:
+            results[i] = dict(name=name, error=e.errors)
+            continue
+        frames[i] = df
+
+    #groups records that can be run together
+    calls = dict()
+    occurrences = dict()
+    for i, df in frames.items():
+        name = df.index[0]
+        columns = tuple(df.columns)
+        occurrences[(columns, name)] = occurrences.get((columns, name), -1) + 1
+        calls.setdefault((columns, occurrences[(columns, name)]), []).append(i)
+
+    for key, members in calls.items():
+        try:
+            out = _call(model_function, pd.concat([frames[i] for i in members]), store)
+            for i in members:
+                results[i] = dict(name=frames[i].index[0], result=result_function(out, frames[i].index[0]))
+        except Exception as e:
+            logger.debug('batch of {} records failed ({!r}), running them one by one'.format(len(members), e))
+            for i in members:
+                try:
+                    out = _call(model_function, frames[i], store)
+                    results[i] = dict(name=frames[i].index[0], result=result_function(out, frames[i].index[0]))
+                except Exception as e:
+                    results[i] = dict(name=frames[i].index[0], error=[repr(e)])
+
+    return results
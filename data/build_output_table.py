@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Builds the output table of the model and its per-group slices.
+
+The table (id, the economy level outputs of compute_resilience and
+group_name) is computed from the baseline packed inputs with the model. It
+does not have every column of the published df2.csv served by
+getOutputData (eg fap, pov_head, total_equivalent_cost), so build_table
+refuses to overwrite a table with columns it does not produce. A manifest
+records the content hash of the inputs of every row and the model
+fingerprint (library source and options), so a rebuild only re-runs the
+rows whose inputs or model changed and reuses the others from the current
+table. Files are written to a temporary file and moved into place, so the
+server never reads a half-written table.
+
+    python build_output_table.py --inputs df_for_wrapper_scp.csv --output model/output_table.csv
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import tempfile
+
+import pandas as pd
+
+from engines import ENGINES, REFERENCE_ENGINE, get_engine
+from packed_schema import parse_csv
+from result_store import code_fingerprint, hash_inputs
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_PATH = 'model/output_table.csv'
+MANIFEST_PATH = 'model/output_table_manifest.json'
+SLICES_DIR = 'model/output_table_slices'
+
+
+def atomic_write(path, text):
+    """writes text to path through a temporary file in the same directory and os.replace"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def model_fingerprint(engine=REFERENCE_ENGINE, **options):
+    """hash of the engine source and the model options: rows are recomputed when it changes"""
+    module = get_engine(engine)
+    source = code_fingerprint(module) if isinstance(ENGINES[engine], str) else repr(module)
+    return hash_inputs(engine, source, **options)
+
+
+def row_hashes(df):
+    """content hash of the inputs of every economy of df"""
+    return {name: hash_inputs(df.loc[[name]]) for name in df.index}
+
+
+def compute_rows(df, engine=REFERENCE_ENGINE, **options):
+    """published rows of the economies of df: id and every economy level output of the model"""
+    model = get_engine(engine)
+    out = model.compute_resilience(*model.unpack_packed_inputs(df), **options)
+    out = out[sorted(out.columns)]
+    if "id" in df:
+        out.insert(0, "id", df["id"])
+    return out
+
+
+def table_columns(path):
+    """columns of the table at path, [] if there is none"""
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def read_manifest(path=MANIFEST_PATH):
+    if not os.path.exists(path):
+        return dict(model=None, rows=dict())
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_table(inputs, output=OUTPUT_PATH, manifest_path=MANIFEST_PATH, slices_dir=SLICES_DIR, engine=REFERENCE_ENGINE, force=False, **options):
+    """(re)builds the published table from the packed inputs csv, re-running only changed rows.
+    Returns the list of recomputed economies"""
+
+    df = parse_csv(inputs)
+    columns = table_columns(output)
+    manifest = read_manifest(manifest_path)
+    fingerprint = model_fingerprint(engine, **options)
+    hashes = row_hashes(df)
+
+    previous = None
+    if os.path.exists(output) and not force and manifest["model"] == fingerprint:
+        previous = pd.read_csv(output, index_col="name", float_precision="round_trip")
+
+    if previous is None:
+        changed = list(df.index)
+    else:
+        changed = [name for name in df.index if manifest["rows"].get(name) != hashes[name] or name not in previous.index]
+
+    #groups are not part of the model inputs: taken from the inputs if present, else kept from the current table
+    current_groups = None
+    if "group_name" in columns:
+        current_groups = pd.read_csv(output, index_col="name", usecols=["name", "group_name"])["group_name"]
+    if "group_name" in df:
+        groups = df["group_name"]
+    elif current_groups is not None:
+        groups = current_groups.reindex(df.index)
+    else:
+        groups = pd.Series(None, index=df.index, dtype=object)
+
+    if changed:
+        logger.info('output table: recomputing {} of {} economies'.format(len(changed), len(df)))
+        rows = compute_rows(df.loc[changed].drop("group_name", axis=1, errors="ignore"), engine, **options)
+    else:
+        rows = None
+
+    if previous is None:
+        table = rows
+    else:
+        kept = previous.loc[[name for name in df.index if name not in changed]].drop("group_name", axis=1, errors="ignore")
+        table = pd.concat([kept, rows]) if rows is not None else kept
+        table = table.reindex(df.index)
+
+    table["group_name"] = groups
+
+    missing = [c for c in columns[1:] if c not in table]
+    if missing:
+        raise ValueError("{} has columns the model does not produce: {}".format(output, ", ".join(missing)))
+
+    #rows that left their group (changed, moved or removed): the slices of their previous groups are rewritten too
+    left = []
+    if current_groups is not None:
+        moved = lambda n: current_groups[n] != groups[n] and not (pd.isnull(current_groups[n]) and pd.isnull(groups[n]))
+        left = [n for n in current_groups.index if n not in df.index or n in changed or moved(n)]
+
+    if changed or left or previous is None or len(previous) != len(table):
+        atomic_write(output, table.to_csv())
+
+        #slices of the groups that changed, removed when the group has no economy left
+        changed_groups = set(groups.loc[changed].dropna())
+        if current_groups is not None:
+            changed_groups |= set(current_groups.loc[left].dropna())
+        for group in sorted(changed_groups):
+            path = os.path.join(slices_dir, "{}.csv".format(group))
+            rows_of_group = table.loc[table["group_name"] == group]
+            if len(rows_of_group):
+                atomic_write(path, rows_of_group.to_csv())
+            elif os.path.exists(path):
+                os.remove(path)
+
+    #manifest last: if the build stops before, the rows are recomputed next time
+    atomic_write(manifest_path, json.dumps(dict(model=fingerprint, rows=hashes), indent=1, sort_keys=True))
+
+    return changed
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Build the published output table from the baseline inputs.")
+    parser.add_argument('--inputs', default='df_for_wrapper_scp.csv', help='baseline packed inputs (with group_name for the slices)')
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    parser.add_argument('--manifest', default=MANIFEST_PATH)
+    parser.add_argument('--slices', default=SLICES_DIR, help='directory of the per-group tables')
+    parser.add_argument('--engine', default=REFERENCE_ENGINE)
+    parser.add_argument('--force', action='store_true', help='recompute every row')
+    args = parser.parse_args()
+
+    changed = build_table(args.inputs, args.output, args.manifest, args.slices, engine=args.engine, force=args.force)
+    print("recomputed {} economies".format(len(changed)))
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Calibration of input columns against observed losses.
+
+Selected packed input columns (eg macro_pi, v_cat_info__poor,
+macro_T_rebuild_K) are fitted, for every economy, so that dK and/or
+risk_to_assets match observed values read from a local csv. The fit is
+Levenberg-Marquardt on relative residuals, over multipliers of the baseline
+values, with forward finite-difference jacobians. The model is used as a
+vectorized objective: each iteration is one batched run holding, for every
+economy not converged yet, the trial point and its perturbations. Economies
+are split across worker processes, and fits can start from the results of a
+previous calibration.
+
+    python calibration.py df_for_wrapper.csv observed_losses.csv model/calibration.csv --columns macro_pi v_cat_info__poor
+"""
+
+import argparse
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from engines import REFERENCE_ENGINE, get_engine
+from packed_schema import parse_csv
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COLUMNS = ["macro_pi", "v_cat_info__poor", "v_cat_info__nonpoor", "macro_T_rebuild_K"]
+
+#outputs that can be calibrated against
+TARGETS = ["dK", "risk_to_assets"]
+
+#multipliers of the baseline values are kept within
+DEFAULT_BOUNDS = (0.1, 10.)
+
+#status of the economies in the results of calibrate
+CONVERGED = "converged"
+MAX_ITER = "max_iter"
+FAILED = "failed"
+
+
+def model_outputs(df, outputs, engine=REFERENCE_ENGINE):
+    """outputs (economy level columns) of the model for the packed inputs df"""
+    model = get_engine(engine)
+    return model.compute_resilience(*model.unpack_packed_inputs(df), outputs=outputs)
+
+
+def fit_economies(df, targets, columns, engine=REFERENCE_ENGINE, start=None, bounds=DEFAULT_BOUNDS, max_iter=30, step=1e-4, tol=1e-8):
+    """fits multipliers of columns for the economies of df to targets (DataFrame per economy with some of TARGETS).
+    start: initial multipliers (array economies x columns), 1 if not given.
+    Returns a DataFrame per economy with the multipliers, the fitted outputs, cost (sum of squared relative residuals), iterations and status"""
+
+    names = df.index
+    n, m = len(df), len(columns)
+    outputs = [c for c in TARGETS if c in targets]
+    base = df[columns].values.astype(float)
+    observed = targets.reindex(names)[outputs].values.astype(float)
+    scale = np.where(np.isfinite(observed) & (observed != 0), np.abs(observed), np.nan)
+
+    def run(idx, p):
+        """relative residuals (lines x targets) and their jacobian (lines x targets x columns) at multipliers p of economies idx"""
+        k = m + 1
+        h = step * p
+        points = np.repeat(p, k, axis=0) + np.tile(np.vstack([np.zeros(m), np.eye(m)]), (len(idx), 1)) * np.repeat(h, k, axis=0)
+
+        batch = df.iloc[np.repeat(idx, k)].copy()
+        for j, col in enumerate(columns):
+            batch[col] = base[np.repeat(idx, k), j] * points[:, j]
+        #unique names, so that all points run in the same call
+        batch.index = pd.Index(["{}#{}".format(names[i], j) for i in idx for j in range(k)], name=df.index.name)
+
+        out = model_outputs(batch, outputs, engine).reindex(batch.index)[outputs].values.astype(float).reshape(len(idx), k, len(outputs))
+        r = (out[:, 0, :] - observed[idx]) / scale[idx]
+        jac = (out[:, 1:, :] - out[:, :1, :]).transpose(0, 2, 1) / h[:, None, :] / scale[idx][:, :, None]
+        #targets not observed do not count
+        missing = np.isnan(scale[idx])
+        r[missing] = 0
+        jac[missing] = 0
+        return out[:, 0, :], r, jac
+
+    p = np.ones((n, m)) if start is None else np.clip(np.where(np.isfinite(start), start, 1.), *bounds)
+    values, r, jac = run(np.arange(n), p)
+    cost = (r ** 2).sum(axis=1)
+    damping = np.full(n, 1e-2)
+    iterations = np.zeros(n, dtype=int)
+    status = np.full(n, MAX_ITER, dtype=object)
+    status[~np.isfinite(cost) | np.isnan(jac).any(axis=(1, 2))] = FAILED
+    status[(status == MAX_ITER) & (cost <= tol)] = CONVERGED
+
+    active = np.flatnonzero(status == MAX_ITER)
+    for it in range(max_iter):
+        if len(active) == 0:
+            break
+        i = active
+
+        jtj = np.einsum("itm,itk->imk", jac[i], jac[i])
+        g = np.einsum("itm,it->im", jac[i], r[i])
+        a = jtj + damping[i][:, None, None] * (np.eye(m) * (np.diagonal(jtj, axis1=1, axis2=2)[:, :, None] + 1e-12))
+        trial = np.clip(p[i] - np.linalg.solve(a, g[:, :, None])[:, :, 0], *bounds)
+
+        values_t, r_t, jac_t = run(i, trial)
+        cost_t = (r_t ** 2).sum(axis=1)
+        iterations[i] += 1
+
+        better = np.isfinite(cost_t) & ~np.isnan(jac_t).any(axis=(1, 2)) & (cost_t < cost[i])
+        gain = cost[i] - np.where(better, cost_t, cost[i])
+
+        accepted = i[better]
+        p[accepted], values[accepted], r[accepted], jac[accepted], cost[accepted] = trial[better], values_t[better], r_t[better], jac_t[better], cost_t[better]
+        damping[accepted] /= 3
+        damping[i[~better]] *= 3
+
+        done = (better & ((gain <= tol * cost[i] + tol) | (cost[i] <= tol))) | (damping[i] > 1e10)
+        status[i[done]] = CONVERGED
+        active = i[~done]
+        logger.debug('calibration: iteration {}, {} economies left'.format(it + 1, len(active)))
+
+    out = pd.DataFrame(base * p, index=names, columns=columns)
+    for j, col in enumerate(outputs):
+        out["fitted_" + col] = values[:, j]
+    out["cost"] = cost
+    out["iterations"] = iterations
+    out["status"] = status
+    return out
+
+
+def _fit(args):
+    return fit_economies(*args[:3], **args[3])
+
+
+def calibrate(df, targets, columns=DEFAULT_COLUMNS, engine=REFERENCE_ENGINE, previous=None, workers=1, **options):
+    """fits columns of df (packed inputs) to targets for every economy of df that has targets.
+    previous: results of an earlier calibration (eg read back from its csv) whose values are used as starting points.
+    Economies are split over workers processes. options are passed to fit_economies"""
+
+    df = df.loc[[n for n in df.index if n in targets.index]]
+    columns = [c for c in columns if c in df]
+
+    start = None
+    if previous is not None:
+        start = (previous.reindex(index=df.index, columns=columns) / df[columns]).values.astype(float)
+
+    if workers <= 1 or len(df) < 2:
+        return fit_economies(df, targets, columns, engine=engine, start=start, **options)
+
+    chunks = np.array_split(np.arange(len(df)), min(workers, len(df)))
+    tasks = [(df.iloc[c], targets, columns, dict(options, engine=engine, start=None if start is None else start[c])) for c in chunks]
+    with multiprocessing.Pool(len(chunks)) as pool:
+        return pd.concat(pool.map(_fit, tasks))
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Calibrate input columns of every economy against observed losses.")
+    parser.add_argument('input', help='packed inputs csv (eg df_for_wrapper.csv)')
+    parser.add_argument('targets', help='csv of observed {} per economy (name column)'.format(" and/or ".join(TARGETS)))
+    parser.add_argument('output', help='csv file to write the fitted values to')
+    parser.add_argument('--columns', nargs='+', default=DEFAULT_COLUMNS, help='packed input columns to fit')
+    parser.add_argument('--warm-start', help='results of a previous calibration to start from')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', default=REFERENCE_ENGINE)
+    parser.add_argument('--max-iter', type=int, default=30)
+    parser.add_argument('--bounds', nargs=2, type=float, default=list(DEFAULT_BOUNDS), help='lowest and highest multipliers of the baseline values')
+    args = parser.parse_args()
+
+    previous = pd.read_csv(args.warm_start, index_col="name") if args.warm_start else None
+    result = calibrate(parse_csv(args.input), pd.read_csv(args.targets, index_col="name"), args.columns, engine=args.engine,
+                       previous=previous, workers=args.workers, max_iter=args.max_iter, bounds=tuple(args.bounds))
+    result.to_csv(args.output)
+    print(result["status"].value_counts().to_string())
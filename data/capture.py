@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+"""Opt-in capture of the requests received by the adapters.
+
+When the RESILIENCE_CAPTURE environment variable is set (to 1 or to the path
+of the log), the adapters record the fields of each request in an
+append-only gzip ndjson log. Records are queued and written by a background
+thread, so the response is not held up by disk I/O; the queue is flushed at
+exit. Each flush appends a gzip member, which gzip readers concatenate, so
+concurrent processes never rewrite each other's records.
+
+The log is read back by replay.py.
+"""
+
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+CAPTURE_PATH = 'model/requests.ndjson.gz'
+
+logger = logging.getLogger(__name__)
+
+#environment variable turning capture on
+CAPTURE_ENV = 'RESILIENCE_CAPTURE'
+
+_STOP = object()
+
+
+class RequestCapture():
+    """Appends request records to a gzip ndjson log from a background thread."""
+
+    def __init__(self, path=CAPTURE_PATH, batch=100):
+        self.path = path
+        self.batch = batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writer, name="request-capture", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, adapter, **fields):
+        """queues the fields of one request to adapter (eg "model_adapter"). Does not wait for the write"""
+        self.queue.put(dict(ts=time.time(), pid=os.getpid(), adapter=adapter, fields=fields))
+
+    def _writer(self):
+        stop = False
+        while not stop:
+            lines = []
+            item = self.queue.get()
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                lines.append(json.dumps(item, default=str))
+                if len(lines) >= self.batch or self.queue.empty():
+                    break
+                item = self.queue.get()
+            if lines:
+                self._append(lines)
+
+    def _append(self, lines):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            #one gzip member per write: a single append of complete lines
+            data = gzip.compress(("\n".join(lines) + "\n").encode())
+            with open(self.path, 'ab') as f:
+                f.write(data)
+        except OSError as e: #capture must never break requests
+            logger.debug('request capture failed: {!r}'.format(e))
+
+    def close(self):
+        """flushes queued records and stops the writer"""
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+
+_capture = None
+_capture_lock = threading.Lock()
+
+
+def capture_from_env():
+    """the process wide RequestCapture if capture is turned on by the environment, None otherwise"""
+    global _capture
+    value = os.environ.get(CAPTURE_ENV)
+    if not value or value == "0":
+        return None
+    with _capture_lock:
+        if _capture is None:
+            _capture = RequestCapture(CAPTURE_PATH if value == "1" else value)
+    return _capture
+
+
+def read_capture(path=CAPTURE_PATH):
+    """yields the records of a capture log, in order"""
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Bounded-memory pipeline for very large packed input tables.
+
+Reads packed inputs (the format of compute_resilience_from_packed_inputs,
+one line per economy) in chunks of economies, runs the engine on each chunk
+and appends the outputs to a csv or hdf5 sink. Economies are independent in
+the model, so the output is identical to a single in-memory run.
+
+    python chunked_pipeline.py subnational.csv outputs.csv --memory-budget 512
+"""
+
+import argparse
+import logging
+import os
+
+import pandas as pd
+
+from engines import REFERENCE_ENGINE, get_engine
+from memory_profile import MemoryProfiler
+
+logger = logging.getLogger(__name__)
+
+#economies used to measure the memory footprint of one economy
+CALIBRATION_ECONOMIES = 8
+
+#share of the memory budget given to model intermediates (the rest covers pandas temporaries and the chunk itself)
+BUDGET_SHARE = 0.5
+
+HDF_KEY = 'packed'
+
+
+def is_hdf(path):
+    return os.path.splitext(path)[1].lower() in ['.h5', '.hdf', '.hdf5']
+
+
+def to_float(obj):
+    try:
+        return obj.astype('float')
+    except ValueError:
+        return obj
+
+
+def read_chunks(path, sizes):
+    """yields chunks of the packed input file at path. sizes is a generator of chunk sizes
+    that is advanced once per chunk, so chunk size can be adapted while reading"""
+
+    if is_hdf(path):
+        start = 0
+        with pd.HDFStore(path, mode='r') as store:
+            nrows = store.get_storer(HDF_KEY).nrows
+        while start < nrows:
+            stop = start + next(sizes)
+            yield pd.read_hdf(path, HDF_KEY, start=start, stop=stop)
+            start = stop
+    else:
+        reader = pd.read_csv(path, index_col='name', iterator=True)
+        while True:
+            try:
+                chunk = reader.get_chunk(next(sizes))
+            except StopIteration:
+                return
+            yield chunk
+
+
+class CsvSink():
+    """appends output chunks to a csv file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = True
+
+    def append(self, df):
+        df.to_csv(self.path, mode='w' if self.header else 'a', header=self.header)
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class HdfSink():
+    """appends output chunks to a table in a hdf5 file (requires pytables)"""
+
+    def __init__(self, path):
+        self.store = pd.HDFStore(path, mode='w')
+
+    def append(self, df):
+        self.store.append(HDF_KEY, df, data_columns=False, min_itemsize={'values': 64})
+
+    def close(self):
+        self.store.close()
+
+
+def bytes_per_economy(engine, chunk, **options):
+    """measures the largest footprint of model intermediates per economy on chunk"""
+    profiler = MemoryProfiler(trace=False).start()
+    out = engine.compute_resilience_from_packed_inputs(chunk, profiler=profiler, **options)
+    profiler.stop()
+    peak = max(sum(s["intermediates"].values()) for s in profiler.stages)
+    return peak / float(len(chunk)), out
+
+
+def run_chunked(input_path, output_path, engine=REFERENCE_ENGINE, memory_budget_mb=512, chunksize=None, **options):
+    """runs engine on the packed inputs at input_path chunk by chunk and writes outputs to output_path.
+    Chunk size is chunksize if given, otherwise derived from memory_budget_mb and the footprint of the first economies.
+    options are passed to compute_resilience. Returns the number of economies processed"""
+
+    engine = get_engine(engine)
+    sink = HdfSink(output_path) if is_hdf(output_path) else CsvSink(output_path)
+
+    state = dict(chunksize=chunksize or CALIBRATION_ECONOMIES)
+
+    def sizes():
+        while True:
+            yield state["chunksize"]
+
+    n = 0
+    try:
+        for chunk in read_chunks(input_path, sizes()):
+            for col in chunk.columns:
+                chunk[col] = to_float(chunk[col])
+
+            if chunksize is None and n == 0:
+                #first chunk calibrates the chunk size to the memory budget
+                per_economy, out = bytes_per_economy(engine, chunk, **options)
+                state["chunksize"] = max(1, int(BUDGET_SHARE * memory_budget_mb * 2**20 / per_economy))
+                logger.debug('{:.0f} bytes per economy, chunks of {} economies'.format(per_economy, state["chunksize"]))
+            else:
+                out = engine.compute_resilience_from_packed_inputs(chunk, **options)
+
+            sink.append(out)
+            n += len(chunk)
+            logger.debug('{} economies processed'.format(n))
+    finally:
+        sink.close()
+
+    return n
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Run the resilience model on a large packed input table in bounded memory.")
+    parser.add_argument('input', help='packed inputs (.csv, or .h5 with a "{}" table)'.format(HDF_KEY))
+    parser.add_argument('output', help='outputs (.csv or .h5)')
+    parser.add_argument('--engine', default=REFERENCE_ENGINE)
+    parser.add_argument('--memory-budget', type=float, default=512, dest='memory_budget_mb', help='peak memory budget in MB')
+    parser.add_argument('--chunksize', type=int, default=None, help='economies per chunk (overrides the memory budget)')
+    args = parser.parse_args()
+
+    run_chunked(args.input, args.output, engine=args.engine, memory_budget_mb=args.memory_budget_mb, chunksize=args.chunksize)
@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""Single-flight coalescing of identical concurrent model runs.
+
+When many users open the same view at once (eg GLOBAL after a release),
+their requests are identical. SingleFlight runs one call per key at a time:
+requests arriving while a call with the same key is in flight wait for it
+and share its result (or its exception) instead of running the model again.
+Counters report how many requests were coalesced.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight():
+    """Runs at most one call per key at a time and shares its outcome with the callers that arrive meanwhile.
+    Results are shared, not copied: they should be immutable (eg response strings)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+        self._counts = collections.Counter()
+
+    def do(self, key, function, *args, **kwargs):
+        """function(*args, **kwargs), or the outcome of the call with the same key in flight"""
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+            self._counts["requests"] += 1
+            self._counts["coalesced"] += not leader
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self._counts["executed"] += 1
+                self._counts["errors"] += call.error is not None
+                self._counts["max_waiters"] = max(self._counts["max_waiters"], call.waiters)
+            call.done.set()
+        return call.result
+
+    def metrics(self):
+        """requests, executed calls, coalesced requests, errors, largest number of requests sharing a call and calls in flight"""
+        with self._lock:
+            out = {k: self._counts[k] for k in ["requests", "executed", "coalesced", "errors", "max_waiters"]}
+            out["in_flight"] = len(self._calls)
+        return out
+
+
+def _normalize(value):
+    #json values (eg a country record) are compared by content, not by formatting or key order
+    if isinstance(value, str):
+        try:
+            return json.dumps(json.loads(value), sort_keys=True)
+        except ValueError:
+            return value
+    return value
+
+
+def request_key(adapter, fields):
+    """key of a request to adapter with form fields: equal for requests the adapter answers identically"""
+    items = sorted((k, _normalize(v)) for k, v in fields.items() if v is not None)
+    return hashlib.sha1(json.dumps([adapter, items], default=str).encode()).hexdigest()
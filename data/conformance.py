@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Differential conformance harness between model engines.
+
+Runs a candidate engine and a reference engine on the same packed inputs for
+every combination of PDS, targeting, budget and financing options, and
+reports the maximum error of every output column. The stress check runs an
+engine and the adapters from a thread pool and checks that results under
+concurrent load are the same as serial ones.
+
+    python conformance.py --candidate pandas_big
+    python conformance.py --stress 8
+"""
+
+import argparse
+import itertools
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import model_adapter
+from engines import REFERENCE_ENGINE, get_engine
+from packed_schema import SHARE_COLUMNS
+
+#all values of the options of compute_resilience exercised by the harness
+OPTIONS = {
+    "optionT": ["perfect", "data", "x33", "incl", "excl"],
+    "optionPDS": ["no", "unif_all", "unif_poor", "prop", "one", "hundred", "perfect", "prop_nonpoor"],
+    "optionB": ["data", "unif_poor", "one_per_affected", "one", "x10", "x05", "max01", "max05", "unlimited"],
+    "optionFee": ["tax", "insurance_premium"],
+}
+
+DEFAULT_INPUTS = ["df_for_wrapper.csv", "df_for_wrapper_scp.csv"]
+
+#packed columns that are left untouched when generating inputs
+#(protection determines the rp grid, n the definition of the poor)
+FIXED_COLUMNS = ["macro_protection", "n_cat_info", "risk", "resilience", "risk_to_assets"]
+
+
+def option_grid(**options):
+    """list of option dicts: every combination of OPTIONS, with keyword arguments overriding the values to use"""
+    values = dict(OPTIONS, **options)
+    keys = sorted(values)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*[values[k] for k in keys])]
+
+
+def generate_inputs(df, n=20, scale=0.2, seed=0):
+    """n random economies obtained by perturbing the numeric inputs of rows of df by up to +/- scale"""
+
+    rng = np.random.RandomState(seed)
+
+    out = df.iloc[rng.randint(len(df), size=n)].copy()
+    out.index = pd.Index(["generated_{:03d}".format(i) for i in range(n)], name=df.index.name)
+
+    for col in out:
+        if any(col.startswith(c) for c in FIXED_COLUMNS) or out[col].dtype.kind != "f":
+            continue
+        out[col] *= rng.uniform(1 - scale, 1 + scale, size=n)
+        if any(col.startswith(c) for c in SHARE_COLUMNS):
+            out[col] = out[col].clip(0, 1)
+
+    return out
+
+
+def max_errors(ref, cand, atol=1e-9):
+    """per-column maximum absolute and relative error between two output frames"""
+
+    cols = [c for c in ref if c in cand and ref[c].dtype.kind in "fiu" and cand[c].dtype.kind in "fiu"]
+    r = ref[cols].astype(float)
+    c = cand[cols].reindex(r.index).astype(float)
+
+    abs_err = (c - r).abs()
+    #nans in the same place are not errors, nans in only one are
+    both_nan = r.isnull() & c.isnull()
+    abs_err[both_nan] = 0
+    abs_err[r.isnull() ^ c.isnull()] = np.inf
+    rel_err = abs_err / (r.abs() + atol)
+
+    return pd.DataFrame({"max_abs_err": abs_err.max(), "max_rel_err": rel_err.max()})
+
+
+def run_engine(engine, df, options):
+    macro, cat_info, hazard_ratios = engine.unpack_packed_inputs(df)
+    return engine.compute_resilience(macro, cat_info, hazard_ratios, **options)
+
+
+def compare_engines(reference, candidate, df, options_list):
+    """runs both engines on df for every dict of options in options_list.
+    Returns per-column max errors indexed by options and column (and the error message of failed runs)"""
+
+    ref_engine = get_engine(reference)
+    cand_engine = get_engine(candidate)
+
+    out = {}
+    for options in options_list:
+        key = tuple(options[k] for k in sorted(options))
+        try:
+            ref = run_engine(ref_engine, df, options)
+            cand = run_engine(cand_engine, df, options)
+            res = max_errors(ref, cand)
+            res["error"] = ""
+        except Exception as e:
+            res = pd.DataFrame({"max_abs_err": [np.nan], "max_rel_err": [np.nan], "error": [repr(e)]}, index=["*"])
+        out[key] = res
+
+    return pd.concat(out, names=sorted(options_list[0]) + ["column"])
+
+
+def run_harness(reference=REFERENCE_ENGINE, candidate="pandas_big", inputs=DEFAULT_INPUTS, n_generated=20, seed=0, options_list=None):
+    """compares candidate to reference on every input file and on generated inputs"""
+
+    if options_list is None:
+        options_list = option_grid()
+
+    frames = {path: pd.read_csv(path, index_col="name") for path in inputs}
+    if n_generated:
+        frames["generated"] = generate_inputs(frames[inputs[0]], n=n_generated, seed=seed)
+
+    report = pd.concat({name: compare_engines(reference, candidate, df, options_list) for name, df in frames.items()},
+                       names=["input"])
+    return report
+
+
+def run_concurrently(jobs, threads=8, repeat=4):
+    """runs every job (function without arguments) once serially, then all of them repeat times from threads threads.
+    Returns the serial results and a list of (job position, concurrent result)"""
+
+    serial = [job() for job in jobs]
+    order = list(range(len(jobs))) * repeat
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        concurrent = list(pool.map(lambda i: jobs[i](), order))
+    return serial, list(zip(order, concurrent))
+
+
+def stress_check(engine=REFERENCE_ENGINE, df=None, options_list=None, groups=None, threads=8, repeat=4):
+    """runs engine on df for every dict of options, and model_adapter requests for groups (group_name of df_for_wrapper.csv,
+    default GLOBAL), serially then concurrently (see run_concurrently).
+    Returns the max error of every concurrent run against its serial run (0 if execution is reentrant)"""
+
+    if df is None:
+        df = pd.read_csv(DEFAULT_INPUTS[0], index_col="name")
+    if options_list is None:
+        options_list = option_grid(optionT=["data"], optionB=["data"])
+    if groups is None:
+        groups = ["GLOBAL"]
+
+    model = get_engine(engine)
+    jobs = [lambda o=o: run_engine(model, df, o) for o in options_list]
+    model_function = "{}.compute_resilience_from_packed_inputs".format(model.__name__)
+    jobs += [lambda g=g: model_adapter.handle_request(dict(m=model_function, g=g)) for g in groups]
+    labels = [repr(o) for o in options_list] + ["model_adapter g={}".format(g) for g in groups]
+
+    serial, concurrent = run_concurrently(jobs, threads=threads, repeat=repeat)
+
+    rows = []
+    for i, result in concurrent:
+        if isinstance(result, str):
+            err = 0. if result == serial[i] else np.inf
+        else:
+            err = max_errors(serial[i], result)["max_abs_err"].max()
+        rows.append(dict(job=labels[i], max_abs_err=err))
+    return pd.DataFrame(rows).groupby("job")["max_abs_err"].max().to_frame()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare a model engine to the reference engine.")
+    parser.add_argument('--reference', default=REFERENCE_ENGINE)
+    parser.add_argument('--candidate')
+    parser.add_argument('--stress', type=int, metavar='THREADS', help='check the reference (or candidate) engine and the adapters under concurrent load instead')
+    parser.add_argument('--repeat', type=int, default=4, help='number of concurrent runs of every stress job')
+    parser.add_argument('--inputs', nargs='*', default=DEFAULT_INPUTS)
+    parser.add_argument('--generated', type=int, default=20, help='number of generated economies')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rtol', type=float, default=1e-6, help='tolerance on the relative error')
+    parser.add_argument('--output', default=None, help='csv file to write the full report to')
+    args = parser.parse_args()
+
+    if args.stress:
+        report = stress_check(args.candidate or args.reference, pd.read_csv(args.inputs[0], index_col="name"), threads=args.stress, repeat=args.repeat)
+        print(report.to_string())
+        if (report["max_abs_err"] != 0).any():
+            print("\nresults differ under concurrent load")
+            sys.exit(1)
+        sys.exit(0)
+    if args.candidate is None:
+        parser.error("--candidate is required without --stress")
+
+    report = run_harness(args.reference, args.candidate, args.inputs, args.generated, args.seed)
+    if args.output:
+        report.to_csv(args.output)
+
+    #worst error of each column over all inputs and options
+    print(report.groupby(level="column")[["max_abs_err", "max_rel_err"]].max().to_string())
+
+    failed = report[report["error"] != ""]
+    if not failed.empty:
+        print("\n{} runs failed".format(len(failed)))
+        print(failed["error"].to_string())
+
+    exceeded = report["max_rel_err"] > args.rtol
+    if exceeded.any() or not failed.empty:
+        print("\n{} columns exceed tolerance {}".format(exceeded.sum(), args.rtol))
+        sys.exit(1)
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+"""Requests expressed as a baseline row plus overridden fields.
+
+Instead of a full country record, the viewer can send the name of a row of
+the baseline table (df_for_wrapper.csv) and only the fields it changed. The
+baseline table is parsed once per process. With the pandas engines, the run
+goes through the shared StagedModel with the changed columns as a hint: the
+baseline of the row is computed (once) and the stages the overrides do not
+invalidate are taken from it.
+
+    model_adapter.py?m=res_ind_lib.compute_resilience_from_packed_inputs&b=Malawi&d={"macro_T_rebuild_K": 2}
+"""
+
+import importlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from packed_schema import SchemaError, column_kind, parse_csv
+from stages import shared_model
+
+BASELINE_PATH = 'df_for_wrapper.csv'
+
+#path -> (modification time, parsed table)
+_baselines = dict()
+_baselines_lock = threading.Lock()
+
+
+def load_baseline(path=BASELINE_PATH):
+    """parsed baseline table, re-read when the file changes. Returns (version, table)"""
+    mtime = os.path.getmtime(path)
+    with _baselines_lock:
+        cached = _baselines.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _baselines[path] = (mtime, parse_csv(path))
+    return cached
+
+
+def apply_overrides(baseline, name, overrides):
+    """the row name of baseline with the values of overrides (dict column -> value).
+    Returns the row (one line DataFrame) and the list of columns whose value changed"""
+
+    errors = []
+    if name not in baseline.index:
+        errors.append("unknown baseline row: {}".format(name))
+    unknown = [c for c in overrides if column_kind(c) != "numeric" or c not in baseline]
+    if unknown:
+        errors.append("columns that cannot be overridden: " + ", ".join(map(str, unknown)))
+    if errors:
+        raise SchemaError(errors)
+
+    row = baseline.loc[[name]].copy()
+    changed = []
+    for col, value in overrides.items():
+        try:
+            value = np.nan if value is None else float(value)
+        except (TypeError, ValueError):
+            errors.append("{}: not a number: {!r}".format(col, value))
+            continue
+        current = row[col].iloc[0]
+        if value == current or (np.isnan(value) and np.isnan(current)):
+            continue
+        row[col] = value
+        changed.append(col)
+    if errors:
+        raise SchemaError(errors)
+
+    return row, changed
+
+
+def run_delta(name, overrides, model_function, path=BASELINE_PATH):
+    """outputs of model_function (a compute_resilience_from_packed_inputs) for the baseline row name with overrides
+    (dict, or json object text)"""
+
+    if isinstance(overrides, str):
+        try:
+            overrides = json.loads(overrides) if overrides.strip() else dict()
+        except ValueError as e:
+            raise SchemaError(["overrides: invalid json: {}".format(e)])
+    if not isinstance(overrides, dict):
+        raise SchemaError(["overrides: not a json object"])
+    version, baseline = load_baseline(path)
+    row, changed = apply_overrides(baseline, name, overrides)
+
+    #only the pandas libraries are expressed as stages
+    module = importlib.import_module(model_function.__module__)
+    if model_function.__name__ != "compute_resilience_from_packed_inputs" or not hasattr(module, "clean_inputs"):
+        return model_function(row)
+
+    model = shared_model(module)
+    reference = (os.path.abspath(path), version, name)
+    if not model.knows(reference):
+        model.compute_resilience_from_packed_inputs(baseline.loc[[name]], reference=reference)
+    return model.compute_resilience_from_packed_inputs(row, reference=reference, changed=changed)
@@ -0,0 +1,62 @@
+# -*- coding: UTF-8 -*-
+"""Registry of interchangeable implementations of the resilience model.
+
+An engine is any object (usually a module) exposing
+    unpack_packed_inputs(df) -> macro, cat_info, hazard_ratios
+    compute_resilience(macro, cat_info, hazard_ratios, **options) -> macro
+    compute_resilience_from_packed_inputs(df, **options) -> df
+    compute_resilience_from_adjusted_inputs_for_pol(df, macro, cat_info, hazard_ratios, optionPDS, optionFee, **options) -> df
+The adapters select engines by name, and conformance.py checks that every
+engine reproduces the reference pandas code.
+"""
+
+import importlib
+
+#name -> module name (imported on first use) or engine object
+ENGINES = {
+    "pandas": "res_ind_lib",
+    "pandas_big": "res_ind_lib_big",
+    "numpy": "resilience_engine",
+}
+
+#engine everything else is compared to
+REFERENCE_ENGINE = "pandas"
+
+#functions every engine must provide
+ENGINE_FUNCTIONS = ["unpack_packed_inputs", "compute_resilience", "compute_resilience_from_packed_inputs", "compute_resilience_from_adjusted_inputs_for_pol"]
+
+
+def register_engine(name, engine):
+    """registers engine (module name or object) under name"""
+    ENGINES[name] = engine
+
+
+def available_engines():
+    return sorted(ENGINES)
+
+
+def get_engine(name=None):
+    """returns the engine registered under name (the reference engine if None)"""
+
+    if name is None:
+        name = REFERENCE_ENGINE
+
+    if name not in ENGINES:
+        raise KeyError("unknown engine {}. Available engines are: {}".format(name, ", ".join(available_engines())))
+
+    engine = ENGINES[name]
+    if isinstance(engine, str):
+        engine = importlib.import_module(engine)
+
+    missing = [f for f in ENGINE_FUNCTIONS if not hasattr(engine, f)]
+    if missing:
+        raise TypeError("engine {} does not provide {}".format(name, ", ".join(missing)))
+
+    return engine
+
+
+def get_engine_function(name, function):
+    """returns function (one of ENGINE_FUNCTIONS) of the engine registered under name"""
+    if function not in ENGINE_FUNCTIONS:
+        raise KeyError("engines do not provide {}. Engine functions are: {}".format(function, ", ".join(ENGINE_FUNCTIONS)))
+    return getattr(get_engine(name), function)
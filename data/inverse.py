@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Inverse problems: multiplier of an input needed to bring an output to a target.
+
+For example, the factor on the vulnerability of households that brings the
+risk of every country of a group to 1% of GDP. All economies are solved
+together with a bracketing root finder (regula falsi, Illinois variant,
+falling back to bisection): each iteration is one batched model run on the
+economies that have not converged yet.
+
+    python inverse.py df_for_wrapper_scp.csv --columns v --output risk --target 0.01 --group "Sub-Saharan Africa"
+"""
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from engines import REFERENCE_ENGINE, get_engine
+from packed_schema import parse_csv
+from response_surface import SLIDERS
+
+logger = logging.getLogger(__name__)
+
+#status of the economies in the results of solve
+CONVERGED = "converged"
+NO_BRACKET = "no_bracket"
+MAX_ITER = "max_iter"
+FAILED = "failed"
+
+
+def scale_columns(df, columns, multipliers):
+    """df with columns multiplied by multipliers (one per line)"""
+    out = df.copy()
+    for col in columns:
+        if col in out:
+            out[col] = out[col] * multipliers
+    return out
+
+
+def solve(df, columns, target, output="risk", bracket=(0., 1.), engine=REFERENCE_ENGINE, xtol=1e-4, rtol=1e-4, max_iter=50):
+    """multiplier of columns (packed columns, or the name of a slider of response_surface.SLIDERS) that brings output
+    to target (a number, or a Series per economy) for every economy of df, searched within bracket.
+    Returns a DataFrame per economy with multiplier, value (of output at multiplier), target,
+    iterations (batched runs after the evaluation of the bracket) and status (converged, no_bracket, max_iter or failed)"""
+
+    if isinstance(columns, str):
+        columns = SLIDERS.get(columns, [columns])
+    model_function = get_engine(engine).compute_resilience_from_packed_inputs
+
+    names = df.index
+    n = len(df)
+    if np.isscalar(target):
+        t = np.full(n, float(target))
+    else:
+        t = target.reindex(names).values.astype(float)
+    ftol = rtol * np.abs(t)
+
+    def evaluate(idx, x):
+        """output - target for the economies at positions idx and multipliers x, in one model run"""
+        batch = scale_columns(df.iloc[idx], columns, x)
+        #unique names, an economy can appear twice
+        batch.index = pd.Index(["{}#{}".format(names[i], k) for k, i in enumerate(idx)], name=df.index.name)
+        return model_function(batch)[output].reindex(batch.index).values.astype(float) - t[idx]
+
+    a = np.full(n, float(bracket[0]))
+    b = np.full(n, float(bracket[1]))
+    f = evaluate(np.concatenate([np.arange(n), np.arange(n)]), np.concatenate([a, b]))
+    fa, fb = f[:n], f[n:]
+
+    x = np.full(n, np.nan)
+    fx = np.full(n, np.nan)
+    iterations = np.zeros(n, dtype=int)
+    status = np.full(n, MAX_ITER, dtype=object)
+
+    status[np.isnan(fa) | np.isnan(fb)] = FAILED
+    for end, f_end in [(b, fb), (a, fa)]:
+        hit = (status != FAILED) & (np.abs(f_end) <= ftol)
+        x[hit], fx[hit], status[hit] = end[hit], f_end[hit], CONVERGED
+    status[(status == MAX_ITER) & (np.sign(fa) == np.sign(fb))] = NO_BRACKET
+
+    #end replaced by the last iteration (-1: a, 1: b), to halve the value at the other end when the same end is replaced twice
+    side = np.zeros(n, dtype=int)
+
+    active = np.flatnonzero(status == MAX_ITER)
+    for it in range(max_iter):
+        if len(active) == 0:
+            break
+        i = active
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xi = (a[i] * fb[i] - b[i] * fa[i]) / (fb[i] - fa[i])
+        bisect = ~np.isfinite(xi) | (xi <= np.minimum(a[i], b[i])) | (xi >= np.maximum(a[i], b[i]))
+        xi = np.where(bisect, (a[i] + b[i]) / 2, xi)
+
+        fi = evaluate(i, xi)
+        iterations[i] += 1
+        x[i], fx[i] = xi, fi
+
+        failed = np.isnan(fi)
+        status[i[failed]] = FAILED
+
+        replace_a = np.sign(fi) == np.sign(fa[i])
+        ia, ib = i[replace_a & ~failed], i[~replace_a & ~failed]
+        fb[ia] = np.where(side[ia] == -1, fb[ia] / 2, fb[ia])
+        a[ia], fa[ia], side[ia] = x[ia], fx[ia], -1
+        fa[ib] = np.where(side[ib] == 1, fa[ib] / 2, fa[ib])
+        b[ib], fb[ib], side[ib] = x[ib], fx[ib], 1
+
+        done = ~failed & ((np.abs(fi) <= ftol[i]) | (np.abs(b[i] - a[i]) <= xtol))
+        status[i[done]] = CONVERGED
+        active = i[~done & ~failed]
+        logger.debug('inverse: iteration {}, {} economies left'.format(it + 1, len(active)))
+
+    return pd.DataFrame(dict(multiplier=x, value=fx + t, target=t, iterations=iterations, status=status), index=names,
+                        columns=["multiplier", "value", "target", "iterations", "status"])
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Find, for every economy, the multiplier of an input that brings an output to a target.")
+    parser.add_argument('input', help='packed inputs csv (eg df_for_wrapper.csv)')
+    parser.add_argument('--columns', nargs='+', required=True, help='slider name ({}) or packed columns to scale'.format(", ".join(SLIDERS)))
+    parser.add_argument('--output', default='risk', help='model output to bring to the target')
+    parser.add_argument('--target', type=float, required=True)
+    parser.add_argument('--bracket', nargs=2, type=float, default=[0., 1.], help='lowest and highest multipliers')
+    parser.add_argument('--group', help='only economies of this group_name (the input needs a group_name column, eg df_for_wrapper_scp.csv)')
+    parser.add_argument('--engine', default=REFERENCE_ENGINE)
+    parser.add_argument('--xtol', type=float, default=1e-4)
+    parser.add_argument('--rtol', type=float, default=1e-4)
+    parser.add_argument('--max-iter', type=int, default=50)
+    args = parser.parse_args()
+
+    df = parse_csv(args.input)
+    if args.group is not None:
+        if 'group_name' not in df:
+            parser.error('{} has no group_name column: --group needs an input with groups, eg df_for_wrapper_scp.csv'.format(args.input))
+        df = df.loc[df['group_name'] == args.group]
+
+    columns = args.columns[0] if len(args.columns) == 1 else args.columns
+    result = solve(df, columns, args.target, output=args.output, bracket=args.bracket, engine=args.engine,
+                   xtol=args.xtol, rtol=args.rtol, max_iter=args.max_iter)
+    print(result.to_csv())
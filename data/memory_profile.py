@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""Opt-in memory instrumentation of model runs.
+
+Pass a MemoryProfiler as profiler= to compute_resilience (or to the packed
+input wrappers) to record, at each stage, the process peak RSS, the byte size
+of the main intermediates and the top tracemalloc allocators of the stage.
+"""
+
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError: #not available on windows
+    resource = None
+
+#default report location, next to model/model.log
+REPORT_PATH = 'model/model_memory.ndjson'
+
+
+def peak_rss_kb():
+    """peak resident set size of the process in kB (None if unknown)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss_kb():
+    """current resident set size of the process in kB (None if unknown)"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def nbytes(obj):
+    """deep size in bytes of a pandas object or numpy array"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True, index=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True, index=True))
+    return int(getattr(obj, "nbytes", 0))
+
+
+class MemoryProfiler():
+    """Records memory use at each stage of a model run."""
+
+    def __init__(self, top=10, trace=True):
+        self.top = top
+        self.trace = trace
+        self.stages = []
+        self._snapshot = None
+        self._started_tracing = False
+        self._t0 = None
+
+    def start(self):
+        self._t0 = time.time()
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._snapshot = tracemalloc.take_snapshot()
+        return self
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self._snapshot = None
+
+    def reset(self):
+        """forgets recorded stages, eg between the runs of several policies"""
+        self.stages = []
+        if self.trace and tracemalloc.is_tracing():
+            self._snapshot = tracemalloc.take_snapshot()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stage(self, name, **intermediates):
+        """records memory at the end of stage name. intermediates are the frames alive at that point"""
+
+        if self._t0 is None:
+            self.start()
+
+        record = dict(
+            stage=name,
+            elapsed=time.time() - self._t0,
+            peak_rss_kb=peak_rss_kb(),
+            rss_kb=current_rss_kb(),
+            intermediates={k: nbytes(v) for k, v in intermediates.items() if v is not None},
+        )
+
+        if self.trace and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            record["traced_kb"] = current // 1024
+            record["traced_peak_kb"] = peak // 1024
+            #top allocators since previous stage
+            stats = snapshot.compare_to(self._snapshot, "lineno")[:self.top]
+            record["top_allocators"] = [
+                dict(where="{}:{}".format(s.traceback[0].filename, s.traceback[0].lineno), size_diff_kb=s.size_diff // 1024, count_diff=s.count_diff)
+                for s in stats]
+            self._snapshot = snapshot
+            if hasattr(tracemalloc, "reset_peak"): #python>=3.9, so peaks are per stage
+                tracemalloc.reset_peak()
+
+        logger.debug('memory at {}: peak rss {} kB, {}'.format(name, record["peak_rss_kb"], record["intermediates"]))
+        self.stages.append(record)
+
+    def report(self):
+        return dict(stages=self.stages, peak_rss_kb=peak_rss_kb())
+
+    def to_frame(self):
+        """one line per stage and intermediate, with sizes in bytes"""
+        return pd.DataFrame([dict(stage=s["stage"], intermediate=k, nbytes=v, peak_rss_kb=s["peak_rss_kb"])
+                             for s in self.stages for k, v in s["intermediates"].items()])
+
+    def write(self, path=REPORT_PATH, **extra):
+        """appends the report as one json line to path"""
+        report = dict(self.report(), time=time.strftime('%Y-%m-%d %H:%M:%S'), **extra)
+        with open(path, 'a') as f:
+            f.write(json.dumps(report) + "\n")
+        return report
@@ -2,13 +2,6 @@
 # -*- coding: UTF-8 -*-
 """Wrapper for running Socio-economic resilience indicator model."""
 
-# enable debugging
-import cgitb
-cgitb.enable()
-
-print ("Content-Type: text/html;charset=utf-8")
-print()
-
 import cgi
 import argparse
 import importlib
@@ -21,6 +14,14 @@ import time
 
 import pandas as pd
 
+from batch_records import is_batch, parse_batch, run_batch
+from capture import capture_from_env
+from delta_requests import run_delta
+from engines import get_engine_function
+from memory_profile import MemoryProfiler
+from packed_schema import SchemaError, coerce_frame, parse_csv, parse_json
+from result_store import ResultStore
+
 PACKAGE_PARENT = '..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(
     os.path.join(os.getcwd(), os.path.expanduser(__file__))))
@@ -28,88 +29,139 @@ sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
 #import res_ind_lib
 
-logging.basicConfig(
-    filename='model/model.log', level=logging.DEBUG,
-    format='%(asctime)s: %(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+#form fields of a request
+FIELDS = ['d', 'm', 'g', 'e', 'b', 'mem']
 
 
 class Model():
     """Runs the resilience model."""
 
-    def __init__(self, df=None, model_function=None, group=None,debug=False):
+    def __init__(self, df=None, model_function=None, group=None,debug=False,store=None):
         if group == None: # country data is sent
             if df == None: # no country data
                 return
             else: #load dataframe with country data sent
-                d = json.loads(data_frame)
-                df = pd.DataFrame.from_records([d], index='name')
+                df = parse_json(df)
         else: #when group data is sent
             #df_all = pd.read_csv("df2.csv")
-            df_all = pd.read_csv("df_for_wrapper.csv")
+            df_all = parse_csv("df_for_wrapper.csv", index_col=None)
             #print df_all
             if group == 'GLOBAL':
                 df = df_all
             else:
                 df = df_all.loc[df_all['group_name'] == group]
 
-        for col in df.columns:
-            df[col] = self.to_float(df[col])
-        self.df = df
-        logging.debug(self.df)
-        with open('model_inputs.csv', 'w') as f:
-            f.write(self.df.to_csv())
+        self.df = coerce_frame(df)
+        logger.debug(self.df)
 
         self.model_function = model_function
         self.debug = debug
+        self.store = store
+
+    def run(self, profiler=None):
+        if profiler is not None: #profiling runs the model instead of reading stored results
+            output = self.model_function(self.df, profiler=profiler)
+        elif self.store is not None:
+            output = self.store.call(self.model_function, self.df)
+        else:
+            output = self.model_function(self.df)
+        logger.debug(output)
+        return output
+
 
-    def to_float(self, obj):
+def handle_request(fields, store=None, profiler=None):
+    """response (json string) to a request with the form fields of the adapter (FIELDS: d is a country record, a batch of
+    records, or the fields overridden in the baseline row b).
+    Uses no process wide state: requests can be handled concurrently by threads.
+    profiler: optional MemoryProfiler (not started) reporting the memory use of the run"""
+
+    data_frame = fields.get('d')
+    mf = fields.get('m')
+    group = fields.get('g')
+    engine = fields.get('e')
+    f = mf.split('.')[1]
+    if engine is not None: #select the implementation of the model by engine name
+        try:
+            model_function = get_engine_function(engine, f)
+        except (KeyError, TypeError) as e: #unknown engine or function
+            return json.dumps({"errors": [e.args[0]]})
+    else:
+        module = importlib.import_module(mf.split('.')[0])
+        model_function = getattr(module, f)
+
+    #baseline row b of df_for_wrapper.csv with the fields of d (json object) overridden
+    if group is None and fields.get('b') is not None:
         try:
-            return obj.astype('float')
-        except ValueError:
-            return obj
+            output = run_delta(fields['b'], data_frame or "{}", model_function)
+        except SchemaError as e:
+            return json.dumps({"errors": e.errors})
+        return output.to_json()
+
+    #batch of country records (json array or ndjson): one vectorized run, one result or error per record
+    if group is None and data_frame is not None and is_batch(data_frame):
+        startTime = time.time()
+        results = run_batch(parse_batch(data_frame), model_function, store=store)
+        logger.debug('Running model on {} records took: {}'.format(len(results), time.time() - startTime))
+        return json.dumps({"data": results})
+
+    try:
+        model = Model(df=data_frame, model_function=model_function, group=group, debug=True, store=store)
+    except SchemaError as e: #reports all invalid inputs at once
+        return json.dumps({"errors": e.errors})
+
+    #slider requests answered from the precomputed response surface when its error bound allows (see response_surface.py)
+    surface_path = os.environ.get('RESILIENCE_RESPONSE_SURFACE')
+    if surface_path and os.path.exists(surface_path) and group is None and data_frame is not None and profiler is None:
+        from response_surface import load_surface #scipy is only needed when a surface is used
+        surface = load_surface(surface_path)
+        if surface.serves(model_function):
+            output = surface.evaluate_frame(model.df)
+            if output is not None:
+                return output.to_json()
+
+    if profiler is not None:
+        profiler.start()
 
-    def run(self):
-        output = self.model_function(self.df)
-        logging.debug(output)
-        return output
+    startTime = time.time()
+    output = model.run(profiler=profiler)
+    elapsed = time.time() - startTime
+    logger.debug('Running model took: {}'.format(elapsed))
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.write(model_function=mf, group=group, elapsed=elapsed)
+    return output.to_json()
 
 if __name__ == '__main__':
-    
-    #parser = argparse.ArgumentParser(
-    #    description="Run the Socio-economic Resilience Model.")
-    #parser.add_argument('-d', '--data-frame', required=True,
-    #                    dest="data_frame", help="The input data frame")
-    #parser.add_argument('-m', '--model-function', required=True,
-    #                    dest='model_function', help='The model function to run'
-    #                    )
-    #args = parser.parse_args()
+
+    # enable debugging
+    import cgitb
+    cgitb.enable()
+
+    print ("Content-Type: text/html;charset=utf-8")
+    print()
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
     PACKAGE_PARENT = '..'
     SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
     sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
-    config = {}
     form = cgi.FieldStorage()
-    config['data_frame'] = form.getvalue('d')
-    config['model_function'] = form.getvalue('m')
-    group = form.getvalue('g')
-    data_frame = config.get('data_frame')
-    mf = config.get('model_function')
-    m = mf.split('.')[0]
-    f = mf.split('.')[1]
-    #module = importlib.import_module('data.' + m) #sesha changing
-    #print sys.path
-    module = importlib.import_module(m)
-    model_function = getattr(module, f)
-    #model_function = mf
-    debug = True
-    if config.get('debug'):
-        debug = True
-
-    model = Model(
-        df=data_frame, model_function=model_function, group=group,debug=debug
-    )
-    startTime = time.time()
-    output = model.run()
-    elapsed = time.time() - startTime
-    logging.debug('Running model took: {}'.format(elapsed))
-    print(output.to_json())
\ No newline at end of file
+    fields = {k: form.getvalue(k) for k in FIELDS}
+
+    #opt-in capture of the request, written in the background
+    capture = capture_from_env()
+    if capture is not None:
+        capture.record("model_adapter", d=fields['d'], m=fields['m'], g=fields['g'], e=fields['e'], b=fields['b'])
+
+    #opt-in memory instrumentation, reported next to model.log
+    profiler = None
+    if fields['mem'] or os.environ.get('RESILIENCE_MEMORY_PROFILE'):
+        profiler = MemoryProfiler()
+
+    print(handle_request(fields, store=ResultStore(), profiler=profiler))
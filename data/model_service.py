@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Long-lived http service running the adapters in-process.
+
+Answers the requests of model_adapter.py and model_scorecard_adapter.py
+(same urls, form fields and responses as the cgi scripts) from a thread per
+request, so the libraries and the result store are loaded once instead of
+once per request. The adapters' handle_request does not use shared files or
+globals, and the heavy numpy kernels release the GIL. Identical concurrent
+requests are coalesced into one model run (see coalesce.py); /metrics
+reports the counters.
+
+At start-up, a background thread precomputes into the result store the
+GLOBAL view (and the group views when the baseline table has groups) and
+the default scorecard. It only starts a request
+when no live request is running; /ready answers 503 until it is done.
+
+    python model_service.py --port 8080
+    python replay.py model/requests.ndjson.gz --url http://localhost:8080/cgi-bin/ --concurrency 8
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import model_adapter
+import model_scorecard_adapter
+from capture import capture_from_env
+from coalesce import SingleFlight, request_key
+from delta_requests import BASELINE_PATH
+from packed_schema import SchemaError, parse_csv
+from result_store import STORE_PATH, ResultStore
+from scorecard_policies import DEFAULT_POLICIES
+
+logger = logging.getLogger(__name__)
+
+#adapter script name -> request handler (form fields -> response)
+ADAPTERS = {
+    "model_adapter": model_adapter.handle_request,
+    "model_scorecard_adapter": model_scorecard_adapter.handle_request,
+}
+
+#model functions of the views precomputed at start-up
+WARMUP_MODEL_FUNCTION = "res_ind_lib.compute_resilience_from_packed_inputs"
+WARMUP_POLICY_FUNCTION = "res_ind_lib_big.compute_resilience_from_adjusted_inputs_for_pol"
+
+#inputs of the precomputed scorecard (its outputs include id and group_name) and the other fields sent by the viewer
+SCORECARD_INPUTS = 'df_for_wrapper_scp.csv'
+SCORECARD_FIELDS = dict(p_col_impacted="v_cat_info__poor", pol_str="_pcinc_p_110", social_col="gamma_SP_cat_info__poor")
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    """Runs the adapter named by the last part of the path (eg /cgi-bin/model_adapter.py) on the form fields of the request"""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip("/").endswith("/metrics"):
+            self._send(json.dumps(dict(coalescing=self.server.flight.metrics(), warmup=self.server.warmup_status())).encode(), "application/json")
+            return
+        if url.path.rstrip("/").endswith("/ready"):
+            ready = self.server.ready.is_set()
+            self._send(json.dumps(dict(ready=ready, warmup=self.server.warmup_status())).encode(), "application/json", 200 if ready else 503)
+            return
+        self._handle(url.query)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self._handle(self.rfile.read(length).decode())
+
+    def _handle(self, query):
+        adapter = os.path.splitext(os.path.basename(urllib.parse.urlparse(self.path).path))[0]
+        if adapter not in ADAPTERS:
+            self.send_error(404, "unknown adapter {}".format(adapter))
+            return
+
+        #first value of each field, as cgi.FieldStorage.getvalue
+        fields = {k: v[0] for k, v in urllib.parse.parse_qs(query).items()}
+
+        capture = capture_from_env()
+        if capture is not None:
+            capture.record(adapter, **fields)
+
+        try:
+            with self.server.live_request():
+                body = self.server.run(adapter, fields).encode()
+        except Exception as e:
+            logger.exception('{} request failed'.format(adapter))
+            self.send_error(500, explain=repr(e))
+            return
+
+        self._send(body, "text/html;charset=utf-8")
+
+    def _send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+class ModelServer(ThreadingHTTPServer):
+    """Serves the adapters. store: ResultStore shared by the requests (None to always run the model)"""
+
+    daemon_threads = True
+
+    def __init__(self, address, store=None):
+        ThreadingHTTPServer.__init__(self, address, ModelRequestHandler)
+        self.store = store
+        self.flight = SingleFlight()
+        self.ready = threading.Event()
+        self._live = 0
+        self._idle = threading.Condition()
+        self._warmup = dict(total=0, done=0, errors=0)
+        self._warmup_lock = threading.Lock()
+
+    def run(self, adapter, fields):
+        """response of adapter to fields. Identical requests in flight share one run"""
+        return self.flight.do(request_key(adapter, fields), ADAPTERS[adapter], fields, store=self.store)
+
+    @contextlib.contextmanager
+    def live_request(self):
+        """context counting a live request: warm-up waits while there are some"""
+        with self._idle:
+            self._live += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._live -= 1
+                self._idle.notify_all()
+
+    def warm_up(self, requests):
+        """runs requests (list of (adapter, fields)) one at a time, each once no live request is running, then sets ready"""
+        with self._warmup_lock:
+            self._warmup["total"] = len(requests)
+        for adapter, fields in requests:
+            with self._idle:
+                self._idle.wait_for(lambda: self._live == 0)
+            failed = False
+            try:
+                self.run(adapter, fields)
+            except Exception:
+                logger.exception('warm-up of {} {} failed'.format(adapter, fields))
+                failed = True
+            with self._warmup_lock:
+                self._warmup["errors"] += failed
+                self._warmup["done"] += 1
+        self.ready.set()
+        logger.info('warm-up done: {}'.format(self.warmup_status()))
+
+    def start_warm_up(self, requests):
+        thread = threading.Thread(target=self.warm_up, args=(requests,), name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def warmup_status(self):
+        with self._warmup_lock:
+            return dict(self._warmup)
+
+
+def warmup_requests(path=BASELINE_PATH, scorecard_path=SCORECARD_INPUTS, model_function=WARMUP_MODEL_FUNCTION, policy_function=WARMUP_POLICY_FUNCTION,
+                    policies=DEFAULT_POLICIES):
+    """requests of the GLOBAL view, the view of every group_name of the baseline table (the table of model_adapter's group
+    requests) and the default scorecard on scorecard_path, most requested first. Views the adapters cannot build are skipped"""
+
+    out = []
+    try:
+        baseline = parse_csv(path)
+    except (OSError, SchemaError) as e:
+        logger.warning('warm-up: no model views, cannot read {}: {}'.format(path, e))
+    else:
+        out.append(("model_adapter", dict(m=model_function, g="GLOBAL")))
+        if "group_name" in baseline:
+            out += [("model_adapter", dict(m=model_function, g=g)) for g in sorted(baseline["group_name"].dropna().unique())]
+        else:
+            logger.info('warm-up: {} has no group_name, group views are not precomputed'.format(path))
+
+    try:
+        scorecard_inputs = parse_csv(scorecard_path)
+    except (OSError, SchemaError) as e:
+        logger.warning('warm-up: no scorecard, cannot read {}: {}'.format(scorecard_path, e))
+    else:
+        if "id" in scorecard_inputs and "group_name" in scorecard_inputs:
+            out.append(("model_scorecard_adapter", dict(SCORECARD_FIELDS, pol_m=policy_function, pol_str_arr=",".join(policies), i_df=scorecard_path)))
+        else:
+            logger.warning('warm-up: no scorecard, {} has no id or group_name column'.format(scorecard_path))
+    return out
+
+
+def make_server(host="", port=8080, store=None):
+    return ModelServer((host, port), store=store)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Serve the model adapters from a long-lived process.")
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--store', default=STORE_PATH, help='path of the sqlite result store')
+    parser.add_argument('--no-store', action='store_true', help='always run the model')
+    parser.add_argument('--no-warmup', action='store_true', help='do not precompute the baseline views at start-up')
+    parser.add_argument('--warmup-model', default=WARMUP_MODEL_FUNCTION, help='model function of the precomputed views')
+    parser.add_argument('--warmup-policy-model', default=WARMUP_POLICY_FUNCTION, help='model function of the precomputed scorecard')
+    parser.add_argument('--warmup-scorecard-inputs', default=SCORECARD_INPUTS, help='inputs of the precomputed scorecard')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, store=None if args.no_store else ResultStore(args.store))
+    if args.no_warmup or server.store is None: #without store, precomputed results would not be kept
+        server.ready.set()
+    else:
+        server.start_warm_up(warmup_requests(scorecard_path=args.warmup_scorecard_inputs, model_function=args.warmup_model,
+                                                  policy_function=args.warmup_policy_model))
+    logger.info('serving the model adapters on port {}'.format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,183 @@
+# -*- coding: UTF-8 -*-
+"""Schema of the packed model inputs, and one-pass parsers for request payloads and csv files.
+
+Packed inputs have one line per economy, numeric macro_*, *_cat_info__* and
+hazard_ratio_* columns (plus a few other numeric columns) and string name,
+group_name and id columns. The parsers decode records or csv rows straight
+into a contiguous float64 block and string arrays, and report every
+validation error at once.
+"""
+
+import csv
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+#string columns of packed inputs
+STRING_COLUMNS = ["name", "group_name", "id"]
+
+#numeric columns of packed inputs
+NUMERIC_PATTERNS = [re.compile(p) for p in [
+    r"^macro_",
+    r"_cat_info__",
+    r"^hazard_ratio_",
+    r"^shew_for_hazard_ratio$",
+    r"^ratio_surge_flood$",
+    r"^(risk|resilience|risk_to_assets)$", #outputs of previous runs, carried along
+]]
+
+#packed columns (prefixes) that are shares and must stay within [0,1] when scaled
+SHARE_COLUMNS = ["fa_cat_info", "v_cat_info", "shew_cat_info", "axfin_cat_info", "hazard_ratio_fa", "hazard_ratio_flood_poor",
+                 "shew_for_hazard_ratio", "macro_urbanization_rate", "macro_prepare_scaleup", "macro_pi", "macro_shareable"]
+
+#values read as missing (nan) rather than as errors
+MISSING_VALUES = ["", "nan", "NaN", "NA", "null", "None"]
+
+
+class SchemaError(ValueError):
+    """Packed inputs do not follow the schema. errors lists every problem found"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        ValueError.__init__(self, "{} validation errors in packed inputs:\n".format(len(errors)) + "\n".join(errors))
+
+
+def column_kind(col):
+    """"string", "numeric" or None (unknown column)"""
+    if col in STRING_COLUMNS:
+        return "string"
+    if any(p.search(col) for p in NUMERIC_PATTERNS):
+        return "numeric"
+    return None
+
+
+def _to_float(value):
+    if value is None:
+        return np.nan
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str) and value.strip() in MISSING_VALUES:
+        return np.nan
+    return float(value)
+
+
+def _parse_rows(columns, rows, index_col="name"):
+    """parses rows (iterable of sequences of values, in the order of columns) into a DataFrame, in a single pass"""
+
+    errors = []
+
+    unknown = [c for c in columns if column_kind(c) is None]
+    if unknown:
+        errors.append("unknown columns: " + ", ".join(unknown))
+    if index_col is not None and index_col not in columns:
+        errors.append("missing column: " + index_col)
+    if len(set(columns)) != len(columns):
+        errors.append("duplicated columns: " + ", ".join(sorted(set(c for c in columns if columns.count(c) > 1))))
+    if errors:
+        raise SchemaError(errors)
+
+    numeric = [i for i, c in enumerate(columns) if column_kind(c) == "numeric"]
+    strings = [i for i, c in enumerate(columns) if column_kind(c) == "string"]
+
+    rows = list(rows)
+    block = np.empty((len(rows), len(numeric)), dtype="float64")
+    texts = [[None] * len(rows) for _ in strings]
+
+    for r, row in enumerate(rows):
+        if len(row) != len(columns):
+            errors.append("record {}: {} values for {} columns".format(r, len(row), len(columns)))
+            continue
+        for j, i in enumerate(numeric):
+            try:
+                block[r, j] = _to_float(row[i])
+            except (TypeError, ValueError):
+                errors.append("record {}: {}: not a number: {!r}".format(r, columns[i], row[i]))
+        for j, i in enumerate(strings):
+            texts[j][r] = None if row[i] is None else str(row[i])
+
+    if errors:
+        raise SchemaError(errors)
+
+    names = {columns[i]: texts[j] for j, i in enumerate(strings)}
+    index = pd.Index(names.pop(index_col), name=index_col) if index_col is not None else None
+
+    df = pd.DataFrame(block, columns=[columns[i] for i in numeric], index=index)
+    for col, values in names.items():
+        df[col] = values
+
+    return df[[c for c in columns if c != index_col]]
+
+
+def parse_records(records, index_col="name"):
+    """parses a list of dicts (eg a json request payload) into a packed input DataFrame indexed by index_col"""
+
+    if isinstance(records, dict):
+        records = [records]
+
+    columns = []
+    for rec in records:
+        for c in rec:
+            if c not in columns:
+                columns.append(c)
+
+    missing = object()
+    rows = [[rec.get(c, missing) for c in columns] for rec in records]
+
+    errors = ["record {}: missing {}".format(r, c) for r, row in enumerate(rows) for c, v in zip(columns, row) if v is missing]
+    if errors:
+        raise SchemaError(errors)
+
+    return _parse_rows(columns, rows, index_col=index_col)
+
+
+def parse_json(text, index_col="name"):
+    """parses a json record or array of records"""
+    return parse_records(json.loads(text), index_col=index_col)
+
+
+def parse_csv(path_or_buffer, index_col="name"):
+    """parses a packed input csv file (path or file object)"""
+
+    if isinstance(path_or_buffer, str):
+        with open(path_or_buffer, newline='') as f:
+            return parse_csv(f, index_col=index_col)
+
+    reader = csv.reader(path_or_buffer)
+    columns = next(reader)
+    return _parse_rows(columns, reader, index_col=index_col)
+
+
+def coerce_frame(df):
+    """returns df with numeric schema columns as float64, converting only the columns that are not already.
+    Raises SchemaError listing every non numeric value"""
+
+    errors = []
+    converted = {}
+    for col in df.columns:
+        if column_kind(col) != "numeric" or df[col].dtype == np.float64:
+            continue
+        try:
+            converted[col] = df[col].astype("float64")
+        except (TypeError, ValueError):
+            bad = [v for v in df[col] if not _is_number(v)]
+            errors.append("{}: not a number: {}".format(col, ", ".join(repr(v) for v in bad[:5])))
+
+    if errors:
+        raise SchemaError(errors)
+    if not converted:
+        return df
+
+    df = df.copy()
+    for col, values in converted.items():
+        df[col] = values
+    return df
+
+
+def _is_number(value):
+    try:
+        _to_float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
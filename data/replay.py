@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Load testing by replaying captured requests.
+
+Replays the records of a capture log (see capture.py) at a given
+concurrency, either in-process (the model work of the adapters, without the
+cgi layer) or against a running server over http, and reports latency
+percentiles and throughput.
+
+    python replay.py model/requests.ndjson.gz --concurrency 8
+    python replay.py model/requests.ndjson.gz --url http://localhost/cgi-bin/ --concurrency 8
+"""
+
+import argparse
+import itertools
+import json
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import model_adapter
+import model_scorecard_adapter
+from capture import CAPTURE_PATH, read_capture
+
+PERCENTILES = [50, 90, 99]
+
+
+#model work of the adapters (without the cgi layer)
+RUNNERS = {
+    "model_adapter": model_adapter.handle_request,
+    "model_scorecard_adapter": model_scorecard_adapter.handle_request,
+}
+
+
+def in_process(record):
+    RUNNERS[record["adapter"]](record["fields"])
+
+
+def over_http(url):
+    """runner posting records to the adapters served under url"""
+
+    def run(record):
+        fields = {k: v for k, v in record["fields"].items() if v is not None}
+        data = urllib.parse.urlencode(fields).encode()
+        with urllib.request.urlopen(urllib.parse.urljoin(url, record["adapter"] + ".py"), data=data) as response:
+            response.read()
+
+    return run
+
+
+def replay(records, runner=in_process, concurrency=1, repeat=1):
+    """runs records (repeat times, in order) with concurrency threads.
+    Returns a DataFrame with one line per request: adapter, latency (s) and error"""
+
+    def timed(record):
+        start = time.perf_counter()
+        try:
+            runner(record)
+            error = None
+        except Exception as e:
+            error = repr(e)
+        return dict(adapter=record["adapter"], latency=time.perf_counter() - start, error=error)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return pd.DataFrame(list(pool.map(timed, itertools.chain.from_iterable([records] * repeat))))
+
+
+def summarize(results, elapsed):
+    """latency percentiles (ms), throughput (requests/s) and error count, overall and per adapter"""
+
+    def stats(df):
+        latency = df["latency"].values * 1000
+        out = {"requests": len(df), "errors": int(df["error"].notnull().sum()), "mean_ms": latency.mean()}
+        for p, v in zip(PERCENTILES, np.percentile(latency, PERCENTILES)):
+            out["p{}_ms".format(p)] = v
+        out["throughput"] = len(df) / elapsed
+        return pd.Series(out)
+
+    out = results.groupby("adapter").apply(stats)
+    out.loc["all"] = stats(results)
+    return out
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Replay captured requests and report latency and throughput.")
+    parser.add_argument('log', nargs='?', default=CAPTURE_PATH, help='capture log')
+    parser.add_argument('--url', help='base url of the adapters (runs in-process if not given)')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='number of passes over the log')
+    parser.add_argument('--limit', type=int, help='only replay the first requests of the log')
+    parser.add_argument('--output', help='csv file to write per request latencies to')
+    args = parser.parse_args()
+
+    records = list(itertools.islice(read_capture(args.log), args.limit))
+    runner = over_http(args.url) if args.url else in_process
+
+    start = time.perf_counter()
+    results = replay(records, runner=runner, concurrency=args.concurrency, repeat=args.repeat)
+    elapsed = time.perf_counter() - start
+
+    if args.output:
+        results.to_csv(args.output)
+    print(summarize(results, elapsed).to_string(float_format="{:.1f}".format))
+    errors = results["error"].dropna()
+    if len(errors):
+        print("\n{} errors, first: {}".format(len(errors), json.dumps(errors.iloc[0])))
@@ -9,9 +9,8 @@ import pandas as pd
 
 from scipy.interpolate import interp1d
 
-logging.basicConfig(
-    filename='model.log', level=logging.DEBUG,
-    format='%(asctime)s: %(levelname)s: %(message)s')
+#handlers are configured by the entry points (adapters, service, command lines), not at import
+logger = logging.getLogger(__name__)
 
 
 #import pandas as pd
@@ -133,6 +132,21 @@ def concat_categories(p,np, index):
     return y.squeeze()
 
 
+def broadcast_to_events(df_in, event_index):
+    """replicates the lines of df_in (indexed by economy and possibly other levels such as income_cat) to each event of event_index,
+    a MultiIndex with an economy level and no duplicates. Unlike broadcast_simple, which broadcasts to the product of all levels,
+    only the events in event_index are created, so economies can have different (ragged) return periods"""
+
+    df_levels = get_list_of_index_names(df_in)
+    event_levels = [l for l in event_index.names if l not in df_levels]
+
+    events = pd.DataFrame({l: event_index.get_level_values(l) for l in event_index.names})
+
+    y = pd.merge(events, df_in.reset_index(), on=economy).set_index(df_levels + event_levels).sort_index()
+
+    return y[df_in.columns]
+
+
 #name of admin division
 economy = "name"
 #levels of index at which one event happens
@@ -141,22 +155,188 @@ event_level = [economy, "hazard", "rp"]
 #return period to use when no rp is provided (mind that this works with protection)
 default_rp = "default_rp"
 
+#optional level of hazard_ratios with climate / exposure scenarios
+scenario = "scenario"
+#joins economy and scenario in the economy labels of the event level work (see fold_scenarios)
+scenario_separator = "\x1f"
+
 #categories of households
 income_cats   = pd.Index(["poor","nonpoor"],name="income_cat")
 #categories for social protection
 affected_cats = pd.Index(["a", "na"]            ,name="affected_cat")
 helped_cats   = pd.Index(["helped","not_helped"],name="helped_cat")
 
+#options of the post disaster response and their default values
+response_option_names = ["optionT", "optionPDS", "optionB", "optionFee"]
+default_response_options = dict(optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax")
+
+#outputs of compute_resilience -> columns of cats_event_iah they sum over households (see breakdown in compute_resilience)
+breakdown_columns = {"dK": "dk", "delta_W": "dw"}
+#levels of breakdown cubes: levels of event_level and household categories
+default_breakdown_levels = [economy, "hazard", "income_cat"]
+household_levels = ["income_cat", "affected_cat", "helped_cat"]
+
+#outputs of compute_resilience -> outputs they are computed from
+output_dependencies = {
+    "risk_to_assets": ["risk", "resilience"],
+    "risk": ["dWpc_currency"],
+    "resilience": ["dK", "delta_W"],
+    "dWtot_currency": ["dWpc_currency"],
+    "dWpc_currency": ["delta_W"],
+    "delta_W_tot": ["delta_W"],
+    "dKtot": ["dK"],
+}
+
+
+def required_outputs(outputs):
+    """set of outputs needed to compute outputs (list of column names), or None (everything) if outputs is None"""
+    if outputs is None:
+        return None
+    required = set()
+    pending = list(outputs)
+    while pending:
+        col = pending.pop()
+        if col not in required:
+            required.add(col)
+            pending += output_dependencies.get(col, [])
+    return required
+
 
-def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True, return_iah=False, return_stats=False,optionT="data", optionPDS="unif_poor", optionB = "data", loss_measure = "dk",fraction_inside=1, verbose_replace=False, optionFee="tax",  share_insured=.25):
+def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True, return_iah=False, return_stats=False,optionT="data", optionPDS="unif_poor", optionB = "data", loss_measure = "dk",fraction_inside=1, verbose_replace=False, optionFee="tax",  share_insured=.25, profiler=None, ragged_rps=False, outputs=None, breakdown=None, breakdown_levels=None):
     """Main function. Computes all outputs (dK, resilience, dC, etc,.) from inputs
     optionT=="perfect","data","x33","incl" or "excl"
     optionPDS=="no","unif_all","unif_poor","prop"
     optionB=="data","unif_poor"
     optionFee == "tax" (default) or "insurance_premium"
     fraction_inside=0..1 (how much aid is paid domestically)
+    profiler: optional memory_profile.MemoryProfiler recording memory use at each stage
+    ragged_rps: if True, hazard data with return periods is evaluated, for each economy, at its data return periods and its own protection only
+        (instead of the protection values of all economies)
+    outputs: optional list of the output columns needed (eg ["dK", "dWpc_currency"]). Only these are returned,
+        and event level columns, stats and economy level outputs that do not feed them are not computed
+    hazard_ratios may have a scenario level (see scale_hazard_ratios): outputs are then indexed by (economy, scenario).
+        macro and cat_info are prepared once and only the event level work is done for every scenario
+    breakdown: optional list of outputs (dK, delta_W) or columns of cats_event_iah, summed over households (weighted by n).
+        They are averaged over return periods and returned by levels (breakdown_levels, default economy, hazard and income_cat)
+        as an additional output, after cats_event_iah if return_iah. cats_event_iah is reduced at event level and not kept
     """
 
+    macro, macro_event, cats_event = prepare_inputs(df_in, cat_info, hazard_ratios, verbose_replace=verbose_replace, profiler=profiler, ragged_rps=ragged_rps)
+
+    ####COMPUTING LOSSES
+    #computes dk and dW per event
+    out=compute_dK_dW(macro_event, cats_event, optionT=optionT, optionPDS=optionPDS, optionB=optionB, return_iah=return_iah,  return_stats= return_stats,is_local_welfare=is_local_welfare, loss_measure=loss_measure,fraction_inside=fraction_inside, optionFee=optionFee,  share_insured=share_insured, profiler=profiler, outputs=outputs, breakdown=breakdown, breakdown_levels=breakdown_levels)
+
+    #unpacks if needed
+    if breakdown is not None:
+        cube = out[-1]
+        out = out[0] if len(out) == 2 else out[:2]
+    if return_iah:
+        dkdw_event,cats_event_iah  = out
+    else:
+        dkdw_event = out
+
+    ##AGGREGATES LOSSES
+    macro = aggregate_losses(macro, dkdw_event, macro_event, is_local_welfare, outputs=outputs)
+
+    if profiler is not None:
+        profiler.stage("aggregate_losses", macro=macro)
+
+    if outputs is not None:
+        macro = macro[[c for c in outputs if c in macro]]
+
+    if breakdown is not None:
+        cube = average_breakdown(cube, macro_event, breakdown_levels or default_breakdown_levels)
+
+    if has_scenarios(hazard_ratios):
+        macro = unfold_scenarios(macro)
+        if return_iah:
+            cats_event_iah = unfold_scenarios(cats_event_iah)
+        if breakdown is not None:
+            cube = unfold_scenarios(cube)
+
+    ###OUTPUTS
+    result = [macro]
+    if return_iah:
+        result.append(cats_event_iah)
+    if breakdown is not None:
+        result.append(cube)
+    return result[0] if len(result) == 1 else tuple(result)
+
+
+def compute_resilience_sweep(df_in, cat_info, hazard_ratios=None, options_list=None, is_local_welfare=True, loss_measure="dk", fraction_inside=1, verbose_replace=False, share_insured=.25, profiler=None, ragged_rps=False, outputs=None):
+    """Computes the outputs of compute_resilience for several combinations of optionT, optionPDS, optionB and optionFee in one call.
+    options_list is a list of dicts of these options (missing ones take the defaults of compute_resilience).
+    Preprocessing, losses before response, targeting counts and needs are computed once and shared by all combinations.
+    Returns the macro outputs indexed by (optionT, optionPDS, optionB, optionFee, economy)"""
+
+    if options_list is None:
+        options_list = [{}]
+
+    macro, macro_event, cats_event = prepare_inputs(df_in, cat_info, hazard_ratios, verbose_replace=verbose_replace, profiler=profiler, ragged_rps=ragged_rps)
+
+    #option independent part of the losses
+    macro_event, cats_event_ia = compute_losses_before_response(macro_event, cats_event)
+
+    if profiler is not None:
+        profiler.stage("losses_before_response", macro_event=macro_event, cats_event=cats_event, cats_event_ia=cats_event_ia)
+
+    #targeting (and needs) per optionT, filled as needed
+    targetings = dict()
+
+    out = dict()
+    for options in options_list:
+        opts = dict(default_response_options, **options)
+        key = tuple(opts[o] for o in response_option_names)
+        if key in out:
+            continue
+        dkdw_event = compute_dK_dW_after_response(macro_event, cats_event_ia, targetings=targetings, is_local_welfare=is_local_welfare, loss_measure=loss_measure, fraction_inside=fraction_inside, share_insured=share_insured, profiler=profiler, outputs=outputs, **opts)
+        out[key] = aggregate_losses(macro, dkdw_event, macro_event, is_local_welfare, outputs=outputs)
+        if outputs is not None:
+            out[key] = out[key][[c for c in outputs if c in out[key]]]
+        if has_scenarios(hazard_ratios):
+            out[key] = unfold_scenarios(out[key])
+
+    return pd.concat(out, names=response_option_names)
+
+
+def prepare_inputs(df_in, cat_info, hazard_ratios=None, verbose_replace=False, profiler=None, ragged_rps=False):
+    """Harmonizes inputs and broadcasts them to event level. Does not depend on PDS options.
+    Returns macro (economy level), macro_event and cats_event (event level)"""
+
+    macro, cat_info, hazard_ratios = clean_inputs(df_in, cat_info, hazard_ratios)
+
+    scenarios = has_scenarios(hazard_ratios)
+
+    if not scenarios:
+        hazard_ratios_event = hazard_ratios_to_events(hazard_ratios, macro.protection, ragged_rps=ragged_rps)
+
+        if profiler is not None:
+            profiler.stage("interpolate_rps", hazard_ratios_event=hazard_ratios_event)
+
+    macro, cat_info = harmonize_inputs(macro, cat_info, hazard_ratios)
+
+    macro["macro_multiplier"] = compute_macro_multiplier(macro)
+
+    if scenarios:
+        #economy level preparation is shared by all scenarios, the event level work is done per (economy, scenario)
+        macro, cat_info, hazard_ratios = fold_scenarios(macro, cat_info, hazard_ratios)
+        hazard_ratios_event = hazard_ratios_to_events(hazard_ratios, macro.protection, ragged_rps=ragged_rps)
+
+        if profiler is not None:
+            profiler.stage("interpolate_rps", hazard_ratios_event=hazard_ratios_event)
+
+    macro_event, cats_event = broadcast_inputs(macro, cat_info, hazard_ratios_event, verbose_replace=verbose_replace, ragged_rps=ragged_rps)
+
+    if profiler is not None:
+        profiler.stage("broadcast", macro=macro, macro_event=macro_event, cats_event=cats_event, hazard_ratios_event=hazard_ratios_event)
+
+    return macro, macro_event, cats_event
+
+
+def clean_inputs(df_in, cat_info, hazard_ratios=None):
+    """Copies inputs, drops missing values and provides default hazard ratios. Returns macro, cat_info, hazard_ratios"""
+
     #make sure to copy inputs
     macro    =    df_in.dropna().copy(deep=True)
     cat_info = cat_info.dropna().copy(deep=True)
@@ -180,13 +360,25 @@ def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True
     if "hazard" not in get_list_of_index_names(hazard_ratios):
         hazard_ratios = broadcast_simple(hazard_ratios, pd.Index(["default_hazard"], name="hazard"))
 
+    return macro, cat_info, hazard_ratios
+
+
+def hazard_ratios_to_events(hazard_ratios, protection, ragged_rps=False):
+    """hazard ratios at event level (economy, hazard, rp), interpolated on the rp grid given by protection if they have return periods"""
+
     #if hazard data has no rp, it is broadcasted to default hazard
     if "rp" not in get_list_of_index_names(hazard_ratios):
         hazard_ratios_event = broadcast_simple(hazard_ratios, pd.Index([default_rp], name="rp"))
     else:
-        #interpolates data to a more granular grid for return periods that includes all protection values
-        hazard_ratios_event = interpolate_rps(hazard_ratios,macro.protection)  #XXX: could move this after dkdw into average over rp (but parallel computing within pandas probably means no difference)
+        #interpolates data to a more granular grid for return periods that includes all protection values (or only the one of each economy if ragged_rps)
+        hazard_ratios_event = interpolate_rps(hazard_ratios,protection, ragged=ragged_rps)  #XXX: could move this after dkdw into average over rp (but parallel computing within pandas probably means no difference)
+
+    return hazard_ratios_event
+
 
+def harmonize_inputs(macro, cat_info, hazard_ratios):
+    """Restricts macro and cat_info to economies present in all inputs and makes income, gdp and transfers consistent.
+    Only uses the index of hazard_ratios. Modifies macro and cat_info in place and returns them"""
 
     #########
     ## PRE PROCESS and harmonize input values
@@ -194,7 +386,6 @@ def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True
     common_places = [c for c in macro.index if c in cat_info.index and c in hazard_ratios.index]
     macro = macro.ix[common_places]
     cat_info = cat_info.ix[common_places]
-    hazard_ratios = hazard_ratios.ix[common_places]
 
 
     ##consistency of income, gdp, etc.
@@ -212,6 +403,11 @@ def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True
     #RECompute consumption from k and new gamma_SP and tau_tax
     cat_info["c"]=(1-macro["tau_tax"])*macro["avg_prod_k"]*cat_info["k"]+ cat_info["gamma_SP"]*macro["tau_tax"]*macro["avg_prod_k"]*agg_to_economy_level(cat_info,"k")
 
+    return macro, cat_info
+
+
+def compute_macro_multiplier(macro):
+    """Macro multiplier of consumption losses (NPV), from reconstruction time, productivity of capital and discount rate"""
 
     # # # # # # # # # # # # # # # # # # #
     # MACRO_MULTIPLIER
@@ -222,23 +418,32 @@ def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True
     recons_rate = three/ macro["T_rebuild_K"]
 
     # Calculation of macroeconomic resilience
-    macro["macro_multiplier"] =(macro["avg_prod_k"] +recons_rate)/(macro["rho"]+recons_rate)
+    return (macro["avg_prod_k"] +recons_rate)/(macro["rho"]+recons_rate)
+
+
+def broadcast_inputs(macro, cat_info, hazard_ratios_event, verbose_replace=False, ragged_rps=False):
+    """Broadcasts macro and cat_info to the events of hazard_ratios_event and applies hazard ratios. Returns macro_event, cats_event"""
 
     ####FORMATING
     #gets the event level index
     event_level_index = hazard_ratios_event.reset_index().set_index(event_level).index
 
+    #with ragged return periods, events are only those of hazard_ratios_event, not the product of all economies, hazards and rps
+    broadcast = broadcast_to_events if ragged_rps else broadcast_simple
+    if ragged_rps:
+        event_level_index = event_level_index.drop_duplicates()
+
     #Broadcast macro to event level
-    macro_event = broadcast_simple(macro,  event_level_index)
+    macro_event = broadcast(macro,  event_level_index)
     #updates columns in macro with columns in hazard_ratios_event
     cols = [c for c in macro_event if c in hazard_ratios_event]
     if not cols==[]:
         macro_event[cols] =  hazard_ratios_event[cols]
     if verbose_replace:
-        print("Replaced in macro: "+", ".join(cols))
+        logger.info("Replaced in macro: "+", ".join(cols))
 
     #Broadcast categories to event level
-    cats_event = broadcast_simple(cat_info,  event_level_index)
+    cats_event = broadcast(cat_info,  event_level_index)
     # applies mh ratios to relevant columns
     cols_c = [c for c in cats_event if c in hazard_ratios_event] #columns that are both in cats_event and hazard_ratios_event
 
@@ -247,21 +452,74 @@ def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True
         hrb = broadcast_simple( hazard_ratios_event[cols_c], cat_info.index).reset_index().set_index(get_list_of_index_names(cats_event)) #explicitly broadcasts hazard ratios to contain income categories
         cats_event[cols_c] = hrb
         if verbose_replace:
-            print("Replaced in cats: "+", ".join(cols_c))
+            logger.info("Replaced in cats: "+", ".join(cols_c))
     if verbose_replace:
-        print("Replaced in both: "+", ".join(np.intersect1d(cols,cols_c)))
+        logger.info("Replaced in both: "+", ".join(np.intersect1d(cols,cols_c)))
 
-    ####COMPUTING LOSSES
-    #computes dk and dW per event
-    out=compute_dK_dW(macro_event, cats_event, optionT=optionT, optionPDS=optionPDS, optionB=optionB, return_iah=return_iah,  return_stats= return_stats,is_local_welfare=is_local_welfare, loss_measure=loss_measure,fraction_inside=fraction_inside, optionFee=optionFee,  share_insured=share_insured)
+    return macro_event, cats_event
 
-    #unpacks if needed
-    if return_iah:
-        dkdw_event,cats_event_iah  = out
-    else:
-        dkdw_event = out
 
-    ##AGGREGATES LOSSES
+def has_scenarios(hazard_ratios):
+    return hazard_ratios is not None and scenario in get_list_of_index_names(hazard_ratios)
+
+
+def scale_hazard_ratios(hazard_ratios, scenarios):
+    """hazard_ratios with a scenario level: for each scenario (row of scenarios, one column of multipliers of fa per hazard),
+    fa is multiplied by the multiplier of its hazard (1 for hazards without one) and capped to 1"""
+
+    levels = get_list_of_index_names(hazard_ratios)
+    hazards = hazard_ratios.index.get_level_values("hazard")
+
+    out = dict()
+    for name, multipliers in scenarios.iterrows():
+        hr = hazard_ratios.copy()
+        m = multipliers.dropna().reindex(hazards).fillna(1).values
+        hr["fa"] = (hr["fa"] * m).clip(upper=1)
+        out[name] = hr
+
+    return pd.concat(out, names=[scenario]).reorder_levels(levels + [scenario]).sort_index()
+
+
+def fold_scenarios(macro, cat_info, hazard_ratios):
+    """Moves the scenario level of hazard_ratios into its economy labels ("economy<scenario_separator>scenario")
+    and replicates macro and cat_info for every (economy, scenario), so that scenarios are computed as economies.
+    Returns macro, cat_info, hazard_ratios. See unfold_scenarios"""
+
+    levels = [l for l in get_list_of_index_names(hazard_ratios) if l != scenario]
+
+    hr = hazard_ratios.reset_index()
+    pairs = hr[[economy, scenario]].drop_duplicates()
+    pairs = pairs.loc[pairs[economy].isin(macro.index) & pairs[economy].isin(cat_info.index.get_level_values(economy))]
+    labels = list(pairs[economy].astype(str) + scenario_separator + pairs[scenario].astype(str))
+
+    hr[economy] = hr[economy].astype(str) + scenario_separator + hr[scenario].astype(str)
+    hazard_ratios = hr.drop(scenario, axis=1).set_index(levels).sort_index()
+
+    macro = macro.ix[pairs[economy].values]
+    macro.index = pd.Index(labels, name=economy)
+
+    cat_info = pd.concat([cat_info.ix[n] for n in pairs[economy]], keys=labels, names=[economy])
+
+    return macro, cat_info, hazard_ratios
+
+
+def unfold_scenarios(df):
+    """splits the economy labels of df made by fold_scenarios into an economy and a scenario level"""
+
+    idx = df.index.to_frame(index=False)
+    split = idx[economy].str.split(scenario_separator, n=1, expand=True)
+    idx[economy] = split[0]
+    idx.insert(list(idx.columns).index(economy) + 1, scenario, split[1])
+
+    df = df.copy()
+    df.index = pd.MultiIndex.from_frame(idx)
+    return df
+
+
+def aggregate_losses(macro, dkdw_event, macro_event, is_local_welfare=True, outputs=None):
+    """Averages event losses over return periods, sums them over hazards and computes risk and resilience at economy level.
+    Returns a copy of macro with outputs"""
+
     #Averages over return periods to get dk_{hazard} and dW_{hazard}
     dkdw_h = average_over_rp(dkdw_event,macro_event["protection"])
 
@@ -269,22 +527,36 @@ def compute_resilience(df_in,cat_info, hazard_ratios=None, is_local_welfare=True
     dkdw = dkdw_h.sum(level=economy)
 
     #adds dk and dw-like columns to macro
+    macro = macro.copy()
     macro[dkdw.columns]=dkdw
 
     #computes socio economic capacity and risk at economy level
-    macro = calc_risk_and_resilience_from_k_w(macro, is_local_welfare)
-
-    ###OUTPUTS
-    if return_iah:
-        return macro, cats_event_iah
-    else:
-        return macro
+    return calc_risk_and_resilience_from_k_w(macro, is_local_welfare, outputs=outputs)
 
 
-def compute_dK_dW(macro_event, cats_event, optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", return_iah=False, return_stats=False, is_local_welfare=True,loss_measure="dk",fraction_inside=1, share_insured=.25):
+def compute_dK_dW(macro_event, cats_event, optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", return_iah=False, return_stats=False, is_local_welfare=True,loss_measure="dk",fraction_inside=1, share_insured=.25, profiler=None, outputs=None, breakdown=None, breakdown_levels=None):
     '''Computes dk and dW line by line.
     presence of multiple return period or multihazard data is transparent to this function'''
 
+    macro_event, cats_event_ia = compute_losses_before_response(macro_event, cats_event)
+
+    if profiler is not None:
+        profiler.stage("losses_before_response", macro_event=macro_event, cats_event=cats_event, cats_event_ia=cats_event_ia)
+
+    return compute_dK_dW_after_response(macro_event, cats_event_ia, optionT=optionT, optionPDS=optionPDS, optionB=optionB, optionFee=optionFee, return_iah=return_iah, return_stats=return_stats, is_local_welfare=is_local_welfare, loss_measure=loss_measure, fraction_inside=fraction_inside, share_insured=share_insured, profiler=profiler, outputs=outputs, breakdown=breakdown, breakdown_levels=breakdown_levels)
+
+
+def compute_losses_before_response(macro_event, cats_event):
+    '''Consumption losses per affected category before post disaster response. Does not depend on PDS options.
+    Adds dk_event to macro_event and returns macro_event, cats_event_ia'''
+
+    cats_event_ia, macro_event["dk_event"] = compute_capital_losses(macro_event, cats_event)
+
+    return macro_event, compute_consumption_losses(macro_event, cats_event_ia)
+
+
+def compute_capital_losses(macro_event, cats_event):
+    '''Capital losses per affected category. Only uses pi in macro_event. Returns cats_event_ia, dk_event'''
 
     ################## MICRO
     ####################
@@ -307,7 +579,14 @@ def compute_dK_dW(macro_event, cats_event, optionT="data", optionPDS="unif_poor"
     cats_event_ia.ix[(cats_event_ia.affected_cat=='na') ,"dk" ]=0
 
     #"national" losses (to scale down transfers)
-    macro_event["dk_event"] =  agg_to_event_level(cats_event_ia, "dk")
+    dk_event =  agg_to_event_level(cats_event_ia, "dk")
+
+    return cats_event_ia, dk_event
+
+
+def compute_consumption_losses(macro_event, cats_event_ia):
+    '''Consumption losses before response, from capital losses (dk in cats_event_ia, dk_event in macro_event),
+    tau_tax and macro_multiplier. Adds dc and dc_npv_pre to cats_event_ia and returns it'''
 
     #immediate consumption losses: direct capital losses plus losses through event-scale depression of transfers
     cats_event_ia["dc"] = (1-macro_event["tau_tax"])*cats_event_ia["dk"]  +  cats_event_ia["gamma_SP"]*macro_event["tau_tax"] *macro_event["dk_event"]
@@ -315,20 +594,41 @@ def compute_dK_dW(macro_event, cats_event, optionT="data", optionPDS="unif_poor"
     # NPV consumption losses accounting for reconstruction and productivity of capital (pre-response)
     cats_event_ia["dc_npv_pre"] = cats_event_ia["dc"]*macro_event["macro_multiplier"]
 
+    return cats_event_ia
+
+
+def compute_dK_dW_after_response(macro_event, cats_event_ia, optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", return_iah=False, return_stats=False, is_local_welfare=True,loss_measure="dk",fraction_inside=1, share_insured=.25, targetings=None, profiler=None, outputs=None, breakdown=None, breakdown_levels=None):
+    '''Computes dk and dW line by line from losses before response (see compute_losses_before_response).
+    targetings is an optional dict optionT -> compute_targeting output, filled as needed, to share targeting between calls
+    outputs is an optional list of the outputs of compute_resilience needed: columns that do not feed them are not computed
+    breakdown: optional list of columns also returned at event level by household categories (see event_breakdown)'''
+
+    required = required_outputs(outputs)
+
+    def needed(col):
+        return required is None or col in required
+
+    if targetings is None:
+        targetings = dict()
+
+    def targeting(optionT):
+        if optionT not in targetings:
+            targetings[optionT] = compute_targeting(macro_event, cats_event_ia, optionT=optionT)
+        return targetings[optionT]
 
     #POST DISASTER RESPONSE
 
     #baseline case (no insurance)
     if optionFee!="insurance_premium":
-        macro_event, cats_event_iah = compute_response(macro_event, cats_event_ia,  optionT=optionT, optionPDS=optionPDS, optionB=optionB, optionFee=optionFee, fraction_inside=fraction_inside, loss_measure = loss_measure)
+        macro_event, cats_event_iah = compute_response(macro_event, cats_event_ia,  optionT=optionT, optionPDS=optionPDS, optionB=optionB, optionFee=optionFee, fraction_inside=fraction_inside, loss_measure = loss_measure, targeting=targeting(optionT))
 
     #special case of insurance that adds to existing default PDS
     else:
         #compute post disaster response with default PDS from data ONLY
-        m__,c__ = compute_response(macro_event, cats_event_ia,optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", fraction_inside=1, loss_measure="dk")
+        m__,c__ = compute_response(macro_event, cats_event_ia,optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", fraction_inside=1, loss_measure="dk", targeting=targeting("data"))
 
         #compute post disaster response with insurance ONLY
-        macro_event, cats_event_iah = compute_response(macro_event.assign(shareable=share_insured), cats_event_ia,  optionT=optionT, optionPDS=optionPDS, optionB=optionB, optionFee=optionFee, fraction_inside=fraction_inside, loss_measure = loss_measure)
+        macro_event, cats_event_iah = compute_response(macro_event.assign(shareable=share_insured), cats_event_ia,  optionT=optionT, optionPDS=optionPDS, optionB=optionB, optionFee=optionFee, fraction_inside=fraction_inside, loss_measure = loss_measure, targeting=targeting(optionT))
 
         columns_to_add = ["need","aid"]
         macro_event[columns_to_add] +=  m__[columns_to_add]
@@ -347,12 +647,11 @@ def compute_dK_dW(macro_event, cats_event, optionT="data", optionPDS="unif_poor"
     # print(macro_event.head())
 
 
-    cats_event_iah["dw"] = calc_delta_welfare(cats_event_iah, macro_event)
-
-    #aggregates dK and delta_W at df level
-    dK      = agg_to_event_level(cats_event_iah,"dk")
-    delta_W = agg_to_event_level(cats_event_iah,"dw")
+    if profiler is not None:
+        profiler.stage("response", macro_event=macro_event, cats_event_ia=cats_event_ia, cats_event_iah=cats_event_iah)
 
+    if needed("delta_W") or return_iah or breakdown is not None:
+        cats_event_iah["dw"] = calc_delta_welfare(cats_event_iah, macro_event)
 
     ###########
     #OUTPUT
@@ -360,39 +659,79 @@ def compute_dK_dW(macro_event, cats_event, optionT="data", optionPDS="unif_poor"
 
     # df_out["macro_multiplier"] = macro_event["macro_multiplier"]
 
-    df_out["dK"] = dK
-    df_out["dKtot"]=dK*macro_event["pop"] #/macro_event["protection"]
+    #aggregates dK and delta_W at df level
+    if needed("dK"):
+        dK      = agg_to_event_level(cats_event_iah,"dk")
+        df_out["dK"] = dK
+    if needed("dKtot"):
+        df_out["dKtot"]=dK*macro_event["pop"] #/macro_event["protection"]
 
-    df_out["delta_W"]    =delta_W
-    df_out["delta_W_tot"]=delta_W*macro_event["pop"] #/macro_event["protection"]
+    if needed("delta_W"):
+        delta_W = agg_to_event_level(cats_event_iah,"dw")
+        df_out["delta_W"]    =delta_W
+    if needed("delta_W_tot"):
+        df_out["delta_W_tot"]=delta_W*macro_event["pop"] #/macro_event["protection"]
 
-    df_out["average_aid_cost_pc"] = macro_event["aid"]
+    if needed("average_aid_cost_pc"):
+        df_out["average_aid_cost_pc"] = macro_event["aid"]
 
     if return_stats:
         stats = np.setdiff1d(cats_event_iah.columns,event_level+['helped_cat',  'affected_cat',     'income_cat'])
+        if required is not None:
+            stats = [c for c in stats if c in required]
         df_stats = agg_to_event_level(cats_event_iah, stats)
         # if verbose_replace:
-        print("stats are "+",".join(stats))
+        logger.debug("stats are "+",".join(stats))
         df_out[df_stats.columns]=(df_stats.T*macro_event.protection).T #corrects stats from protecgion because they get averaged over rp with the rest of df_out later
 
+    if profiler is not None:
+        profiler.stage("welfare", cats_event_iah=cats_event_iah, df_out=df_out)
+
+    result = [df_out]
     if return_iah:
-        return df_out,cats_event_iah
-    else:
-        return df_out
+        result.append(cats_event_iah)
+    if breakdown is not None:
+        result.append(event_breakdown(cats_event_iah, breakdown, breakdown_levels or default_breakdown_levels))
+    return result[0] if len(result) == 1 else tuple(result)
+
 
+def event_breakdown(cats_event_iah, breakdown, levels):
+    """Sums over households of the breakdown columns (outputs of breakdown_columns or columns of cats_event_iah) weighted by n,
+    per event and household categories of levels (eg income_cat). Returns an event level frame with columns (output, categories)"""
 
-def compute_response(macro_event, cats_event_ia,  optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", fraction_inside=1, loss_measure="dk"):
+    cats = [l for l in levels if l in household_levels]
+
+    weighted = cats_event_iah[[breakdown_columns.get(c, c) for c in breakdown]].mul(cats_event_iah["n"], axis=0)
+    weighted.columns = list(breakdown)
+
+    keys = [cats_event_iah.index.get_level_values(l) for l in event_level] + [cats_event_iah[l] for l in cats]
+    cube = weighted.groupby(keys).sum()
+
+    return cube.unstack(cats) if cats else cube
+
+
+def average_breakdown(cube, macro_event, levels):
+    """Averages an event level breakdown (see event_breakdown) over return periods and sums it over the levels not in levels"""
+
+    cats = [l for l in levels if l in household_levels]
+
+    cube = average_over_rp(cube, macro_event["protection"])
+    if cats:
+        cube = cube.stack(cats)
+
+    return cube.sum(level=[l for l in levels if l in get_list_of_index_names(cube)])
+
+
+def compute_targeting(macro_event, cats_event_ia, optionT="data"):
     """
-    Computes aid received,  aid fee, and other stuff, from losses and PDS options on targeting, financing, and dimensioning of the help.
-    Returns copies of macro_event and cats_event_iah updated with stuff
-    TODO In general this function is ill coded and should be rewritteN
+    Part of the post disaster response that only depends on optionT: exposure at event level, targeting errors, counts of helped and not helped, and maximum aid.
+    Returns (targeting, cats_event_iah, needs) where targeting holds the event level columns to add to macro_event
+    and needs caches aggregated needs (see agg_need). Returns None if optionT is not recognized
     """
 
+    targeting = pd.DataFrame(index=macro_event.index)
 
-    macro_event    = macro_event.copy()
-    cats_event_ia = cats_event_ia.copy()
-
-    macro_event["fa"] =  agg_to_event_level(cats_event_ia,"fa")
+    targeting["fa"] =  agg_to_event_level(cats_event_ia,"fa")
 
 
     #adding hELPED/NOT HELPED CATEGORIES, indexed at event level
@@ -401,44 +740,84 @@ def compute_response(macro_event, cats_event_ia,  optionT="data", optionPDS="uni
 
     ####targeting errors
     if optionT=="perfect":
-        macro_event["error_incl"] = 0
-        macro_event["error_excl"] = 0
+        targeting["error_incl"] = 0
+        targeting["error_excl"] = 0
     elif optionT=="data":
-        macro_event["error_incl"]=(1-macro_event["prepare_scaleup"])/2*macro_event["fa"]/(1-macro_event["fa"])
-        macro_event["error_excl"]=(1-macro_event["prepare_scaleup"])/2
+        targeting["error_incl"]=(1-macro_event["prepare_scaleup"])/2*targeting["fa"]/(1-targeting["fa"])
+        targeting["error_excl"]=(1-macro_event["prepare_scaleup"])/2
     elif optionT=="x33":
-        macro_event["error_incl"]= .33*macro_event["fa"]/(1-macro_event["fa"])
-        macro_event["error_excl"]= .33
+        targeting["error_incl"]= .33*targeting["fa"]/(1-targeting["fa"])
+        targeting["error_excl"]= .33
     elif optionT=="incl":
-        macro_event["error_incl"]= .33*macro_event["fa"]/(1-macro_event["fa"])
-        macro_event["error_excl"]= 0
+        targeting["error_incl"]= .33*targeting["fa"]/(1-targeting["fa"])
+        targeting["error_excl"]= 0
     elif optionT=="excl":
-        macro_event["error_incl"]= 0
-        macro_event["error_excl"]= 0.33
+        targeting["error_incl"]= 0
+        targeting["error_excl"]= 0.33
     else:
-        print("unrecognized targeting error option")
+        logger.warning("unrecognized targeting error option")
         return None
 
     #counting (mind self multiplication of n)
-    cats_event_iah.ix[(cats_event_iah.helped_cat=='helped')    & (cats_event_iah.affected_cat=='a') ,"n"]*=(1-macro_event["error_excl"])
-    cats_event_iah.ix[(cats_event_iah.helped_cat=='not_helped')& (cats_event_iah.affected_cat=='a') ,"n"]*=(  macro_event["error_excl"])
-    cats_event_iah.ix[(cats_event_iah.helped_cat=='helped')    & (cats_event_iah.affected_cat=='na'),"n"]*=(  macro_event["error_incl"])
-    cats_event_iah.ix[(cats_event_iah.helped_cat=='not_helped')& (cats_event_iah.affected_cat=='na'),"n"]*=(1-macro_event["error_incl"])
+    cats_event_iah.ix[(cats_event_iah.helped_cat=='helped')    & (cats_event_iah.affected_cat=='a') ,"n"]*=(1-targeting["error_excl"])
+    cats_event_iah.ix[(cats_event_iah.helped_cat=='not_helped')& (cats_event_iah.affected_cat=='a') ,"n"]*=(  targeting["error_excl"])
+    cats_event_iah.ix[(cats_event_iah.helped_cat=='helped')    & (cats_event_iah.affected_cat=='na'),"n"]*=(  targeting["error_incl"])
+    cats_event_iah.ix[(cats_event_iah.helped_cat=='not_helped')& (cats_event_iah.affected_cat=='na'),"n"]*=(1-targeting["error_incl"])
     ###!!!! n is one again from here.
 
     # #should be only ones
     # cats_event_iah.n.sum(level=event_level)
 
     # MAXIMUM NATIONAL SPENDING ON SCALE UP
-    macro_event["max_aid"] = macro_event["max_increased_spending"]*macro_event["borrow_abi"]*macro_event["gdp_pc_pp"]
+    targeting["max_aid"] = macro_event["max_increased_spending"]*macro_event["borrow_abi"]*macro_event["gdp_pc_pp"]
+
+    return targeting, cats_event_iah, dict()
+
+
+def agg_need(cats_event_iah, loss_measure, poor_only, needs=None):
+    """losses (loss_measure) of affected people (only poor if poor_only) aggregated at event level.
+    needs is an optional dict caching results for a given targeting"""
+
+    key = (loss_measure, poor_only)
+    if needs is not None and key in needs:
+        return needs[key]
+
+    if poor_only:
+        d = cats_event_iah.ix[(cats_event_iah.affected_cat=='a') & (cats_event_iah.income_cat=='poor')]
+    else:
+        d = cats_event_iah.ix[(cats_event_iah.affected_cat=='a')]
+    need = agg_to_event_level(d,loss_measure)
+
+    if needs is not None:
+        needs[key] = need
+    return need
+
+
+def compute_response(macro_event, cats_event_ia,  optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", fraction_inside=1, loss_measure="dk", targeting=None):
+    """
+    Computes aid received,  aid fee, and other stuff, from losses and PDS options on targeting, financing, and dimensioning of the help.
+    targeting is the output of compute_targeting for optionT (computed if None)
+    Returns copies of macro_event and cats_event_iah updated with stuff
+    TODO In general this function is ill coded and should be rewritteN
+    """
+
+    if targeting is None:
+        targeting = compute_targeting(macro_event, cats_event_ia, optionT=optionT)
+        if targeting is None:
+            return None
+
+    targeting, cats_event_iah, needs = targeting
+
+    macro_event    = macro_event.copy()
+    macro_event[targeting.columns] = targeting
+    cats_event_iah = cats_event_iah.copy()
 
     ##THIS LOOP DETERMINES help_received and help_fee by category   (currently may also output cats_event_ia[["need","aid","unif_aid"]] which might not be necessary )
     # how much post-disaster support?
 
     if optionB=="unif_poor":
         ### CALCULATE FIRST THE BUDGET FOR unif_poor and use the same budget for other methods
-        d = cats_event_iah.ix[(cats_event_iah.affected_cat=='a') & (cats_event_iah.income_cat=='poor')]
-        macro_event["need"] = macro_event["shareable"]*agg_to_event_level(d,loss_measure)
+        macro_event["need"] = macro_event["shareable"]*agg_need(cats_event_iah, loss_measure, True, needs)
         macro_event["aid"] = macro_event["need"].clip(upper=macro_event["max_aid"])
     elif optionB=="one_per_affected":
         ### CALCULATE FIRST THE BUDGET FOR unif_poor and use the same budget for other methods
@@ -457,8 +836,7 @@ def compute_response(macro_event, cats_event_ia,  optionT="data", optionPDS="uni
     elif optionB=="max05":
         macro_event["max_aid"]=0.05*macro_event["gdp_pc_pp"]
     elif optionB=="unlimited":
-        d = cats_event_iah.ix[(cats_event_iah.affected_cat=='a')]
-        macro_event["need"] = macro_event["shareable"]*agg_to_event_level(d,loss_measure)
+        macro_event["need"] = macro_event["shareable"]*agg_need(cats_event_iah, loss_measure, False, needs)
         macro_event["aid"] = macro_event["need"]
 
     if optionFee == "tax":
@@ -473,15 +851,9 @@ def compute_response(macro_event, cats_event_ia,  optionT="data", optionPDS="uni
 
     elif optionPDS in ["unif_all", "unif_poor"]:
 
-        if optionPDS=="unif_all":
-            #individual need: NPV losses for affected
-            d = cats_event_iah.ix[(cats_event_iah.affected_cat=='a')]
-        elif optionPDS=="unif_poor":
-            #NPV losses for POOR affected
-            d = cats_event_iah.ix[(cats_event_iah.affected_cat=='a') & (cats_event_iah.income_cat=='poor')]
-
-        #aggs need of those selected in the previous block (eg only poor) at event level
-        macro_event["need"] = macro_event["shareable"]*agg_to_event_level(d,loss_measure)
+        #individual need: NPV losses for affected (for POOR affected with unif_poor)
+        #aggs need of those selected (eg only poor) at event level
+        macro_event["need"] = macro_event["shareable"]*agg_need(cats_event_iah, loss_measure, optionPDS=="unif_poor", needs)
 
         #actual aid reduced by capacity
         if optionB=="data":
@@ -552,10 +924,10 @@ def compute_response(macro_event, cats_event_ia,  optionT="data", optionPDS="uni
             cats_event_iah.ix[(cats_event_iah.income_cat=='nonpoor'),"help_fee"] = fraction_inside * agg_to_event_level(cats_event_iah.query("income_cat=='nonpoor'"),"help_received")
 
         else:
-            print("did not know how to finance the PDS")
+            logger.warning("did not know how to finance the PDS")
 
     else:
-        print("unrecognised optionPDS treated as no")
+        logger.warning("unrecognised optionPDS treated as no")
 
 
     return macro_event, cats_event_iah
@@ -565,8 +937,14 @@ def compute_response(macro_event, cats_event_ia,  optionT="data", optionPDS="uni
 
 
 
-def calc_risk_and_resilience_from_k_w(df, is_local_welfare):
-    """Computes risk and resilience from dk, dw and protection. Line by line: multiple return periods or hazard is transparent to this function"""
+def calc_risk_and_resilience_from_k_w(df, is_local_welfare, outputs=None):
+    """Computes risk and resilience from dk, dw and protection. Line by line: multiple return periods or hazard is transparent to this function
+    outputs: optional list of the outputs needed, the others are not computed"""
+
+    required = required_outputs(outputs)
+
+    def needed(col):
+        return required is None or col in required
 
     df=df.copy()
 
@@ -586,26 +964,30 @@ def calc_risk_and_resilience_from_k_w(df, is_local_welfare):
     else:
         wprime =(welf(df["gdp_pc_pp_nat"]/rho+h,df["income_elast"])-welf(df["gdp_pc_pp_nat"]/rho-h,df["income_elast"]))/(2*h)
 
-    dWref   = wprime*df["dK"]
-
     #expected welfare loss (per family and total)
-    df["dWpc_currency"] = df["delta_W"]/wprime  #//df["protection"]
-    df["dWtot_currency"]=df["dWpc_currency"]*df["pop"];
+    if needed("dWpc_currency"):
+        df["dWpc_currency"] = df["delta_W"]/wprime  #//df["protection"]
+    if needed("dWtot_currency"):
+        df["dWtot_currency"]=df["dWpc_currency"]*df["pop"];
 
     #welfare loss (per family and total)
     #df["dWpc_currency"] = df["delta_W"]/wprime/df["protection"]
     #df["dWtot_currency"]=df["dWpc_currency"]*df["pop"];
 
     #Risk to welfare as percentage of local GDP
-    df["risk"]= df["dWpc_currency"]/(df["gdp_pc_pp"]);
+    if needed("risk"):
+        df["risk"]= df["dWpc_currency"]/(df["gdp_pc_pp"]);
 
     ############
     #SOCIO-ECONOMIC CAPACITY)
-    df["resilience"] =dWref/(df["delta_W"] );
+    if needed("resilience"):
+        dWref   = wprime*df["dK"]
+        df["resilience"] =dWref/(df["delta_W"] );
 
     ############
     #RISK TO ASSETS
-    df["risk_to_assets"]  =df.resilience* df.risk;
+    if needed("risk_to_assets"):
+        df["risk_to_assets"]  =df.resilience* df.risk;
 
     return df
 
@@ -647,7 +1029,10 @@ def agg_to_economy_level (df, seriesname):
     return (df[seriesname].T*df["n"]).T.sum(level=economy)
 
 
-def interpolate_rps(fa_ratios,protection_list):
+def interpolate_rps(fa_ratios,protection_list, ragged=False):
+    """interpolates fa_ratios (with rp as index level or as columns) to a grid of return periods that includes the data return periods and protection_list.
+    If ragged, protection_list is the protection of each economy (Series indexed by economy), each economy only gets its own protection in its grid,
+    and the result is always stacked on rp"""
 
     ###INPUT CHECKING
     if fa_ratios is None:
@@ -661,6 +1046,13 @@ def interpolate_rps(fa_ratios,protection_list):
         fa_ratios = fa_ratios.unstack("rp")
         flag_stack = True
 
+    if ragged:
+        protection = protection_list.squeeze() if type(protection_list)==pd.DataFrame else protection_list
+        if type(fa_ratios.columns)==pd.MultiIndex:
+            keys = fa_ratios.columns.get_level_values(0).unique()
+            return pd.concat({col:interpolate_rps(fa_ratios[col],protection, ragged=True) for col in  keys}, axis=1)
+        return interpolate_rps_ragged(fa_ratios, protection)
+
     if type(protection_list) in [pd.Series, pd.DataFrame]:
         protection_list=protection_list.squeeze().unique().tolist()
 
@@ -699,6 +1091,85 @@ def interpolate_rps(fa_ratios,protection_list):
     return fa_ratios_rps
 
 
+def ragged_rp_grid(protection, data_rps):
+    """return period grid of each economy: the data return periods plus the protection of the economy.
+    Returns (offsets, values): the grid of the i-th economy of protection is values[offsets[i]:offsets[i+1]] (sorted)"""
+
+    data_rps = np.unique(np.asarray(data_rps, dtype=float))
+    protection = np.asarray(protection, dtype=float)
+
+    #one line per economy with the data rps and the protection (marked as inf when already in the data, so it sorts last and is dropped)
+    grid = np.empty((len(protection), len(data_rps)+1))
+    grid[:, :-1] = data_rps
+    grid[:, -1] = np.where(np.in1d(protection, data_rps), np.inf, protection)
+    grid.sort(axis=1)
+
+    keep = np.isfinite(grid)
+    offsets = np.append(0, np.cumsum(keep.sum(axis=1)))
+
+    return offsets, grid[keep]
+
+
+def interpolate_rps_ragged(fa_ratios, protection):
+    """interpolates fa_ratios (one line per economy x hazard x ..., data return periods as columns) to the grid of each economy (see ragged_rp_grid).
+    Same interpolation as interpolate_rps: linear extrapolation to rp 0, linear interpolation, constant exposure on the right, no negative exposure.
+    Returns fa_ratios stacked on rp"""
+
+    fa_ratios_rps = fa_ratios.copy()
+
+    #extrapolates linear towards the 0 return period exposure  (this creates negative exposure that is tackled after interp) (mind the 0 rp when computing probas)
+    if len(fa_ratios_rps.columns)==1:
+        fa_ratios_rps[0] = fa_ratios_rps.squeeze()
+    else:
+        fa_ratios_rps[0]=fa_ratios_rps.iloc[:,0]- fa_ratios_rps.columns[0]*(
+        fa_ratios_rps.iloc[:,1]-fa_ratios_rps.iloc[:,0])/(
+        fa_ratios_rps.columns[1]-fa_ratios_rps.columns[0])
+    fa_ratios_rps = fa_ratios_rps.sort_index(axis=1)
+
+    x = fa_ratios_rps.columns.values.astype(float)
+    y = fa_ratios_rps.values.astype(float)
+
+    #grids per economy, then per line
+    codes, economies = pd.factorize(fa_ratios.index.get_level_values(economy))
+    offsets, values = ragged_rp_grid(protection.reindex(economies).values, fa_ratios.columns.values)
+    lens = np.diff(offsets)[codes]
+    line = np.repeat(np.arange(len(fa_ratios)), lens)
+    within = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    rp = values[np.repeat(offsets[:-1][codes], lens) + within]
+
+    #linear interpolation (nan outside of the data, like interp1d)
+    j = np.clip(np.searchsorted(x, rp, side="right") - 1, 0, len(x) - 2)
+    fa = y[line, j] + (y[line, j+1] - y[line, j]) * (rp - x[j]) / (x[j+1] - x[j])
+    fa[(rp < x[0]) | (rp > x[-1])] = np.nan
+
+    #no negative exposure, constant exposure on the right
+    fa = pd.Series(fa).clip(lower=0).groupby(line).fillna(method="pad").values
+
+    idx = fa_ratios.index[line]
+    index = pd.MultiIndex.from_arrays([idx.get_level_values(i) for i in range(idx.nlevels)] + [rp], names=get_list_of_index_names(fa_ratios) + ["rp"])
+
+    return pd.Series(fa, index=index).sort_index()
+
+
+def rp_probabilities(rp, groups):
+    """probability of events of return period rp, within groups of events (arrays of same length, one group per economy, hazard, ...):
+    1/rp-1/rp_next, where rp_next is the next return period of the group (1/rp for the largest). Groups can have different return periods"""
+
+    rp = np.asarray(rp, dtype=float)
+    groups = np.asarray(groups)
+
+    order = np.lexsort((rp, groups))
+    rp_sorted = rp[order]
+    group_sorted = groups[order]
+
+    rp_next = np.append(rp_sorted[1:], np.inf)
+    rp_next[np.append(group_sorted[1:] != group_sorted[:-1], True)] = np.inf
+
+    proba = np.empty(len(rp))
+    proba[order] = 1/rp_sorted - 1/rp_next
+    return proba
+
+
 def average_over_rp(df,protection=None):
     """Aggregation of the outputs over return periods"""
 
@@ -708,7 +1179,7 @@ def average_over_rp(df,protection=None):
     #does nothing if df does not contain data on return periods
     try:
         if "rp" not in df.index.names:
-            print("rp was not in df")
+            logger.debug("rp was not in df")
             return df
     except(TypeError):
         pass
@@ -722,22 +1193,17 @@ def average_over_rp(df,protection=None):
     df=df.copy().reset_index("rp")
     protection=protection.copy().reset_index("rp",drop=True)
 
-    #computes probability of each return period
-    return_periods=np.unique(df["rp"].dropna())
-
-    proba = pd.Series(np.diff(np.append(1/return_periods,0)[::-1])[::-1],index=return_periods) #removes 0 from the rps
-
-    #matches return periods and their probability
-    proba_serie=df["rp"].replace(proba)
-
-    #removes events below the protection level
-    proba_serie[protection>df.rp] =0
-
     #handles cases with multi index and single index (works around pandas limitation)
     idxlevels = list(range(df.index.nlevels))
     if idxlevels==[0]:
         idxlevels =0
 
+    #computes probability of each return period, from the return periods of each economy and hazard (which may differ, see ragged_rps)
+    proba_serie = pd.Series(rp_probabilities(df["rp"], df.groupby(level=idxlevels).ngroup()), index=df.index)
+
+    #removes events below the protection level
+    proba_serie[protection>df.rp] =0
+
     #average weighted by proba
     averaged = df.mul(proba_serie,axis=0).sum(level=idxlevels) # obsolete .div(proba_serie.sum(level=idxlevels),axis=0)
 
@@ -794,7 +1260,8 @@ def unpack(v,pv,fa,pe,ph,share1):
 
     return v_p,v_r, fap_ref, far_ref, cp_ref, cr_ref
 
-def compute_v_fa(df):
+def compute_v_fa(df, ph=0.2):
+    """v, pv, fa, pe from the exposure and vulnerability of poor and nonpoor (inverse of unpack). ph: share of poor people"""
 
     fap = df["fap"]
     far = df["far"]
@@ -802,8 +1269,6 @@ def compute_v_fa(df):
     vp = df.v_p
     vr=df.v_r
 
-    ph = 0.2#df["pov_head"]
-
     cp=    df["gdp_pc_pp"]*df["share1"]/ph
     cr= df["gdp_pc_pp"]*(1-df["share1"])/(1-ph)
 
@@ -822,7 +1287,8 @@ def compute_v_fa(df):
 
 
 
-def compute_resilience_from_packed_inputs(df) :
+def unpack_packed_inputs(df) :
+    """splits a packed input frame (one line per economy) into macro, cat_info and hazard_ratios"""
 
     df=df.copy()
     ##MACRO
@@ -864,18 +1330,38 @@ def compute_resilience_from_packed_inputs(df) :
     #no EW for earthquake
     hazard_ratios["shew"]=hazard_ratios.shew.unstack("hazard").assign(earthquake=0).stack("hazard").reset_index().set_index(["name", "hazard","income_cat"])
 
+    return macro, cat_info, hazard_ratios
+
+
+def compute_resilience_from_packed_inputs(df, scenarios=None, **kwargs) :
+    """runs compute_resilience on a packed input frame. kwargs are passed to compute_resilience.
+    scenarios: optional multipliers of fa (one row per scenario, one column per hazard, see scale_hazard_ratios).
+    The rows of df are then repeated for every scenario and indexed by (economy, scenario)"""
+
+    df=df.copy()
+
+    macro, cat_info, hazard_ratios = unpack_packed_inputs(df)
+
+    if scenarios is not None:
+        hazard_ratios = scale_hazard_ratios(hazard_ratios, scenarios)
+
     #ACTUALLY DO THE THING
-    out = compute_resilience(macro, cat_info, hazard_ratios)
+    out = compute_resilience(macro, cat_info, hazard_ratios, **kwargs)
+
+    if scenarios is not None:
+        df = df.ix[out.index.get_level_values(economy)]
+        df.index = out.index
 
-    df[["risk","resilience","risk_to_assets"]] = out[["risk","resilience","risk_to_assets"]]
+    outputs = [c for c in ["risk","resilience","risk_to_assets"] if c in out]
+    df[outputs] = out[outputs]
 
     return df
 
 #sesha adding this new function
 #Alternative to above function but with adjusted macro, cat_info when scorecard policy calculations kick in
-def compute_resilience_from_adjusted_inputs_for_pol(df, macro, cat_info, hazard_ratios,optionPDS,optionFee) :
+def compute_resilience_from_adjusted_inputs_for_pol(df, macro, cat_info, hazard_ratios,optionPDS,optionFee, **kwargs) :
     # ACTUALLY DO THE THING
-    out = compute_resilience(macro, cat_info, hazard_ratios,optionPDS=optionPDS,optionFee=optionFee)
+    out = compute_resilience(macro, cat_info, hazard_ratios,optionPDS=optionPDS,optionFee=optionFee, **kwargs)
     df2 = df.copy()
 
     #Add these new columns for scorecard metrics output
@@ -886,7 +1372,9 @@ def compute_resilience_from_adjusted_inputs_for_pol(df, macro, cat_info, hazard_
     df2["dWpc_currency"] = 0.0
     df2["dWtot_currency"] = 0.0
 
-    df2[["risk", "resilience", "risk_to_assets","dK","dKtot","delta_W","delta_W_tot","dWpc_currency","dWtot_currency"]] = out[["risk", "resilience", "risk_to_assets","dK","dKtot","delta_W","delta_W_tot","dWpc_currency","dWtot_currency"]]
+    #only the outputs computed (see outputs argument of compute_resilience)
+    outputs = [c for c in ["risk", "resilience", "risk_to_assets","dK","dKtot","delta_W","delta_W_tot","dWpc_currency","dWtot_currency"] if c in out]
+    df2[outputs] = out[outputs]
 
     #return this dataframe with metrics calculated for a spedific policy
     return df2
@@ -0,0 +1,549 @@
+# -*- coding: UTF-8 -*-
+"""Numpy implementation of the resilience model, prepared once per input schema.
+
+A ResilienceEngine is prepared from a packed input frame: column names are
+parsed into macro, category and hazard positions, and the hazard and income
+layout is fixed. run(values) then only gathers columns from a float array
+and does the arithmetic of compute_resilience, like a prepared statement.
+The engine follows res_ind_lib for packed inputs (hazard ratios without
+return periods) and is registered as the "numpy" engine, so conformance.py
+can check it against the reference. The per-event arrays (economy x hazard
+x income x affected x helped) are computed in place into workspace buffers
+kept per engine and thread, so repeated runs do not allocate them again.
+
+    engine = ResilienceEngine(df, optionPDS="unif_poor")
+    out = engine.run(df.values)   #dict of arrays, one value per economy
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from packed_schema import column_kind
+from res_ind_lib import default_response_options, economy, fold_scenarios, has_scenarios, scale_hazard_ratios, unfold_scenarios, unpack_packed_inputs
+
+#outputs of compute_resilience at event level (averaged over return periods and summed over hazards)
+EVENT_OUTPUTS = ["dK", "dKtot", "delta_W", "delta_W_tot", "average_aid_cost_pc"]
+
+#outputs at economy level
+ECONOMY_OUTPUTS = ["dWpc_currency", "dWtot_currency", "risk", "resilience", "risk_to_assets"]
+
+#macro columns updated by the model
+MACRO_OUTPUTS = ["gdp_pc_pp", "tau_tax", "macro_multiplier"]
+
+LOSS_MEASURES = ["dk", "dc", "dc_npv_pre"]
+
+#packed columns that are outputs of previous runs, not inputs
+PACKED_OUTPUTS = ["risk", "resilience", "risk_to_assets"]
+
+#prepared engines: key -> ResilienceEngine
+_prepared = dict()
+_prepared_lock = threading.Lock()
+MAX_PREPARED = 16
+
+
+def welf(c, elast, out=None):
+    """Welfare function (computed into out when given)"""
+    if out is None:
+        return (c**(1-elast)-1)/(1-elast)
+    np.power(c, 1-elast, out=out)
+    np.subtract(out, 1, out=out)
+    return np.divide(out, 1-elast, out=out)
+
+
+def _sum(a, axis):
+    #sums skip nans, like pandas sums over index levels
+    return np.nansum(a, axis=axis)
+
+
+class Workspace():
+    """Buffers reused across runs: get(name, shape) returns the buffer of name, allocated again only when its shape changes.
+    Buffers are overwritten by the next run, and a workspace is used by one thread at a time"""
+
+    def __init__(self):
+        self.buffers = dict()
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=float):
+        a = self.buffers.get(name)
+        if a is None or a.shape != shape or a.dtype != dtype:
+            a = self.buffers[name] = np.empty(shape, dtype=dtype)
+            self.allocations += 1
+        return a
+
+
+def _product_sum(ws, a, b, axis, keep=None):
+    """_sum of a*b over axis, computed in a buffer of ws whose nans are zeroed in place (np.nansum zeroes them in a copy).
+    keep: optional boolean mask of the income categories (axis 2) to sum"""
+    shape = np.broadcast(a, b).shape
+    product = np.multiply(a, b, out=ws.get("product{}".format(len(shape)), shape))
+    np.copyto(product, 0, where=np.isnan(product, out=ws.get("nan{}".format(len(shape)), shape, dtype=bool)))
+    if keep is not None:
+        np.copyto(product, 0, where=~keep.reshape((1, 1, -1) + (1,)*(len(shape)-3)))
+    return product.sum(axis=axis)
+
+
+def _clip(a, upper):
+    #like pandas clip(upper=): nan values and nan thresholds are left as they are
+    return np.where(a > upper, upper, a)
+
+
+def _targeting(optionT, fa_event, prepare_scaleup, n_ia, out):
+    """n of each (economy, hazard, income, affected, helped) category for targeting option optionT (see res_ind_lib.compute_targeting),
+    computed into out"""
+
+    ps = prepare_scaleup[:, None]
+    zeros = np.zeros_like(fa_event)
+    if optionT == "perfect":
+        incl, excl = zeros, zeros
+    elif optionT == "data":
+        incl, excl = (1-ps)/2*fa_event/(1-fa_event), zeros + (1-ps)/2
+    elif optionT == "x33":
+        incl, excl = .33*fa_event/(1-fa_event), zeros + .33
+    elif optionT == "incl":
+        incl, excl = .33*fa_event/(1-fa_event), zeros
+    elif optionT == "excl":
+        incl, excl = zeros, zeros + .33
+    else:
+        raise ValueError("unrecognized targeting error option {}".format(optionT))
+
+    incl, excl = incl[:, :, None], excl[:, :, None]
+    n_a, n_na = n_ia[..., 0], n_ia[..., 1]
+
+    n = out
+    np.multiply(n_a, 1-excl, out=n[..., 0, 0])
+    np.multiply(n_a, excl, out=n[..., 0, 1])
+    np.multiply(n_na, incl, out=n[..., 1, 0])
+    np.multiply(n_na, 1-incl, out=n[..., 1, 1])
+    return n
+
+
+def _response(n, loss, k, poor, gdp, shareable, max_aid, prepare_scaleup, borrow_abi, optionPDS, optionB, optionFee, fraction_inside, ws, name="response"):
+    """need, aid (economy x hazard), help_received and help_fee (economy x hazard x income x affected x helped), as in res_ind_lib.compute_response.
+    n and loss are per category, need is None when compute_response does not set it.
+    help_received and help_fee are computed into the buffers name_help_received and name_help_fee of the workspace ws"""
+
+    shape = n.shape[:2]
+    need, aid = None, None
+
+    def agg_need(poor_only):
+        return _product_sum(ws, n[:, :, :, 0, :], loss[:, :, :, 0, None], (2, 3), keep=poor if poor_only else None)
+
+    def helped(values):
+        out = ws.get(name + "_help_received", n.shape)
+        out[..., 1] = 0
+        out[..., 0] = values
+        return out
+
+    def zeros(buffer):
+        out = ws.get(name + "_" + buffer, n.shape)
+        out[...] = 0
+        return out
+
+    def fee_prorata(total):
+        return fraction_inside*total[:, :, None, None, None]*k/_product_sum(ws, n, k, (2, 3, 4))[:, :, None, None, None]
+
+    if optionB == "unif_poor":
+        need = shareable*agg_need(True)
+        aid = _clip(need, max_aid)
+    elif optionB == "one_per_affected":
+        need = _product_sum(ws, n[:, :, :, 0, :], 1, (2, 3))
+        aid = need
+    elif optionB == "one":
+        aid = np.ones(shape)
+    elif optionB == "x10":
+        aid = np.broadcast_to(0.1*gdp, shape)
+    elif optionB == "x05":
+        aid = np.broadcast_to(0.05*gdp, shape)
+    elif optionB == "max01":
+        max_aid = 0.01*gdp
+    elif optionB == "max05":
+        max_aid = 0.05*gdp
+    elif optionB == "unlimited":
+        need = shareable*agg_need(False)
+        aid = need
+
+    if optionPDS == "no":
+        aid = np.zeros(shape)
+        help_received = zeros("help_received")
+        help_fee = zeros("help_fee")
+
+    elif optionPDS in ["unif_all", "unif_poor"]:
+        need = shareable*agg_need(optionPDS == "unif_poor")
+        if optionB == "data":
+            aid = _clip(need*prepare_scaleup*borrow_abi, max_aid)
+        elif optionB in ["max01", "max05"]:
+            aid = _clip(need, max_aid)
+        if aid is None:
+            raise KeyError("aid")
+
+        unif_aid = aid/_product_sum(ws, n[..., 0], 1, (2, 3))
+        help_received = helped(unif_aid[:, :, None, None])
+        help_fee = fee_prorata(aid)
+
+    elif optionPDS in ["one", "hundred"]:
+        unif_aid = np.ones(shape) if optionPDS == "one" else np.broadcast_to(gdp, shape)
+        help_received = helped(unif_aid[:, :, None, None])
+        need = _product_sum(ws, n, help_received, (2, 3, 4))
+        aid = need
+        help_fee = fee_prorata(aid)
+
+    elif optionPDS in ["prop", "perfect", "prop_nonpoor"]:
+        #needs per income category (sum over helped and not helped lines of the affected, as in res_ind_lib)
+        need_cat = 2*loss[:, :, :, 0]
+        if optionPDS == "prop_nonpoor":
+            need_cat = np.where(poor, 0, need_cat)
+
+        need = shareable*_product_sum(ws, n[..., 0], need_cat[:, :, :, None], (2, 3))
+
+        if optionB == "data":
+            aid = _clip(need*prepare_scaleup*borrow_abi, max_aid)
+        elif optionB in ["max01", "max05"]:
+            aid = _clip(need, max_aid)
+        if aid is None:
+            raise KeyError("aid")
+
+        help_received = helped((shareable[:, :, None]*need_cat*(aid/need)[:, :, None])[:, :, :, None])
+
+        if optionFee == "tax":
+            help_fee = fee_prorata(_product_sum(ws, n, help_received, (2, 3, 4)))
+        elif optionFee == "insurance_premium":
+            help_fee = np.broadcast_to(fraction_inside*_product_sum(ws, n, help_received, (3, 4))[:, :, :, None, None], n.shape)
+        else:
+            raise ValueError("did not know how to finance the PDS with {}".format(optionFee))
+
+    else:
+        raise ValueError("unrecognised optionPDS {}".format(optionPDS))
+
+    return need, np.broadcast_to(aid, shape), help_received, help_fee
+
+
+def compute_arrays(macro, cat, fa, shew, poor, optionT="data", optionPDS="unif_poor", optionB="data", optionFee="tax", loss_measure="dk", fraction_inside=1, share_insured=.25, is_local_welfare=True, workspace=None, profiler=None):
+    """Outputs of compute_resilience from arrays.
+    macro: dict of economy level arrays (as the columns of macro), cat: dict of economy x income arrays (as the columns of cat_info),
+    fa and shew: economy x hazard x income exposure and early warning, poor: boolean array marking the poor income category.
+    workspace: Workspace holding the per-event arrays (a new one if not given).
+    profiler: optional memory_profile.MemoryProfiler recording memory use at each stage.
+    Returns a dict of economy level arrays (MACRO_OUTPUTS, EVENT_OUTPUTS and ECONOMY_OUTPUTS)"""
+
+    if not is_local_welfare:
+        raise NotImplementedError("the numpy engine only computes local welfare")
+    if loss_measure not in LOSS_MEASURES:
+        raise ValueError("loss_measure should be one of " + ", ".join(LOSS_MEASURES))
+    ws = Workspace() if workspace is None else workspace
+
+    with np.errstate(all="ignore"):
+
+        ##consistency of income, gdp, etc. (see res_ind_lib.harmonize_inputs)
+        apk = macro["avg_prod_k"]
+        n, c = cat["n"], cat["c"]
+        gdp = apk*_sum(n*cat["k"], 1)
+        social = cat["gamma_SP"]*(gdp*macro["tau_tax"])[:, None]/c + 0.1*cat["axfin"]
+        tau = _sum(social*c*n, 1)/_sum(c*n, 1)
+        gamma = social*c/_sum(social*c*n, 1)[:, None]
+        k = (c/apk[:, None])*((1-social)/(1-tau[:, None]))
+        gdp = apk*_sum(n*k, 1)
+
+        #macro multiplier
+        recons_rate = np.log(1/0.05)/macro["T_rebuild_K"]
+        macro_multiplier = (apk+recons_rate)/(macro["rho"]+recons_rate)
+
+        ##losses before response: economy x hazard x income x affected
+        #computed in place, same operations in the same order as the reference
+        shape_ia = fa.shape + (2,)
+        shape_iah = shape_ia + (2,)
+        tmp_ia = ws.get("tmp_ia", shape_ia)
+        n_e = n[:, None, :]
+        n_ia = ws.get("n_ia", shape_ia)
+        np.multiply(n_e, fa, out=n_ia[..., 0])
+        np.subtract(1, fa, out=n_ia[..., 1])
+        np.multiply(n_e, n_ia[..., 1], out=n_ia[..., 1])
+
+        v_shew = ws.get("v_shew", fa.shape)
+        np.multiply(macro["pi"][:, None, None], shew, out=v_shew)
+        np.subtract(1, v_shew, out=v_shew)
+        np.multiply(cat["v"][:, None, :], v_shew, out=v_shew)
+
+        dk = ws.get("dk", shape_ia)
+        np.multiply(k[:, None, :], v_shew, out=dk[..., 0])
+        dk[..., 1] = 0
+        dk_event = _product_sum(ws, n_ia, dk, (2, 3))
+
+        tau_ia = tau[:, None, None, None]
+        dc = ws.get("dc", shape_ia)
+        np.multiply(1-tau_ia, dk, out=dc)
+        np.multiply(gamma[:, None, :, None]*tau_ia, dk_event[:, :, None, None], out=tmp_ia)
+        np.add(dc, tmp_ia, out=dc)
+        dc_npv_pre = np.multiply(dc, macro_multiplier[:, None, None, None], out=ws.get("dc_npv_pre", shape_ia))
+        losses = dict(dk=dk, dc=dc, dc_npv_pre=dc_npv_pre)
+        if profiler is not None:
+            profiler.stage("losses_before_response", n_ia=n_ia, v_shew=v_shew, **losses)
+
+        ##response
+        fa_event = _product_sum(ws, n_ia, fa[..., None], (2, 3))
+        targetings = dict()
+
+        def targeting(optionT):
+            if optionT not in targetings:
+                targetings[optionT] = _targeting(optionT, fa_event, macro["prepare_scaleup"], n_ia, ws.get("n_iah_" + optionT, shape_iah))
+            return targetings[optionT]
+
+        k_iah = k[:, None, :, None, None]
+        max_aid = (macro["max_increased_spending"]*macro["borrow_abi"]*gdp)[:, None]
+        event = dict(k=k_iah, poor=poor, gdp=gdp[:, None], max_aid=max_aid,
+                     prepare_scaleup=macro["prepare_scaleup"][:, None], borrow_abi=macro["borrow_abi"][:, None], ws=ws)
+        shareable = np.broadcast_to(macro["shareable"][:, None], fa_event.shape)
+
+        if optionFee != "insurance_premium":
+            need, aid, help_received, help_fee = _response(targeting(optionT), losses[loss_measure], shareable=shareable, optionPDS=optionPDS,
+                                                           optionB=optionB, optionFee=optionFee, fraction_inside=fraction_inside, **event)
+        else:
+            #default PDS from data plus insurance
+            need_d, aid_d, help_received_d, help_fee_d = _response(targeting("data"), dk, shareable=shareable, optionPDS="unif_poor",
+                                                                   optionB="data", optionFee="tax", fraction_inside=1, name="pds", **event)
+            need, aid, help_received, help_fee = _response(targeting(optionT), losses[loss_measure], shareable=np.full(fa_event.shape, share_insured),
+                                                           optionPDS=optionPDS, optionB=optionB, optionFee=optionFee, fraction_inside=fraction_inside, **event)
+            if need is None:
+                raise KeyError("need")
+            aid = aid + aid_d
+            help_received = np.add(help_received, help_received_d, out=ws.get("help_received", shape_iah))
+            help_fee = np.add(help_fee, help_fee_d, out=ws.get("help_fee", np.broadcast(help_fee, help_fee_d).shape))
+
+        n_iah = targeting(optionT)
+
+        ##welfare
+        dc_npv_post = np.subtract(dc_npv_pre[..., None], help_received, out=ws.get("dc_npv_post", shape_iah))
+        np.add(dc_npv_post, help_fee, out=dc_npv_post)
+        c_iah = c[:, None, :, None, None]
+        rho = macro["rho"][:, None, None, None, None]
+        elast = macro["income_elast"][:, None, None, None, None]
+        c_rho = np.divide(c_iah, rho, out=ws.get("c_rho", np.broadcast(c_iah, rho).shape))
+        dw = np.subtract(c_rho, dc_npv_post, out=ws.get("dw", shape_iah))
+        welf(dw, elast, out=dw)
+        np.subtract(welf(c_rho, elast, out=ws.get("welf_c", c_rho.shape)), dw, out=dw)
+
+        pop = macro["pop"][:, None]
+        dK = _product_sum(ws, n_iah, dk[..., None], (2, 3, 4))
+        delta_W = _product_sum(ws, n_iah, dw, (2, 3, 4))
+        if profiler is not None:
+            profiler.stage("welfare", n_iah=n_iah, help_received=help_received, help_fee=help_fee, dc_npv_post=dc_npv_post, dw=dw)
+        event_out = dict(dK=dK, dKtot=dK*pop, delta_W=delta_W, delta_W_tot=delta_W*pop, average_aid_cost_pc=aid)
+
+        ##aggregates: single return period, divided by protection as in res_ind_lib.average_over_rp
+        protection = macro["protection"][:, None]
+        out = dict(gdp_pc_pp=gdp, tau_tax=tau, macro_multiplier=macro_multiplier)
+        for col in EVENT_OUTPUTS:
+            out[col] = _sum(event_out[col]/protection, 1)
+
+        h = 1e-4
+        x = gdp/macro["rho"]
+        wprime = (welf(x+h, macro["income_elast"])-welf(x-h, macro["income_elast"]))/(2*h)
+        out["dWpc_currency"] = out["delta_W"]/wprime
+        out["dWtot_currency"] = out["dWpc_currency"]*macro["pop"]
+        out["risk"] = out["dWpc_currency"]/gdp
+        out["resilience"] = wprime*out["dK"]/out["delta_W"]
+        out["risk_to_assets"] = out["resilience"]*out["risk"]
+
+    return out
+
+
+def _check_options(options):
+    unsupported = [o for o in ["return_iah", "return_stats", "ragged_rps", "verbose_replace", "breakdown", "breakdown_levels"] if options.pop(o, None)]
+    if unsupported:
+        raise NotImplementedError("the numpy engine does not support " + ", ".join(unsupported))
+    return options
+
+
+class ResilienceEngine():
+    """Resilience model prepared for the schema (numeric columns) and economies (index) of a packed input frame.
+    Options are those of compute_resilience"""
+
+    def __init__(self, template, outputs=None, **options):
+        self.options = dict(default_response_options, **_check_options(dict(options)))
+        self.outputs = outputs
+        self.index = template.index
+        self.columns = [c for c in template.columns if column_kind(c) == "numeric" and c not in PACKED_OUTPUTS]
+        pos = {c: i for i, c in enumerate(self.columns)}
+
+        self.macro_idx = {c.replace("macro_", ""): pos[c] for c in self.columns if "macro" in c}
+
+        cat_cols = [c.replace("cat_info_", "").split("__") for c in self.columns if "cat_info" in c]
+        self.incomes = sorted(set(i for _, i in cat_cols))
+        self.cat_idx = {var: np.array([pos["{}_cat_info__{}".format(var, i)] for i in self.incomes]) for var in sorted(set(v for v, _ in cat_cols))}
+        self.poor = np.array([i == "poor" for i in self.incomes])
+
+        #hazard ratios as in res_ind_lib.unpack_packed_inputs
+        self.hazards = sorted(c.replace("hazard_ratio_fa__", "") for c in self.columns if "hazard_ratio_fa" in c)
+        self.fa_idx = np.array([[pos["hazard_ratio_fa__" + h]]*len(self.incomes) for h in self.hazards])
+        self.flood, self.surge = self.hazards.index("flood"), self.hazards.index("surge")
+        self.poor_i = self.incomes.index("poor")
+        self.flood_poor_col, self.ratio_surge_col = pos["hazard_ratio_flood_poor"], pos["ratio_surge_flood"]
+        self.shew_col = pos["shew_for_hazard_ratio"]
+        self.shew_mask = np.array([h != "earthquake" for h in self.hazards], dtype=float)[None, :, None]
+
+        #economies with missing values are dropped by the reference: their outputs are nan
+        self._local = threading.local()
+        self.used = np.array(sorted(set(self.macro_idx.values()) | set(np.concatenate(list(self.cat_idx.values())))
+                                    | set(self.fa_idx.ravel()) | {self.flood_poor_col, self.ratio_surge_col, self.shew_col}))
+
+    def workspace(self):
+        """Workspace of the calling thread: runs of the engine from several threads do not share buffers"""
+        ws = getattr(self._local, "workspace", None)
+        if ws is None:
+            ws = self._local.workspace = Workspace()
+        return ws
+
+    def values(self, df):
+        """float array of the numeric inputs of df (same economies and schema as the template)"""
+        return df[self.columns].values.astype(float)
+
+    def run(self, values, profiler=None):
+        """outputs (dict of arrays, one value per economy) for values, a float array with the template's economies as lines
+        and self.columns as columns (or a packed input DataFrame). profiler: optional MemoryProfiler"""
+
+        if isinstance(values, pd.DataFrame):
+            values = self.values(values)
+        values = np.asarray(values, dtype=float)
+
+        macro = {name: values[:, i] for name, i in self.macro_idx.items()}
+        cat = {var: values[:, idx] for var, idx in self.cat_idx.items()}
+
+        ws = self.workspace()
+        fa = np.take(values, self.fa_idx, axis=1, out=ws.get("fa", (len(values),) + self.fa_idx.shape))
+        fa[:, self.flood, self.poor_i] = values[:, self.flood_poor_col]
+        np.multiply(fa[:, self.flood, :], values[:, self.ratio_surge_col, None], out=fa[:, self.surge, :])
+        shew = np.multiply(values[:, self.shew_col, None, None], self.shew_mask, out=ws.get("shew", fa.shape))
+
+        out = compute_arrays(macro, cat, fa, shew, self.poor, workspace=ws, profiler=profiler, **self.options)
+
+        missing = np.isnan(values[:, self.used]).any(axis=1)
+        if missing.any():
+            for v in out.values():
+                v[missing] = np.nan
+
+        if self.outputs is not None:
+            out = {c: v for c, v in out.items() if c in self.outputs}
+        return out
+
+    def run_frame(self, df, profiler=None):
+        """same as res_ind_lib.compute_resilience_from_packed_inputs"""
+        out = self.run(df, profiler=profiler)
+        df = df.copy()
+        for col in PACKED_OUTPUTS:
+            if col in out:
+                df[col] = out[col]
+        return df
+
+
+def prepare(template, **options):
+    """ResilienceEngine for the schema and economies of template, reused across calls"""
+
+    key = (tuple(template.columns), tuple(template.index), tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in options.items())))
+    with _prepared_lock:
+        engine = _prepared.get(key)
+    if engine is None:
+        #prepared outside of the lock: two threads may prepare the same engine, both are equivalent
+        engine = ResilienceEngine(template, **options)
+        with _prepared_lock:
+            if len(_prepared) >= MAX_PREPARED:
+                _prepared.pop(next(iter(_prepared)))
+            _prepared[key] = engine
+    return engine
+
+
+def arrays_from_frames(macro, cat_info, hazard_ratios=None):
+    """(economies, macro, cat, fa, shew, poor) arrays for compute_arrays from the frames taken by compute_resilience
+    (economies are dropped as in res_ind_lib.clean_inputs and harmonize_inputs)"""
+
+    macro = macro.dropna()
+    cat_info = cat_info.dropna()
+    if isinstance(hazard_ratios, pd.DataFrame):
+        hazard_ratios = hazard_ratios.dropna()
+        if hazard_ratios.empty:
+            hazard_ratios = None
+    if hazard_ratios is not None and not isinstance(hazard_ratios, pd.DataFrame):
+        raise NotImplementedError("the numpy engine takes hazard ratios as a DataFrame")
+    if hazard_ratios is not None and "rp" in hazard_ratios.index.names:
+        raise NotImplementedError("the numpy engine does not handle hazard data with return periods")
+
+    cats = cat_info.unstack("income_cat")
+    incomes = sorted(cat_info.index.get_level_values("income_cat").unique())
+    economies = [e for e in macro.index if e in cats.index and (hazard_ratios is None or e in hazard_ratios.index.get_level_values(economy))]
+
+    cats = cats.reindex(economies)
+    cat = {var: cats[var].reindex(columns=incomes).values.astype(float) for var in cat_info.columns}
+    m = {col: macro.loc[economies, col].values.astype(float) for col in macro.columns}
+
+    if hazard_ratios is None or "hazard" not in hazard_ratios.index.names:
+        hazards = ["default_hazard"]
+    else:
+        hazards = sorted(hazard_ratios.index.get_level_values("hazard").unique())
+
+    arrays = dict()
+    for col in ["fa", "shew"]:
+        if hazard_ratios is None or col not in hazard_ratios:
+            arrays[col] = np.repeat(cat[col][:, None, :], len(hazards), axis=1)
+            continue
+        s = hazard_ratios[col]
+        if "hazard" not in s.index.names:
+            s = pd.concat({hazards[0]: s}, names=["hazard"]).reorder_levels(s.index.names[:1] + ["hazard"] + s.index.names[1:])
+        if "income_cat" in s.index.names:
+            a = s.unstack(["hazard", "income_cat"]).reindex(index=economies, columns=pd.MultiIndex.from_product([hazards, incomes]))
+            arrays[col] = a.values.astype(float).reshape(len(economies), len(hazards), len(incomes))
+        else:
+            a = s.unstack("hazard").reindex(index=economies, columns=hazards)
+            arrays[col] = np.repeat(a.values.astype(float)[:, :, None], len(incomes), axis=2)
+
+    return economies, m, cat, arrays["fa"], arrays["shew"], np.array([i == "poor" for i in incomes])
+
+
+def compute_resilience(df_in, cat_info, hazard_ratios=None, outputs=None, **options):
+    """same as res_ind_lib.compute_resilience for hazard ratios without return periods"""
+
+    if has_scenarios(hazard_ratios):
+        #scenarios are computed as economies
+        out = compute_resilience(*fold_scenarios(df_in.dropna(), cat_info.dropna(), hazard_ratios.dropna()), outputs=outputs, **options)
+        return unfold_scenarios(out)
+
+    options = dict(default_response_options, **_check_options(dict(options)))
+    economies, macro, cat, fa, shew, poor = arrays_from_frames(df_in, cat_info, hazard_ratios)
+    res = compute_arrays(macro, cat, fa, shew, poor, **options)
+
+    out = df_in.loc[economies].copy()
+    for col in MACRO_OUTPUTS + EVENT_OUTPUTS + ECONOMY_OUTPUTS:
+        out[col] = res[col]
+
+    if outputs is not None:
+        out = out[[c for c in outputs if c in out]]
+    return out
+
+
+def compute_resilience_from_packed_inputs(df, scenarios=None, profiler=None, **options):
+    """same as res_ind_lib.compute_resilience_from_packed_inputs, with an engine prepared once per schema and economies"""
+
+    if scenarios is None:
+        return prepare(df, **options).run_frame(df, profiler=profiler)
+
+    macro, cat_info, hazard_ratios = unpack_packed_inputs(df.copy())
+    out = compute_resilience(macro, cat_info, scale_hazard_ratios(hazard_ratios, scenarios), profiler=profiler, **options)
+    df = df.loc[out.index.get_level_values(economy)]
+    df.index = out.index
+    for col in PACKED_OUTPUTS:
+        if col in out:
+            df[col] = out[col]
+    return df
+
+
+def compute_resilience_from_adjusted_inputs_for_pol(df, macro, cat_info, hazard_ratios, optionPDS, optionFee, **options):
+    """same as res_ind_lib_big.compute_resilience_from_adjusted_inputs_for_pol: outputs of the scorecard policy that
+    adjusted macro and cat_info, added to the packed inputs df"""
+
+    out = compute_resilience(macro, cat_info, hazard_ratios, optionPDS=optionPDS, optionFee=optionFee, **options)
+    df = df.copy()
+    for col in ["dK", "dKtot", "delta_W", "delta_W_tot", "dWpc_currency", "dWtot_currency"]:
+        df[col] = 0.0
+    for col in PACKED_OUTPUTS + ["dK", "dKtot", "delta_W", "delta_W_tot", "dWpc_currency", "dWtot_currency"]:
+        if col in out:
+            df[col] = out[col]
+    return df
@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Precomputed response surfaces of the model outputs over the viewer sliders.
+
+An offline stage evaluates, for every country, risk, resilience and
+risk_to_assets on a tensor-product grid of slider multipliers (one batched
+model run per chunk of grid points), and estimates the interpolation error
+at random off-grid points. At request time the surface is interpolated; the
+exact model is run instead when the query is outside the grid, moves inputs
+that are not sliders, or when the error bound exceeds the tolerance. Share
+columns scaled by a slider are clipped to [0,1].
+
+model_adapter answers single record requests from the surface saved at
+RESILIENCE_RESPONSE_SURFACE when it is set, and the request runs the
+packed inputs function of the engine the surface was built with.
+
+    python response_surface.py df_for_wrapper.csv model/response_surfaces.npz
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator
+
+from engines import REFERENCE_ENGINE, get_engine
+from packed_schema import SHARE_COLUMNS, column_kind, parse_csv
+
+logger = logging.getLogger(__name__)
+
+#slider -> packed columns it scales
+SLIDERS = {
+    "v": ["v_cat_info__poor", "v_cat_info__nonpoor"],
+    "fa": ["hazard_ratio_fa__earthquake", "hazard_ratio_fa__flood", "hazard_ratio_fa__surge", "hazard_ratio_fa__tsunami", "hazard_ratio_fa__wind", "hazard_ratio_flood_poor"],
+    "shew": ["shew_for_hazard_ratio"],
+    "axfin": ["axfin_cat_info__poor", "axfin_cat_info__nonpoor"],
+    "social": ["gamma_SP_cat_info__poor", "gamma_SP_cat_info__nonpoor"],
+    "T_rebuild_K": ["macro_T_rebuild_K"],
+}
+
+#range of the multipliers of each slider
+DEFAULT_RANGE = (0.5, 1.5)
+
+OUTPUTS = ["risk", "resilience", "risk_to_assets"]
+
+#the error bound is the largest error at check points times this factor
+SAFETY_FACTOR = 2.
+
+#loaded surfaces: path -> (modification time, ResponseSurface)
+_surfaces = dict()
+_surfaces_lock = threading.Lock()
+
+
+def apply_multipliers(df, multipliers, sliders):
+    """df (one line per economy) with the columns of each slider scaled by multipliers (array n_lines x n_sliders).
+    Shares are clipped to [0,1]"""
+    out = df.copy()
+    for j, slider in enumerate(sliders):
+        for col in SLIDERS[slider]:
+            if col in out:
+                out[col] = out[col] * multipliers[:, j]
+                if any(col.startswith(c) for c in SHARE_COLUMNS):
+                    out[col] = out[col].clip(0, 1)
+    return out
+
+
+def evaluate_points(df, points, sliders, model_function, chunksize=5000):
+    """model outputs for every economy of df at every point (array n_points x n_sliders of multipliers).
+    Points are evaluated in batched runs of about chunksize economies. Returns array n_economies x n_points x n_outputs"""
+
+    n_economies, n_points = len(df), len(points)
+    out = np.empty((n_economies, n_points, len(OUTPUTS)))
+
+    #lines are (economy, point), economy major
+    per_chunk = max(1, chunksize // n_economies)
+    for start in range(0, n_points, per_chunk):
+        chunk_points = points[start:start + per_chunk]
+        k = len(chunk_points)
+
+        batch = df.iloc[np.repeat(np.arange(n_economies), k)]
+        batch = apply_multipliers(batch, np.tile(chunk_points, (n_economies, 1)), sliders)
+        #unique names so that all points run in the same call
+        batch.index = pd.Index(["{}#{}".format(name, p) for name in df.index for p in range(start, start + k)], name=df.index.name)
+
+        res = model_function(batch)[OUTPUTS].values
+        out[:, start:start + k, :] = res.reshape(n_economies, k, len(OUTPUTS))
+        logger.debug('response surface: {}/{} points evaluated'.format(start + k, n_points))
+
+    return out
+
+
+class ResponseSurface():
+    """Model outputs on a grid of slider multipliers, for a set of economies."""
+
+    def __init__(self, names, sliders, grids, values, error_bounds, baseline, engine=REFERENCE_ENGINE):
+        self.names = list(names)
+        self.sliders = list(sliders)
+        self.grids = [np.asarray(g, dtype=float) for g in grids]
+        self.values = values              #n_economies x grid shape x n_outputs
+        self.error_bounds = error_bounds  #n_economies x n_outputs
+        self.baseline = baseline          #packed inputs the multipliers apply to
+        self.engine = engine              #engine the surface was computed with
+        self._position = {name: i for i, name in enumerate(self.names)}
+        #built once, so that a query only interpolates
+        self._interpolators = [RegularGridInterpolator(self.grids, v, bounds_error=False, fill_value=np.nan) for v in self.values]
+
+    @classmethod
+    def build(cls, df, sliders=None, ranges=None, points=3, engine=REFERENCE_ENGINE, n_check=20, chunksize=5000, seed=0):
+        """evaluates the model on the grid (points per slider, within ranges: slider -> (low, high) multipliers)
+        and estimates the error bound of each economy and output at n_check random points"""
+
+        sliders = list(SLIDERS) if sliders is None else list(sliders)
+        ranges = dict() if ranges is None else ranges
+        grids = [np.linspace(*ranges.get(s, DEFAULT_RANGE), num=points) for s in sliders]
+        model_function = get_engine(engine).compute_resilience_from_packed_inputs
+
+        grid_points = np.array(list(itertools.product(*grids)))
+        values = evaluate_points(df, grid_points, sliders, model_function, chunksize)
+        values = values.reshape((len(df),) + tuple(len(g) for g in grids) + (len(OUTPUTS),))
+
+        surface = cls(df.index, sliders, grids, values, np.zeros((len(df), len(OUTPUTS))), df, engine)
+
+        #error bound from random off-grid points
+        rng = np.random.RandomState(seed)
+        lows = np.array([g[0] for g in grids])
+        highs = np.array([g[-1] for g in grids])
+        check = lows + rng.uniform(size=(n_check, len(sliders))) * (highs - lows)
+        exact = evaluate_points(df, check, sliders, model_function, chunksize)
+        for i in range(len(df)):
+            approx = surface._interpolators[i](check)
+            err = np.abs(approx - exact[i])
+            surface.error_bounds[i] = SAFETY_FACTOR * np.nanmax(np.where(np.isnan(err), np.inf, err), axis=0)
+
+        return surface
+
+    def _interpolate(self, i, point):
+        return self._interpolators[i](np.asarray(point, dtype=float)[None, :])[0]
+
+    def serves(self, model_function):
+        """True if model_function is the packed inputs function of the engine of the surface"""
+        reference = get_engine(self.engine).compute_resilience_from_packed_inputs
+        return (getattr(model_function, "__module__", None), getattr(model_function, "__name__", None)) == (reference.__module__, reference.__name__)
+
+    def multipliers(self, record):
+        """slider multipliers matching record (Series of packed inputs) relative to the baseline of its economy,
+        or None if record changes other inputs or scales the columns of a slider unevenly"""
+
+        name = record.name
+        if name not in self._position:
+            return None
+        base = self.baseline.loc[name]
+
+        slider_cols = [c for s in self.sliders for c in SLIDERS[s]]
+        others = [c for c in record.index if c not in slider_cols and c in base.index and c not in OUTPUTS]
+        numeric = [c for c in others if column_kind(c) == "numeric"]
+        if not np.allclose(record[numeric].astype(float), base[numeric].astype(float), equal_nan=True):
+            return None
+        if any(record[c] != base[c] for c in others if c not in numeric):
+            return None
+
+        point = []
+        for s in self.sliders:
+            cols = [c for c in SLIDERS[s] if c in record.index and base[c] != 0]
+            ratios = np.array([record[c] / base[c] for c in cols], dtype=float)
+            if len(ratios) == 0:
+                point.append(1.)
+            elif np.allclose(ratios, ratios[0]):
+                point.append(ratios[0])
+            else:
+                return None
+        return np.array(point)
+
+    def interpolate(self, record, rtol=0.01):
+        """outputs for record (Series of packed inputs named after its economy) if the error bound of the
+        surface is within rtol of the value there, None otherwise"""
+
+        point = self.multipliers(record)
+        if point is None:
+            return None
+        i = self._position[record.name]
+        values = self._interpolate(i, point)
+        if np.isnan(values).any() or (self.error_bounds[i] > rtol * np.abs(values)).any():
+            return None
+        return dict(zip(OUTPUTS, values))
+
+    def evaluate(self, record, exact=None, rtol=0.01):
+        """outputs for record (Series of packed inputs named after its economy), interpolated if the error bound
+        is within rtol of the value, computed with exact(record) otherwise.
+        Returns (dict output -> value, True if exact)"""
+
+        values = self.interpolate(record, rtol)
+        if values is not None:
+            return values, False
+
+        if exact is None:
+            raise ValueError("query outside of the response surface of {} and no exact model given".format(record.name))
+        return dict(zip(OUTPUTS, exact(record))), True
+
+    def evaluate_frame(self, df, rtol=0.01):
+        """df (packed inputs) with the interpolated outputs, as compute_resilience_from_packed_inputs, or None if
+        an economy of df cannot be interpolated within rtol"""
+
+        out = df.copy()
+        for name in df.index:
+            values = self.interpolate(df.loc[name], rtol)
+            if values is None:
+                return None
+            for col, value in values.items():
+                out.loc[name, col] = value
+        return out
+
+    def save(self, path):
+        np.savez_compressed(path, names=np.array(self.names, dtype=object), sliders=np.array(self.sliders, dtype=object),
+                            grids=np.array(self.grids, dtype=object), values=self.values, error_bounds=self.error_bounds,
+                            baseline=self.baseline.reset_index().to_json().encode(), engine=np.array(self.engine))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=True)
+        baseline = pd.read_json(bytes(data["baseline"]).decode(), precise_float=True).set_index("name")
+        engine = str(data["engine"]) if "engine" in data else REFERENCE_ENGINE
+        return cls(data["names"], data["sliders"], list(data["grids"]), data["values"], data["error_bounds"], baseline, engine)
+
+
+def load_surface(path):
+    """ResponseSurface saved at path, loaded once per process and again when the file changes"""
+    mtime = os.path.getmtime(path)
+    with _surfaces_lock:
+        cached = _surfaces.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _surfaces[path] = (mtime, ResponseSurface.load(path))
+    return cached[1]
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Precompute response surfaces of the model over the viewer sliders.")
+    parser.add_argument('input', help='packed inputs csv (eg df_for_wrapper.csv)')
+    parser.add_argument('output', help='npz file to write the surfaces to')
+    parser.add_argument('--sliders', nargs='*', default=list(SLIDERS), choices=list(SLIDERS))
+    parser.add_argument('--points', type=int, default=3, help='grid points per slider')
+    parser.add_argument('--engine', default=REFERENCE_ENGINE)
+    parser.add_argument('--check', type=int, default=20, help='random points used to estimate the error bound')
+    args = parser.parse_args()
+
+    surface = ResponseSurface.build(parse_csv(args.input), sliders=args.sliders, points=args.points, engine=args.engine, n_check=args.check)
+    surface.save(args.output)
@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Local on-disk store of model results.
+
+Entries are keyed by the content hash of the inputs, the model module, the
+function name and a fingerprint of the source of the module and of every
+module of this repository it uses (directly or not), so results survive
+restarts and are invalidated as soon as the library code changes.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import importlib
+import inspect
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+#default location, next to model/model.log
+STORE_PATH = 'model/results.sqlite'
+
+#directory of the modules of this repository (model libraries, engines, adapters)
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#(source path, mtime) -> sha1 of the source, so files are only hashed when they change
+_fingerprints = {}
+
+
+def _file_fingerprint(path):
+    mtime = os.path.getmtime(path)
+    if (path, mtime) not in _fingerprints:
+        with open(path, 'rb') as f:
+            _fingerprints[(path, mtime)] = hashlib.sha1(f.read()).hexdigest()
+    return _fingerprints[(path, mtime)]
+
+
+def _repo_module(obj):
+    #module of this repository obj is (or is defined in), None otherwise
+    name = getattr(obj, "__module__", None)
+    module = obj if inspect.ismodule(obj) else sys.modules.get(name) if isinstance(name, str) else None
+    path = getattr(module, "__file__", None)
+    if path is None or os.path.dirname(os.path.abspath(path)) != SOURCE_DIR:
+        return None
+    return module
+
+
+def repo_dependencies(*objects):
+    """modules of this repository that objects (modules, functions, bound methods) are defined in or use,
+    following the globals of each module found. Returns a dict name -> module"""
+
+    stack = []
+    for obj in objects:
+        stack.append(obj)
+        #bound methods (eg of a StagedModel) also depend on what their object holds (eg the library)
+        owner = getattr(obj, "__self__", None)
+        if owner is not None and not inspect.ismodule(owner) and hasattr(owner, "__dict__"):
+            stack.extend([type(owner)] + list(vars(owner).values()))
+
+    modules = {}
+    while stack:
+        module = _repo_module(stack.pop())
+        if module is None or module.__name__ in modules:
+            continue
+        modules[module.__name__] = module
+        stack.extend(vars(module).values())
+    return modules
+
+
+def code_fingerprint(*objects):
+    """sha1 of the source files of the modules of this repository that objects (module names, modules or functions)
+    use, see repo_dependencies"""
+
+    objects = [sys.modules[o] if isinstance(o, str) else o for o in objects]
+    h = hashlib.sha1()
+    for name, module in sorted(repo_dependencies(*objects).items()):
+        h.update(name.encode())
+        h.update(_file_fingerprint(inspect.getsourcefile(module)).encode())
+    return h.hexdigest()
+
+
+def _feed(h, obj):
+    """updates hash h with a stable representation of obj"""
+
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(type(obj).__name__.encode())
+        h.update(repr(list(obj.index.names)).encode())
+        h.update(obj.to_csv().encode())
+    elif isinstance(obj, dict):
+        for k in sorted(obj):
+            h.update(repr(k).encode())
+            _feed(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            _feed(h, o)
+    else:
+        h.update(repr(obj).encode())
+    h.update(b'\0')
+
+
+def hash_inputs(*args, **kwargs):
+    """content hash of the positional and keyword arguments of a model call"""
+
+    h = hashlib.sha1()
+    _feed(h, list(args))
+    _feed(h, kwargs)
+    return h.hexdigest()
+
+
+class ResultStore():
+    """SQLite store of model outputs."""
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        with self._connect() as con:
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'input_hash TEXT, module TEXT, function TEXT, fingerprint TEXT, '
+                'created REAL, result BLOB, '
+                'PRIMARY KEY (input_hash, module, function, fingerprint))')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def get(self, input_hash, module, function, fingerprint):
+        """stored result or None"""
+        with self._connect() as con:
+            row = con.execute(
+                'SELECT result FROM results WHERE input_hash=? AND module=? AND function=? AND fingerprint=?',
+                (input_hash, module, function, fingerprint)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def put(self, input_hash, module, function, fingerprint, result):
+        """stores result and drops entries of the same function computed with older code"""
+        blob = sqlite3.Binary(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._connect() as con:
+            con.execute(
+                'DELETE FROM results WHERE module=? AND function=? AND fingerprint!=?',
+                (module, function, fingerprint))
+            con.execute(
+                'INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)',
+                (input_hash, module, function, fingerprint, time.time(), blob))
+
+    def call(self, func, *args, **kwargs):
+        """returns func(*args, **kwargs), reading through the store"""
+
+        module = func.__module__
+        function = func.__name__
+        fingerprint = code_fingerprint(module, func)
+        input_hash = hash_inputs(*args, **kwargs)
+
+        result = self.get(input_hash, module, function, fingerprint)
+        if result is not None:
+            logger.debug('result store hit: {}.{} {}'.format(module, function, input_hash))
+            return result
+
+        result = func(*args, **kwargs)
+        self.put(input_hash, module, function, fingerprint, result)
+        return result
+
+    def purge(self):
+        """removes entries whose module source changed since they were computed"""
+
+        with self._connect() as con:
+            keys = con.execute('SELECT DISTINCT module, fingerprint FROM results').fetchall()
+            stale = []
+            for module, fingerprint in keys:
+                try:
+                    current = code_fingerprint(importlib.import_module(module))
+                except ImportError:
+                    current = None
+                if current != fingerprint:
+                    stale.append((module, fingerprint))
+            con.executemany('DELETE FROM results WHERE module=? AND fingerprint=?', stale)
+        return len(stale)
+
+    def export(self, path, module=None, function=None):
+        """writes all stored frames (optionally only one module/function) to a single csv,
+        with the store key prepended to the index"""
+
+        query = 'SELECT input_hash, module, function, fingerprint, result FROM results'
+        conditions, params = [], []
+        if module is not None:
+            conditions.append('module=?')
+            params.append(module)
+        if function is not None:
+            conditions.append('function=?')
+            params.append(function)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        frames = {}
+        with self._connect() as con:
+            for input_hash, mod, fun, fingerprint, blob in con.execute(query, params):
+                result = pickle.loads(blob)
+                if isinstance(result, pd.Series):
+                    result = result.to_frame()
+                if isinstance(result, pd.DataFrame):
+                    frames[(mod, fun, fingerprint, input_hash)] = result
+
+        if not frames:
+            return None
+
+        out = pd.concat(frames, names=['module', 'function', 'fingerprint', 'input_hash'])
+        out.to_csv(path)
+        return out
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Manage the local store of model results.")
+    parser.add_argument('--store', default=STORE_PATH, help='path of the sqlite store')
+    sub = parser.add_subparsers(dest='command')
+    exp = sub.add_parser('export', help='bulk export stored results to csv')
+    exp.add_argument('output')
+    exp.add_argument('--module', default=None)
+    exp.add_argument('--function', default=None)
+    sub.add_parser('purge', help='remove results computed with outdated model code')
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.command == 'export':
+        store.export(args.output, module=args.module, function=args.function)
+    elif args.command == 'purge':
+        print('removed {} stale model versions'.format(store.purge()))
+    else:
+        parser.print_help()
@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+"""Multi-core scorecard runner.
+
+The unpacked inputs (df, macro, cat_info, hazard_ratios) are put in
+multiprocessing.shared_memory once; worker processes attach to them at
+start-up and evaluate policies without DataFrames being pickled. Results are
+gathered in pol_str_arr order and match model_scorecard_adapter.Model.run.
+Results are awaited until a deadline, so a worker that dies or hangs makes
+its policies fail instead of blocking the request.
+"""
+
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from packed_schema import coerce_frame
+from scorecard_policies import OUTPUT_COLUMNS, apply_policy, policy_options, unpack_for_policies
+
+logger = logging.getLogger(__name__)
+
+#longest wait for one policy when no timeout is given (a lost task would otherwise block forever)
+MAX_POLICY_SECONDS = 600
+
+#allowance for starting the workers and attaching the inputs
+STARTUP_SECONDS = 10
+
+#inputs attached in each worker: name -> (DataFrame, SharedMemory)
+_worker_inputs = dict()
+
+
+class PolicyTimeout(Exception):
+    pass
+
+
+class SharedFrame():
+    """Numeric block of a DataFrame in shared memory, plus the (small) metadata needed to rebuild it.
+    Non numeric columns (names, ids) are kept in the metadata."""
+
+    def __init__(self, df):
+        numeric = [c for c in df.columns if df[c].dtype.kind in "biuf"]
+        self.columns = list(df.columns)
+        self.numeric = numeric
+        self.dtypes = [df[c].dtype.str for c in numeric]
+        self.index = df.index
+        self.others = {c: df[c].values for c in df.columns if c not in numeric}
+        self.shape = (len(df), len(numeric))
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, 8 * len(df) * len(numeric)))
+        block = np.ndarray(self.shape, dtype="float64", buffer=self.shm.buf)
+        block[:] = df[numeric].values.astype("float64")
+        self.name = self.shm.name
+
+    def __getstate__(self):
+        #only metadata is pickled, the block is attached by name
+        state = self.__dict__.copy()
+        state["shm"] = None
+        return state
+
+    def attach(self):
+        """DataFrame viewing the shared block (numeric columns) with the original dtypes"""
+        shm = shared_memory.SharedMemory(name=self.name)
+        block = np.ndarray(self.shape, dtype="float64", buffer=shm.buf)
+        df = pd.DataFrame(block, index=self.index, columns=self.numeric, copy=False)
+        for c, dtype in zip(self.numeric, self.dtypes):
+            if np.dtype(dtype) != np.dtype("float64"):
+                df[c] = df[c].astype(dtype)
+        for c, values in self.others.items():
+            df[c] = values
+        return df[self.columns], shm
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _init_worker(shared, model_function, store):
+    for name, frame in shared.items():
+        _worker_inputs[name] = frame.attach()
+    module, function = model_function
+    _worker_inputs["model_function"] = (getattr(importlib.import_module(module), function), None)
+    _worker_inputs["store"] = (store, None)
+
+
+def _on_alarm(signum, frame):
+    raise PolicyTimeout()
+
+
+def _run_policy(pol_str, optionPDS, optionFee, p_col_impacted, timeout):
+    """evaluates one policy in a worker. Returns (output, error)"""
+
+    df = _worker_inputs["df"][0]
+    hazard_ratios = _worker_inputs["hazard_ratios"][0]
+    macro = _worker_inputs["macro"][0].copy()
+    cat_info = _worker_inputs["cat_info"][0].copy()
+    model_function = _worker_inputs["model_function"][0]
+    store = _worker_inputs["store"][0]
+
+    if timeout:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        macro, cat_info, optionPDS, optionFee = apply_policy(pol_str, macro, cat_info, optionPDS, optionFee, p_col_impacted)
+        args = (df, macro, cat_info, hazard_ratios)
+        kwargs = dict(optionPDS=optionPDS, optionFee=optionFee, outputs=OUTPUT_COLUMNS)
+        if store is not None:
+            output = store.call(model_function, *args, **kwargs)
+        else:
+            output = model_function(*args, **kwargs)
+        return output[OUTPUT_COLUMNS], None
+    except PolicyTimeout:
+        return None, "policy {} timed out after {}s".format(pol_str, timeout)
+    except Exception as e:
+        return None, "policy {} failed: {!r}".format(pol_str, e)
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def run_scorecard(df, pol_str_arr, pol_model_function, optionPDS="no", optionFee="tax", p_col_impacted=None, workers=None, timeout=None, store=None):
+    """evaluates the policies of pol_str_arr on df in parallel.
+    pol_model_function is the model function or its "module.function" name.
+    timeout is the maximum duration of one policy in seconds (None: only bounded by MAX_POLICY_SECONDS); policies
+    not done by the deadline, eg because their worker died, are reported as errors.
+    store: optional result_store.ResultStore the workers read through (each worker opens its own connections).
+    Returns (outputs, errors): outputs in pol_str_arr order (None for failed policies), errors maps policies to error messages"""
+
+    if not isinstance(pol_model_function, str):
+        pol_model_function = pol_model_function.__module__ + "." + pol_model_function.__name__
+    module, function = pol_model_function.rsplit(".", 1)
+
+    df = coerce_frame(df)
+
+    macro, cat_info, hazard_ratios = unpack_for_policies(df)
+    shared = dict(df=SharedFrame(df), macro=SharedFrame(macro), cat_info=SharedFrame(cat_info), hazard_ratios=SharedFrame(hazard_ratios))
+
+    options = policy_options(pol_str_arr, optionPDS, optionFee)
+
+    #policies run in rounds of one policy per worker
+    processes = workers or os.cpu_count() or 1
+    rounds = -(-len(pol_str_arr) // processes)
+    wait = timeout or MAX_POLICY_SECONDS
+    deadline = time.time() + STARTUP_SECONDS + wait * rounds
+
+    outputs, errors = [], dict()
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(shared, (module, function), store))
+    try:
+        pending = [pool.apply_async(_run_policy, (pol_str, o[0], o[1], p_col_impacted, timeout)) for pol_str, o in zip(pol_str_arr, options)]
+        for pol_str, result in zip(pol_str_arr, pending):
+            try:
+                output, error = result.get(max(0., deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                output, error = None, "policy {} did not finish within {}s (worker lost or hung)".format(pol_str, wait)
+            if error is not None:
+                logger.debug(error)
+                errors[pol_str] = error
+            outputs.append(output)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        for frame in shared.values():
+            frame.release()
+
+    return outputs, errors
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""Scorecard policies: how each policy of the scorecard modifies the model inputs.
+
+Shared by model_scorecard_adapter and the parallel scorecard runner, so this
+module has no side effects at import.
+"""
+
+import pandas as pd
+
+#columns of the model outputs kept in the scorecard
+OUTPUT_COLUMNS = ['id','group_name',"dK","dKtot","dWpc_currency","dWtot_currency"]
+
+#policies of the viewer's scorecard
+DEFAULT_POLICIES = ["_exp095", "_exr095", "_pcinc_p_110", "_soc133", "_rec067", "_ew100", "_vul070p", "_vul070", "optionPDS", "optionFee", "axfin"]
+
+
+def unpack_for_policies(df):
+    """splits packed inputs df into macro, cat_info and hazard_ratios, as expected by compute_resilience_from_adjusted_inputs_for_pol"""
+
+    ##MACRO
+    macro_cols = [c for c in df if "macro" in c]
+    macro = df[macro_cols]
+    macro = macro.rename(columns=lambda c: c.replace("macro_", ""))
+    #print(macro.to_string())
+
+    ##CAT INFO
+    cat_cols = [c for c in df if "cat_info" in c]
+    cat_info = df[cat_cols]
+    cat_info.columns = pd.MultiIndex.from_tuples([c.replace("cat_info_", "").split("__") for c in cat_info])
+    cat_info = cat_info.sort_index(axis=1).stack()
+    cat_info.index.names = "name", "income_cat"
+
+    #print(cat_info.columns)
+    #OUTPUT FROM ABOVE PRINT:Index(['axfin', 'c', 'fa', 'gamma_SP', 'k', 'n', 'shew', 'v'], dtype='object')
+
+    ##HAZARD RATIOS
+    ###exposure
+    fa_cols = [c for c in df if "hazard_ratio_fa" in c]
+    fa = df[fa_cols]
+    fa.columns = [c.replace("hazard_ratio_fa__", "") for c in fa]
+
+    ##### add poor and nonpoor
+    hop = pd.DataFrame(2 * [fa.unstack()], index=["poor", "nonpoor"]).T
+    hop.ix["flood"]["poor"] = df.hazard_ratio_flood_poor
+    # print(hop)
+    hop.ix["surge"]["poor"] = hop.ix["flood"]["poor"] * df["ratio_surge_flood"]
+    hop.ix["surge"]["nonpoor"] = hop.ix["flood"]["nonpoor"] * df["ratio_surge_flood"]
+    hop = hop.stack().swaplevel(0, 1).sort_index()
+    hop.index.names = ["name", "hazard", "income_cat"]
+
+    hazard_ratios = pd.DataFrame()
+    hazard_ratios["fa"] = hop
+
+    ## Shew
+    hazard_ratios["shew"] = 0
+    # hazard_ratios["shew"] +=df.shew_for_hazard_ratio #sesha commenting this and adding next two lines.
+    names = hazard_ratios["fa"].index.get_level_values('name')  # sesha added
+    hazard_ratios["shew"] = df.ix[names]["shew_for_hazard_ratio"].values  # sesha added
+    # no EW for earthquake
+    hazard_ratios["shew"] = hazard_ratios.shew.unstack("hazard").assign(earthquake=0).stack("hazard").reset_index().set_index(["name", "hazard", "income_cat"])
+
+    return macro, cat_info, hazard_ratios
+
+
+def apply_policy(pol_str, macro, cat_info, optionPDS="no", optionFee="tax", p_col_impacted=None):
+    """modifies macro and cat_info (in place) for policy pol_str. Returns macro, cat_info, optionPDS, optionFee"""
+
+    # POLICY: Reduce vulnerability of the poor by 5% of their current exposure
+    if pol_str == '_exp095':
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), "v"] *= 0.95
+
+    # POLICY: Reduce vulnerability of the rich by 5% of their current exposure
+    elif pol_str == '_exr095':
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "nonpoor"), "v"] *= 0.95
+
+    # POLICY: Increase income of the poor by 10%
+    elif pol_str == '_pcinc_p_110':
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), "c"] *= 1.10
+        cat_info['gamma_SP'] = cat_info['gamma_SP'] / cat_info['c']
+
+    # POLICY: Increase social transfers to poor BY one third
+    elif pol_str == '_soc133':
+        # Cost of this policy = sum(social_topup), per person
+        cat_info['social_topup'] = 0
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), "social_topup"] = 0.333 * cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), ["gamma_SP","c"]].prod(axis=1)
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), "c"] *= (1.0 + 0.333 * cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), "gamma_SP"])
+        # Initialize cat_info['pcsoc'] to 0 for now. CHECK WITH BRIAN.
+        cat_info['pcsoc'] = 0
+        # BRIAN says cat_info['pcsoc'] is computed from social, but it is used for computing social on next line. Something need to change here.
+        cat_info['gamma_SP'] = (cat_info['social_topup'] + cat_info['pcsoc']) / cat_info['c']
+
+    # POLICY: Decrease reconstruction time by 1/3
+    elif pol_str == '_rec067':
+        macro['T_rebuild_K'] *= 0.666667
+
+    # POLICY: Increase access to early warnings to 100%
+    elif pol_str == '_ew100':
+        cat_info['shew'] = 1.0
+        cat_info[p_col_impacted] = 1.0
+
+    # POLICY: Decrease vulnerability of poor by 30%
+    elif pol_str == '_vul070':
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), "v"] *=0.70
+
+    # POLICY: Decrease vulnerability of rich by 30%
+    elif pol_str == '_vul070r':
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "nonpoor"), "v"] *= 0.70
+
+    # POLICY: Postdisaster support package
+    elif pol_str == 'optionPDS':
+        optionPDS = "unif_poor"
+
+    # POLICY: Develop market insurance (optionFee = 'insurance_premium')
+    elif pol_str == 'optionFee':
+        optionPDS = "unif_poor"
+        optionFee = "insurance_premium"
+
+    # POLICY: Universal access to finance
+    elif pol_str == 'axfin':
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "nonpoor"), "axfin"] = 1
+        cat_info.ix[(cat_info.index.get_level_values('income_cat') == "poor"), "axfin"] = 1
+
+    return macro, cat_info, optionPDS, optionFee
+
+
+def policy_options(pol_str_arr, optionPDS="no", optionFee="tax"):
+    """(optionPDS, optionFee) used for each policy of pol_str_arr. As in the original scorecard loop,
+    options set by the optionPDS and optionFee policies carry over to the following policies"""
+
+    out = []
+    for pol_str in pol_str_arr:
+        if pol_str == 'optionPDS':
+            optionPDS = "unif_poor"
+        elif pol_str == 'optionFee':
+            optionPDS = "unif_poor"
+            optionFee = "insurance_premium"
+        out.append((optionPDS, optionFee))
+    return out
@@ -0,0 +1,278 @@
+# -*- coding: UTF-8 -*-
+"""compute_resilience as a graph of cached stages.
+
+Each stage declares the columns of its inputs it depends on. A stage is only
+re-executed when the fingerprint of these columns (or of its parameters)
+changes, so a perturbed scenario evaluated after its baseline only re-runs
+the invalidated stages: _rec067 (T_rebuild_K) re-runs the macro multiplier
+and what follows it but not the rp interpolation or the capital losses,
+shew and v changes leave the rp interpolation untouched, etc.
+
+Callers that know what changed relative to an earlier run (eg a baseline row
+plus a few overridden fields) can pass it as a hint: the fingerprints of the
+unchanged inputs are then reused rather than hashed again.
+"""
+
+import collections
+import hashlib
+import importlib
+import threading
+
+import pandas as pd
+
+
+class Dep():
+    """dependency of a stage on node: all its columns (columns=None), some of them, or only its index (columns=[])"""
+
+    def __init__(self, node, columns=None, exclude=()):
+        self.node = node
+        self.columns = columns
+        self.exclude = list(exclude)
+
+    def key(self):
+        return (self.node, None if self.columns is None else tuple(self.columns), tuple(self.exclude))
+
+    def affected_by(self, columns):
+        """whether changes of columns (of node) change the fingerprint"""
+        if self.columns is None:
+            return any(c not in self.exclude for c in columns)
+        return any(c in self.columns and c not in self.exclude for c in columns)
+
+    def fingerprint(self, value):
+        h = hashlib.sha1()
+        if isinstance(value, pd.DataFrame):
+            cols = list(value.columns) if self.columns is None else [c for c in self.columns if c in value]
+            cols = [c for c in cols if c not in self.exclude]
+            h.update(repr(cols).encode())
+            h.update(pd.util.hash_pandas_object(value.index).values.tobytes())
+            if cols:
+                h.update(pd.util.hash_pandas_object(value[cols], index=False).values.tobytes())
+        elif isinstance(value, pd.Series):
+            h.update(pd.util.hash_pandas_object(value.index).values.tobytes())
+            if self.columns != []:
+                h.update(pd.util.hash_pandas_object(value, index=False).values.tobytes())
+        else:
+            h.update(repr(value).encode())
+        return h.hexdigest()
+
+
+class Stage():
+    """function(**inputs, **params) returning the values of outputs (one value or a tuple)"""
+
+    def __init__(self, name, function, deps, outputs, params=()):
+        self.name = name
+        self.function = function
+        self.deps = deps
+        self.outputs = outputs
+        self.params = list(params)
+
+
+class StageGraph():
+    """Stages in execution order, with the outputs of the last cache_size evaluations of each stage.
+    Runs can be made from several threads"""
+
+    def __init__(self, stages, cache_size=8, max_references=1024):
+        self.stages = stages
+        self.cache_size = cache_size
+        self.cache = {s.name: collections.OrderedDict() for s in stages}
+        #reference label -> fingerprints of the input dependencies of the run recorded under it
+        self.references = collections.OrderedDict()
+        self.max_references = max_references
+        self._lock = threading.Lock()
+        #stages executed by the last run
+        self.executed = []
+
+    def clear(self):
+        with self._lock:
+            for c in self.cache.values():
+                c.clear()
+            self.references.clear()
+
+    def run(self, nodes, reference=None, changed=None, **params):
+        """evaluates the stages on nodes (dict of input values). Returns nodes with every stage output.
+        reference: optional label of the inputs. Without changed, the fingerprints of the inputs are recorded under it.
+        changed: dict input node -> changed columns, telling that the inputs are those recorded under reference except these columns:
+        the recorded fingerprints of the dependencies they do not affect are reused"""
+
+        inputs = set(nodes)
+        nodes = dict(nodes)
+        executed = []
+
+        with self._lock:
+            known = self.references.get(reference) if changed is not None else None
+        fingerprints = dict()
+
+        for stage in self.stages:
+            h = hashlib.sha1()
+            for dep in stage.deps:
+                if known is not None and dep.node in inputs and dep.key() in known and not dep.affected_by(changed.get(dep.node, ())):
+                    fingerprint = known[dep.key()]
+                else:
+                    fingerprint = dep.fingerprint(nodes[dep.node])
+                if dep.node in inputs:
+                    fingerprints[dep.key()] = fingerprint
+                h.update(fingerprint.encode())
+            h.update(repr([(p, params.get(p)) for p in stage.params]).encode())
+            key = h.hexdigest()
+
+            cache = self.cache[stage.name]
+            with self._lock:
+                out = cache.get(key)
+                if out is not None:
+                    cache.move_to_end(key)
+            if out is None:
+                out = stage.function(**{d.node: nodes[d.node] for d in stage.deps}, **{p: params.get(p) for p in stage.params})
+                out = out if len(stage.outputs) > 1 else (out,)
+                with self._lock:
+                    cache[key] = out
+                    if len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+                executed.append(stage.name)
+
+            nodes.update(zip(stage.outputs, out))
+
+        if reference is not None and changed is None:
+            with self._lock:
+                self.references[reference] = fingerprints
+                if len(self.references) > self.max_references:
+                    self.references.popitem(last=False)
+
+        self.executed = executed
+        return nodes
+
+
+def packed_changes(columns):
+    """input node -> columns of compute_resilience inputs changed by changes of packed columns (see unpack_packed_inputs)"""
+    out = collections.defaultdict(set)
+    for col in columns:
+        if col.startswith("macro_"):
+            out["macro_in"].add(col.replace("macro_", ""))
+        elif "_cat_info__" in col:
+            out["cat_info_in"].add(col.split("_cat_info__")[0])
+        elif col.startswith("hazard_ratio_") or col == "ratio_surge_flood":
+            out["hazard_ratios_in"].add("fa")
+        elif col == "shew_for_hazard_ratio":
+            out["hazard_ratios_in"].add("shew")
+    return dict(out)
+
+
+#options of the response stage (see compute_dK_dW_after_response)
+RESPONSE_OPTIONS = ["optionT", "optionPDS", "optionB", "optionFee", "loss_measure", "fraction_inside", "share_insured", "return_stats", "is_local_welfare", "outputs"]
+
+
+def resilience_stages(lib):
+    """stages of compute_resilience, with the functions of lib (module)"""
+
+    def clean(macro_in, cat_info_in, hazard_ratios_in):
+        return lib.clean_inputs(macro_in, cat_info_in, hazard_ratios_in)
+
+    def hazard_events(hazard_ratios, macro_clean, ragged_rps):
+        return lib.hazard_ratios_to_events(hazard_ratios, macro_clean["protection"], ragged_rps=bool(ragged_rps))
+
+    def harmonize(macro_clean, cat_info_clean, hazard_ratios):
+        #reconstruction time is added back by the macro multiplier stage
+        return lib.harmonize_inputs(macro_clean.drop("T_rebuild_K", axis=1), cat_info_clean.copy(), hazard_ratios)
+
+    def macro_multiplier(macro_harmonized, macro_clean):
+        macro = macro_harmonized.copy()
+        macro.insert(list(macro_clean.columns).index("T_rebuild_K"), "T_rebuild_K", macro_clean["T_rebuild_K"].reindex(macro.index))
+        macro["macro_multiplier"] = lib.compute_macro_multiplier(macro)
+        return macro
+
+    def broadcast(macro, cat_info, hazard_ratios_event, ragged_rps):
+        return lib.broadcast_inputs(macro, cat_info, hazard_ratios_event, ragged_rps=bool(ragged_rps))
+
+    def capital_losses(macro_event, cats_event):
+        return lib.compute_capital_losses(macro_event, cats_event)
+
+    def consumption_losses(macro_event, cats_event_dk, dk_event):
+        macro_event = macro_event.assign(dk_event=dk_event)
+        return macro_event, lib.compute_consumption_losses(macro_event, cats_event_dk.copy())
+
+    def response(macro_event_losses, cats_event_ia, **options):
+        return lib.compute_dK_dW_after_response(macro_event_losses.copy(), cats_event_ia.copy(), **{k: v for k, v in options.items() if v is not None})
+
+    def aggregate(macro, dkdw_event, macro_event_losses, is_local_welfare, outputs):
+        out = lib.aggregate_losses(macro, dkdw_event, macro_event_losses, is_local_welfare, outputs=outputs)
+        if outputs is not None:
+            out = out[[c for c in outputs if c in out]]
+        return out
+
+    return [
+        Stage("clean", clean, [Dep("macro_in"), Dep("cat_info_in"), Dep("hazard_ratios_in")], ["macro_clean", "cat_info_clean", "hazard_ratios"]),
+        Stage("interpolate_rps", hazard_events, [Dep("hazard_ratios"), Dep("macro_clean", ["protection"])], ["hazard_ratios_event"], ["ragged_rps"]),
+        Stage("harmonize", harmonize, [Dep("macro_clean", exclude=["T_rebuild_K"]), Dep("cat_info_clean"), Dep("hazard_ratios", [])], ["macro_harmonized", "cat_info"]),
+        Stage("macro_multiplier", macro_multiplier, [Dep("macro_harmonized"), Dep("macro_clean", ["T_rebuild_K"])], ["macro"]),
+        Stage("broadcast", broadcast, [Dep("macro"), Dep("cat_info"), Dep("hazard_ratios_event")], ["macro_event", "cats_event"], ["ragged_rps"]),
+        Stage("capital_losses", capital_losses, [Dep("macro_event", ["pi"]), Dep("cats_event")], ["cats_event_dk", "dk_event"]),
+        Stage("consumption_losses", consumption_losses, [Dep("macro_event"), Dep("cats_event_dk"), Dep("dk_event")], ["macro_event_losses", "cats_event_ia"]),
+        Stage("response", response, [Dep("macro_event_losses"), Dep("cats_event_ia")], ["dkdw_event"], RESPONSE_OPTIONS),
+        Stage("aggregate", aggregate, [Dep("macro"), Dep("dkdw_event"), Dep("macro_event_losses", ["protection"])], ["result"], ["is_local_welfare", "outputs"]),
+    ]
+
+
+class StagedModel():
+    """compute_resilience of lib (module or module name) evaluated through a StageGraph, for repeated calls on perturbed inputs"""
+
+    def __init__(self, lib="res_ind_lib", cache_size=8):
+        self.lib = importlib.import_module(lib) if isinstance(lib, str) else lib
+        self.graph = StageGraph(resilience_stages(self.lib), cache_size=cache_size)
+
+    def knows(self, reference):
+        """whether inputs were recorded under reference (see StageGraph.run)"""
+        return reference in self.graph.references
+
+    def compute_resilience(self, df_in, cat_info, hazard_ratios=None, is_local_welfare=True, ragged_rps=False, outputs=None, reference=None, changed=None, **options):
+        """same as lib.compute_resilience. Options the graph does not handle (return_iah, profiler, verbose_replace, breakdown) and scenarios run lib.compute_resilience.
+        reference and changed are the optional hint of StageGraph.run"""
+
+        #the rp interpolation of scenarios follows the harmonization (see lib.prepare_inputs): not a stage of the graph
+        if any(options.get(o) for o in ["return_iah", "profiler", "verbose_replace", "breakdown"]) or self.lib.has_scenarios(hazard_ratios):
+            return self.lib.compute_resilience(df_in, cat_info, hazard_ratios, is_local_welfare=is_local_welfare, ragged_rps=ragged_rps, outputs=outputs, **options)
+
+        unknown = [o for o in options if o not in RESPONSE_OPTIONS + ["return_iah", "profiler", "verbose_replace", "breakdown", "breakdown_levels"]]
+        if unknown:
+            raise TypeError("unexpected options: " + ", ".join(unknown))
+
+        params = dict(self.lib.default_response_options, **{o: v for o, v in options.items() if o in RESPONSE_OPTIONS})
+        nodes = self.graph.run(dict(macro_in=df_in, cat_info_in=cat_info, hazard_ratios_in=hazard_ratios), reference=reference, changed=changed,
+                               is_local_welfare=is_local_welfare, ragged_rps=ragged_rps, outputs=outputs, **params)
+        return nodes["result"].copy()
+
+    def compute_resilience_from_packed_inputs(self, df, reference=None, changed=None, **kwargs):
+        """same as lib.compute_resilience_from_packed_inputs. changed: packed columns changed relative to the inputs recorded under reference"""
+
+        df = df.copy()
+        macro, cat_info, hazard_ratios = self.lib.unpack_packed_inputs(df)
+        out = self.compute_resilience(macro, cat_info, hazard_ratios, reference=reference,
+                                      changed=None if changed is None else packed_changes(changed), **kwargs)
+
+        outputs = [c for c in ["risk", "resilience", "risk_to_assets"] if c in out]
+        df[outputs] = out[outputs]
+        return df
+
+    def compute_resilience_from_adjusted_inputs_for_pol(self, df, macro, cat_info, hazard_ratios, optionPDS, optionFee, **kwargs):
+        """same as res_ind_lib_big.compute_resilience_from_adjusted_inputs_for_pol"""
+
+        out = self.compute_resilience(macro, cat_info, hazard_ratios, optionPDS=optionPDS, optionFee=optionFee, **kwargs)
+        df2 = df.copy()
+        outputs = ["risk", "resilience", "risk_to_assets", "dK", "dKtot", "delta_W", "delta_W_tot", "dWpc_currency", "dWtot_currency"]
+        for col in outputs[3:]:
+            df2[col] = 0.0
+        outputs = [c for c in outputs if c in out]
+        df2[outputs] = out[outputs]
+        return df2
+
+
+#process wide StagedModels: lib name -> StagedModel
+_shared = dict()
+_shared_lock = threading.Lock()
+
+
+def shared_model(lib="res_ind_lib", cache_size=256):
+    """StagedModel of lib shared by the requests of a process"""
+    name = lib if isinstance(lib, str) else lib.__name__
+    with _shared_lock:
+        if name not in _shared:
+            _shared[name] = StagedModel(lib, cache_size=cache_size)
+        return _shared[name]
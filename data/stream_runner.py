@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""Command line runner streaming model outputs for packed input records.
+
+Reads packed input records as ndjson (one json record per line) or csv from a
+file or stdin and runs them in batches (see batch_records.run_batch). One
+ndjson line per record, with the name and either result or error, is written
+to stdout in input order as soon as its batch is done. Only a few batches are
+read ahead, so memory stays bounded whatever the size of the input, and
+batches can be run in several worker processes. With --policies, each record
+is evaluated under the scorecard policies and its result holds the
+scorecard outputs of each policy (id and group_name only when the records
+have them, eg df_for_wrapper_scp.csv).
+
+    python stream_runner.py df_for_wrapper.csv --format csv --batch-size 64 --workers 4 > model/outputs.ndjson
+    cat records.ndjson | python stream_runner.py -m res_ind_lib_big.compute_resilience_from_packed_inputs
+"""
+
+import argparse
+import collections
+import csv
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+import sys
+
+from batch_records import parse_line, row_result, run_batch
+from packed_schema import coerce_frame
+from scorecard_policies import DEFAULT_POLICIES, OUTPUT_COLUMNS, apply_policy, policy_options, unpack_for_policies
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ["ndjson", "csv"]
+
+DEFAULT_MODEL_FUNCTION = "res_ind_lib.compute_resilience_from_packed_inputs"
+DEFAULT_POLICY_FUNCTION = "res_ind_lib_big.compute_resilience_from_adjusted_inputs_for_pol"
+
+DEFAULT_BATCH_SIZE = 64
+
+#batches submitted to the workers ahead of the one being written, per worker
+READ_AHEAD = 2
+
+#model function of the worker process
+_worker_model = dict()
+
+
+class PolicyModel():
+    """Model function evaluating the scorecard policies on packed inputs, as model_scorecard_adapter.Model.
+    Returns a dict policy -> scorecard outputs (OUTPUT_COLUMNS per economy, without the id and group_name labels
+    the inputs do not have)"""
+
+    def __init__(self, pol_model_function, pol_str_arr, p_col_impacted=None):
+        self.pol_model_function = pol_model_function
+        self.pol_str_arr = pol_str_arr
+        self.p_col_impacted = p_col_impacted
+
+    def __call__(self, df):
+        df = coerce_frame(df)
+        out = collections.OrderedDict()
+        for pol_str, (optionPDS, optionFee) in zip(self.pol_str_arr, policy_options(self.pol_str_arr)):
+            macro, cat_info, hazard_ratios = unpack_for_policies(df)
+            macro, cat_info, optionPDS, optionFee = apply_policy(pol_str, macro, cat_info, optionPDS, optionFee, self.p_col_impacted)
+            output = self.pol_model_function(df, macro, cat_info, hazard_ratios, optionPDS=optionPDS, optionFee=optionFee, outputs=OUTPUT_COLUMNS)
+            out[pol_str] = output[[c for c in OUTPUT_COLUMNS if c in output]]
+        return out
+
+
+def policy_result(out, name):
+    """result of the record name in the outputs of a PolicyModel: scorecard outputs per policy"""
+    return collections.OrderedDict((pol_str, row_result(output, name)) for pol_str, output in out.items())
+
+
+def model_function(function, policies=None, p_col_impacted=None):
+    """(model function, result function) for function ("module.function"), evaluated under policies if given"""
+    module, name = function.rsplit(".", 1)
+    f = getattr(importlib.import_module(module), name)
+    if policies is None:
+        return f, row_result
+    return PolicyModel(f, policies, p_col_impacted), policy_result
+
+
+def read_batches(f, fmt="ndjson", batch_size=DEFAULT_BATCH_SIZE):
+    """yields lists of (record, error), as taken by run_batch, of at most batch_size records read from the file object f"""
+
+    if fmt == "csv":
+        reader = csv.reader(f)
+        header = next(reader, None)
+        records = ((dict(zip(header, row)), None) if len(row) == len(header) else
+                   (None, "line {}: {} values for {} columns".format(reader.line_num, len(row), len(header)))
+                   for row in reader if row)
+    elif fmt == "ndjson":
+        records = (parse_line(line) for line in f if line.strip())
+    else:
+        raise ValueError("format should be one of " + ", ".join(FORMATS))
+
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _run(records, model, result_function):
+    #one ndjson line per record, and the number of errors
+    results = run_batch(records, model, result_function=result_function)
+    return "".join(json.dumps(r) + "\n" for r in results), sum("error" in r for r in results)
+
+
+def _init_worker(spec):
+    _worker_model["model"] = model_function(*spec)
+
+
+def _run_in_worker(records):
+    return _run(records, *_worker_model["model"])
+
+
+def run_stream(batches, out, function=DEFAULT_MODEL_FUNCTION, policies=None, p_col_impacted=None, workers=1):
+    """runs the batches (as yielded by read_batches) with function and writes the results to the file object out as ndjson,
+    in input order. With workers > 1, batches are run in worker processes, READ_AHEAD batches per worker being read ahead.
+    Returns the number of records and the number of errors"""
+
+    spec = (function, policies, p_col_impacted)
+    counts = collections.Counter()
+
+    def write(batch):
+        text, errors = batch
+        out.write(text)
+        out.flush()
+        counts["records"] += text.count("\n")
+        counts["errors"] += errors
+        logger.debug('stream: {} records written'.format(counts["records"]))
+
+    if workers <= 1:
+        model = model_function(*spec)
+        for records in batches:
+            write(_run(records, *model))
+        return counts["records"], counts["errors"]
+
+    pending = collections.deque()
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(spec,))
+    try:
+        for records in batches:
+            pending.append(pool.apply_async(_run_in_worker, (records,)))
+            if len(pending) >= READ_AHEAD * workers:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return counts["records"], counts["errors"]
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        filename='model/model.log', level=logging.DEBUG,
+        format='%(asctime)s: %(levelname)s: %(message)s')
+
+    parser = argparse.ArgumentParser(description="Run the model on packed input records and stream the results as ndjson.")
+    parser.add_argument('input', nargs='?', default='-', help='ndjson or csv packed input records (default: stdin)')
+    parser.add_argument('--format', choices=FORMATS, default=None, help='input format (default: from the file extension, ndjson for stdin)')
+    parser.add_argument('-m', '--model-function', default=None,
+                        help='module.function of the model (default: {}, or {} with --policies)'.format(DEFAULT_MODEL_FUNCTION, DEFAULT_POLICY_FUNCTION))
+    parser.add_argument('--policies', nargs='?', const=",".join(DEFAULT_POLICIES), default=None,
+                        help='evaluate the scorecard policies (comma separated, default: the viewer scorecard)')
+    parser.add_argument('--p-col-impacted', default=None, help='column impacted by the _ew100 policy')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='records per model call')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.input.lower().endswith(".csv") else "ndjson")
+    policies = args.policies.split(",") if args.policies is not None else None
+    function = args.model_function or (DEFAULT_POLICY_FUNCTION if policies is not None else DEFAULT_MODEL_FUNCTION)
+
+    f = sys.stdin if args.input == '-' else open(args.input, newline='')
+    try:
+        n, errors = run_stream(read_batches(f, fmt, args.batch_size), sys.stdout, function=function, policies=policies,
+                               p_col_impacted=args.p_col_impacted, workers=args.workers)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    logger.info('stream: {} records, {} errors'.format(n, errors))